@@ -1,29 +1,39 @@
 import os
 import torch
-import fire
-import gradio as gr
 from PIL import Image
-from functools import partial
-import spaces 
-import cv2
+from functools import partial, wraps
 import time
+import shutil
+import tempfile
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
-from rembg import remove
-from segment_anything import sam_model_registry, SamPredictor
 
-import os
-import torch
-
-from PIL import Image
-from typing import Dict, Optional,  List
+from typing import Any, Dict, Optional,  List
 from dataclasses import dataclass
 from mvdiffusion.data.single_image_dataset import SingleImageDataset 
-from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
 from einops import rearrange
-import numpy as np
 import subprocess
 from datetime import datetime
-from icecream import ic
+# gradio, spaces, segment_anything, rembg, cv2 and diffusers are imported at their first use, see
+# benchmarks/importtime.py
+
+
+def gpu_task(fn):
+    # `spaces.GPU`, resolved when the task first runs so importing the app does not import `spaces`
+    gpu_fn = None
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal gpu_fn
+        if gpu_fn is None:
+            import spaces
+            gpu_fn = spaces.GPU(fn)
+        return gpu_fn(*args, **kwargs)
+
+    return wrapper
+
 def save_image(tensor):
     ndarr = tensor.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to("cpu", torch.uint8).numpy()
     # pdb.set_trace()
@@ -62,25 +72,64 @@ if not hasattr(Image, 'Resampling'):
     Image.Resampling = Image
 
 
-def sam_init():
-    sam_checkpoint = os.path.join(os.path.dirname(__file__), "sam_pt", "sam_vit_h_4b8939.pth")
-    model_type = "vit_h"
+SAM_CHECKPOINTS = {
+    'vit_h': 'sam_vit_h_4b8939.pth',
+    'vit_l': 'sam_vit_l_0b3195.pth',
+    'vit_b': 'sam_vit_b_01ec64.pth',
+    # MobileSAM, needs the `mobile_sam` package
+    'vit_t': 'mobile_sam.pt',
+}
+
+
+class CachedSamPredictor:
+    # one SAM model shared by all sessions; every session keeps the image embeddings of its last images (an
+    # OrderedDict in `gr.State`), so a new box on the same image only runs the prompt decoder. The lock keeps the
+    # image set by a request until its prediction is done.
+    def __init__(self, predictor, max_images=4):
+        self.predictor = predictor
+        self.max_images = max_images
+        self.lock = threading.Lock()
+
+    def predict(self, image, embeddings=None, **kwargs):
+        key = (hashlib.sha1(image.tobytes()).hexdigest(), image.shape)
+        with self.lock:
+            cached = embeddings is not None and key in embeddings
+            if cached:
+                embeddings.move_to_end(key)
+                self.predictor.features, self.predictor.original_size, self.predictor.input_size = embeddings[key]
+                self.predictor.is_image_set = True
+            else:
+                self.predictor.set_image(image)
+                if embeddings is not None:
+                    embeddings[key] = (self.predictor.features, self.predictor.original_size, self.predictor.input_size)
+                    if len(embeddings) > self.max_images:
+                        embeddings.popitem(last=False)
+            return self.predictor.predict(**kwargs), cached
+
+
+def sam_init(model_type='vit_h'):
+    if model_type == 'vit_t':
+        from mobile_sam import sam_model_registry, SamPredictor
+    else:
+        from segment_anything import sam_model_registry, SamPredictor
+
+    sam_checkpoint = os.path.join(os.path.dirname(__file__), "sam_pt", SAM_CHECKPOINTS[model_type])
 
     sam = sam_model_registry[model_type](checkpoint=sam_checkpoint).to(device=f"cuda:{_GPU_ID}")
-    predictor = SamPredictor(sam)
+    predictor = CachedSamPredictor(SamPredictor(sam))
     return predictor
 
-@spaces.GPU
-def sam_segment(predictor, input_image, *bbox_coords):
+@gpu_task
+def sam_segment(predictor, input_image, *bbox_coords, embeddings=None):
     bbox = np.array(bbox_coords)
     image = np.asarray(input_image)
 
     start_time = time.time()
-    predictor.set_image(image)
-
-    masks_bbox, scores_bbox, logits_bbox = predictor.predict(box=bbox, multimask_output=True)
+    (masks_bbox, scores_bbox, logits_bbox), cached = predictor.predict(
+        image, embeddings, box=bbox, multimask_output=True
+    )
 
-    print(f"SAM Time: {time.time() - start_time:.3f}s")
+    print(f"SAM Time: {time.time() - start_time:.3f}s{' (cached embedding)' if cached else ''}")
     out_image = np.zeros((image.shape[0], image.shape[1], 4), dtype=np.uint8)
     out_image[:, :, :3] = image
     out_image_bbox = out_image.copy()
@@ -103,15 +152,17 @@ def expand2square(pil_img, background_color):
         return result
 
 
-def preprocess(predictor, input_image, chk_group=None, segment=True, rescale=False):
+def preprocess(predictor, input_image, chk_group=None, sam_embeddings=None, segment=True, rescale=False):
     RES = 1024
     input_image.thumbnail([RES, RES], Image.Resampling.LANCZOS)
     if chk_group is not None:
         segment = "Background Removal" in chk_group
         rescale = "Rescale" in chk_group
     if segment:
+        from mvdiffusion.data.background_removal import remove_background
+
         image_rem = input_image.convert('RGBA')
-        image_nobg = remove(image_rem, alpha_matting=True)
+        image_nobg = remove_background(image_rem, alpha_matting=True)
         arr = np.asarray(image_nobg)[:, :, -1]
         x_nonzero = np.nonzero(arr.sum(axis=0))
         y_nonzero = np.nonzero(arr.sum(axis=1))
@@ -119,9 +170,13 @@ def preprocess(predictor, input_image, chk_group=None, segment=True, rescale=Fal
         y_min = int(y_nonzero[0].min())
         x_max = int(x_nonzero[0].max())
         y_max = int(y_nonzero[0].max())
-        input_image = sam_segment(predictor, input_image.convert('RGB'), x_min, y_min, x_max, y_max)
+        input_image = sam_segment(
+            predictor, input_image.convert('RGB'), x_min, y_min, x_max, y_max, embeddings=sam_embeddings
+        )
     # Rescale and recenter
     if rescale:
+        import cv2
+
         image_arr = np.array(input_image)
         in_w, in_h = image_arr.shape[:2]
         out_res = min(RES, max(in_w, in_h))
@@ -140,14 +195,17 @@ def preprocess(predictor, input_image, chk_group=None, segment=True, rescale=Fal
         input_image = Image.fromarray((rgb * 255).astype(np.uint8))
     else:
         input_image = expand2square(input_image, (127, 127, 127, 0))
-    return input_image, input_image.resize((320, 320), Image.Resampling.LANCZOS)
+    return input_image, input_image.resize((320, 320), Image.Resampling.LANCZOS), sam_embeddings
 
 def load_era3d_pipeline(cfg):
+    from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
+
     # Load scheduler, tokenizer and models.
     
     pipeline = StableUnCLIPImg2ImgPipeline.from_pretrained(
         cfg.pretrained_model_name_or_path,
-        torch_dtype=weight_dtype
+        torch_dtype=weight_dtype,
+        **cfg.pipe_kwargs,
     )
     # sys.main_lock = threading.Lock()
     return pipeline
@@ -156,64 +214,125 @@ def load_era3d_pipeline(cfg):
 from mvdiffusion.data.single_image_dataset import SingleImageDataset
 
 
-def prepare_data(single_image, crop_size, cfg):
+def prepare_data(single_image, crop_size):
+    # the prompt embeddings are held by the runtime, the dataset only preprocesses the image
     dataset = SingleImageDataset(root_dir='', num_views=6, img_wh=[512, 512], bg_color='white', 
-        crop_size=crop_size, single_image=single_image, prompt_embeds_path=cfg.validation_dataset.prompt_embeds_path)
+        crop_size=crop_size, single_image=single_image, prompt_embeds_path=None)
     return dataset[0]
 
-scene = 'scene'
-@spaces.GPU
-def run_pipeline(pipeline, cfg, single_image, guidance_scale, steps, seed, crop_size, chk_group=None):
-    pipeline.to(device=f'cuda:{_GPU_ID}')
-    pipeline.unet.enable_xformers_memory_efficient_attention()
-    
-    global scene
-    # pdb.set_trace()
 
-    if chk_group is not None:
-        write_image = "Write Results" in chk_group
+class Era3DRuntime:
+    # built once at startup: the pipeline, its placement and attention setup, and the fixed prompt embeddings, so a
+    # request only preprocesses its image and runs inference
+    def __init__(self, cfg, device=f'cuda:{_GPU_ID}'):
+        self.cfg = cfg
+        self.device = device
+        self.pipeline = load_era3d_pipeline(cfg)
+        self.pipeline.set_progress_bar_config(disable=True)
+
+        prompt_embeds_path = cfg.validation_dataset.prompt_embeds_path
+        prompt_embeddings = torch.stack([
+            torch.load(f'{prompt_embeds_path}/normal_embeds.pt'), torch.load(f'{prompt_embeds_path}/clr_embeds.pt')
+        ], dim=0)
+        self.prompt_embeddings = rearrange(prompt_embeddings, "B Nv N C -> (B Nv) N C")
+        self.result_cache = None
+        if cfg.result_cache_dir is not None:
+            from mvdiffusion.pipelines.result_cache import ResultCache
+            self.result_cache = ResultCache(cfg.result_cache_dir, max_size_gb=cfg.result_cache_size_gb)
+        self.is_ready = False
+
+    def setup(self):
+        if self.is_ready:
+            return
+        self.pipeline.to(device=self.device)
+        self.pipeline.unet.enable_xformers_memory_efficient_attention()
+        if self.cfg.attention_backend is not None and self.cfg.attention_backend != 'autotune':
+            from mvdiffusion.models.attention_backends import set_attention_backend
+
+            set_attention_backend(self.pipeline.unet, self.cfg.attention_backend)
+        if self.cfg.attention_slice_size is not None:
+            self.pipeline.enable_attention_slicing(self.cfg.attention_slice_size)
+        self.prompt_embeddings = self.prompt_embeddings.to(device=self.device, dtype=weight_dtype)
+
+        # one denoising step on a blank input selects the attention / conv kernels before the first request
+        size = self.pipeline.unet.config.sample_size * self.pipeline.vae_scale_factor
+        self.generate(torch.ones(3, size, size), guidance_scale=3.0, seed=0, num_inference_steps=1, output_type='latent')
+        self.is_ready = True
+
+    def generate(self, img_in, guidance_scale, seed, output_type='pt', **pipe_kwargs):
+        num_views = self.pipeline.num_views
+        # `.to` would materialize an expanded tensor, so move the one input image first
+        imgs_in = img_in.to(device=self.device, dtype=weight_dtype)
+        # (2, Nv, 3, H, W) view of the one input image, the pipeline encodes it once
+        imgs_in = torch.stack([imgs_in]*2, dim=0).unsqueeze(1).expand(-1, num_views, -1, -1, -1)
+        generator = torch.Generator(device=self.pipeline.unet.device).manual_seed(int(seed))
+        pipe_kwargs = {**self.cfg.pipe_validation_kwargs, **pipe_kwargs}
+        return self.pipeline(
+            imgs_in, 
+            None, 
+            prompt_embeds=self.prompt_embeddings,
+            generator=generator, 
+            guidance_scale=guidance_scale, 
+            output_type=output_type, 
+            num_images_per_prompt=1, 
+            # return_elevation_focal=cfg.log_elevation_focal_length,
+            **pipe_kwargs
+        ).images
+
+    def result_key(self, img_in, guidance_scale, seed, steps, crop_size):
+        # the preprocessed input and every setting the generated views depend on
+        return self.result_cache.make_key(
+            img_in.numpy(), seed=int(seed), guidance_scale=float(guidance_scale), num_inference_steps=int(steps),
+            crop_size=int(crop_size), model=self.cfg.pretrained_model_name_or_path, revision=self.cfg.revision,
+        )
 
-    batch = prepare_data(single_image, crop_size, cfg)
 
-    pipeline.set_progress_bar_config(disable=True)
-    seed = int(seed)
-    generator = torch.Generator(device=pipeline.unet.device).manual_seed(seed)
+@gpu_task
+def setup_runtime(runtime):
+    runtime.setup()
 
 
-    imgs_in = torch.stack([batch['imgs_in']]*2, dim=0)
-    num_views = imgs_in.shape[1]
-    imgs_in = rearrange(imgs_in, "B Nv C H W -> (B Nv) C H W")# (B*Nv, 3, H, W)
-    
-    normal_prompt_embeddings, clr_prompt_embeddings = batch['normal_prompt_embeddings'], batch['color_prompt_embeddings'] 
-    prompt_embeddings = torch.stack([normal_prompt_embeddings, clr_prompt_embeddings], dim=0)
-    prompt_embeddings = rearrange(prompt_embeddings, "B Nv N C -> (B Nv) N C")
-    
-    
-    imgs_in = imgs_in.to(device=f'cuda:{_GPU_ID}', dtype=weight_dtype)
-    prompt_embeddings = prompt_embeddings.to(device=f'cuda:{_GPU_ID}', dtype=weight_dtype)
-    
-    out = pipeline(
-        imgs_in, 
-        None, 
-        prompt_embeds=prompt_embeddings,
-        generator=generator, 
-        guidance_scale=guidance_scale, 
-        output_type='pt', 
-        num_images_per_prompt=1, 
-        # return_elevation_focal=cfg.log_elevation_focal_length,
-        **cfg.pipe_validation_kwargs
-    ).images
+VIEWS = ['front', 'front_right', 'right', 'back', 'left', 'front_left']
+@gpu_task
+def run_pipeline(runtime, single_image, guidance_scale, steps, seed, crop_size, chk_group=None, session=None):
+    # a no-op once the runtime is set up at startup
+    runtime.setup()
+    cfg = runtime.cfg
+    # the scene and result key of the last run of this session (`gr.State`), for `process_3d`
+    session = {'scene': 'scene', 'key': None} if session is None else session
+    # pdb.set_trace()
+
+    write_image = chk_group is not None and "Write Results" in chk_group
+
+    batch = prepare_data(single_image, crop_size)
+    cur_dir = os.path.join(cfg.save_dir, f"cropsize-{int(crop_size)}-cfg{guidance_scale:.1f}")
+    num_views = 6
+    filenames = [f"normals_{view}_masked.png" for view in VIEWS] + [f"color_{view}_masked.png" for view in VIEWS]
+
+    result_files = None
+    if runtime.result_cache is not None:
+        session['key'] = runtime.result_key(batch['imgs_in'], guidance_scale, seed, steps, crop_size)
+        result_files = runtime.result_cache.get(session['key'])
+    if result_files is not None:
+        # generated before with the same input and settings
+        if write_image:
+            session['scene'] = 'scene'+datetime.now().strftime('@%Y%m%d-%H%M%S')
+            scene_dir = os.path.join(cur_dir, session['scene'])
+            os.makedirs(scene_dir, exist_ok=True)
+            for filename in filenames:
+                shutil.copyfile(result_files[filename], os.path.join(scene_dir, filename))
+        normals_pred = [np.array(Image.open(result_files[filename])) for filename in filenames[:num_views]]
+        images_pred = [np.array(Image.open(result_files[filename])) for filename in filenames[num_views:]]
+        return images_pred, normals_pred, session
+
+    out = runtime.generate(batch['imgs_in'], guidance_scale, seed, num_inference_steps=int(steps))
 
     bsz = out.shape[0] // 2
     normals_pred = out[:bsz]
     images_pred = out[bsz:]
-    num_views = 6
     if write_image:
-        VIEWS = ['front', 'front_right', 'right', 'back', 'left', 'front_left']
-        cur_dir = os.path.join(cfg.save_dir, f"cropsize-{int(crop_size)}-cfg{guidance_scale:.1f}")
-        
-        scene = 'scene'+datetime.now().strftime('@%Y%m%d-%H%M%S')
-        scene_dir = os.path.join(cur_dir, scene)
+        session['scene'] = 'scene'+datetime.now().strftime('@%Y%m%d-%H%M%S')
+        scene_dir = os.path.join(cur_dir, session['scene'])
         os.makedirs(scene_dir, exist_ok=True)
 
         for j in range(num_views):
@@ -229,14 +348,26 @@ def run_pipeline(pipeline, cfg, single_image, guidance_scale, steps, seed, crop_
 
     normals_pred = [save_image(normals_pred[i]) for i in range(bsz)]
     images_pred = [save_image(images_pred[i]) for i in range(bsz)]
+
+    if runtime.result_cache is not None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for filename, ndarr in zip(filenames, normals_pred + images_pred):
+                Image.fromarray(ndarr).save(os.path.join(tmp_dir, filename))
+            runtime.result_cache.put(session['key'], {filename: os.path.join(tmp_dir, filename) for filename in filenames})
     
     out = images_pred + normals_pred
-    return images_pred, normals_pred
+    return images_pred, normals_pred, session
 
 
-def process_3d(mode, data_dir, guidance_scale, crop_size):
+def process_3d(runtime, mode, data_dir, guidance_scale, crop_size, session):
     dir = None
-    global scene
+    scene, scene_key = session['scene'], session['key']
+
+    # the mesh of views reconstructed before
+    if runtime.result_cache is not None and scene_key is not None:
+        result_files = runtime.result_cache.get(scene_key)
+        if result_files is not None and 'mesh.obj' in result_files:
+            return result_files['mesh.obj']
 
     cur_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -250,6 +381,8 @@ def process_3d(mode, data_dir, guidance_scale, crop_size):
     print(obj_files)
     if obj_files:
         dir = obj_files[0]
+        if runtime.result_cache is not None and scene_key is not None:
+            dir = runtime.result_cache.put(scene_key, {'mesh.obj': dir}).get('mesh.obj', dir)
     return dir
 
 
@@ -286,10 +419,20 @@ class TestConfig:
     
     regress_elevation: bool
     regress_focal_length: bool
+
+    attention_backend: Optional[str] = None
+    attention_autotune_cache: Optional[str] = None
+    attention_slice_size: Optional[Any] = None
+    pipeline_snapshot: Optional[str] = None
+    num_shared_workers: int = 0
+    rgba_mask: str = 'rembg'
+    result_cache_dir: Optional[str] = None
+    result_cache_size_gb: float = 20.0
     
 
 
-def run_demo():
+def run_demo(sam_model_type='vit_h'):
+    import gradio as gr
     from utils.misc import load_config
     from omegaconf import OmegaConf
 
@@ -299,11 +442,12 @@ def run_demo():
     schema = OmegaConf.structured(TestConfig)
     cfg = OmegaConf.merge(schema, cfg)
 
-    pipeline = load_era3d_pipeline(cfg)
     torch.set_grad_enabled(False)
+    runtime = Era3DRuntime(cfg)
+    setup_runtime(runtime)
 
     
-    predictor = sam_init()
+    predictor = sam_init(sam_model_type)
 
 
     custom_theme = gr.themes.Soft(primary_hue="blue").set(
@@ -392,21 +536,28 @@ def run_demo():
         with gr.Row():
             view_gallery = gr.Gallery(label='Multiview Images')
             normal_gallery = gr.Gallery(label='Multiview Normals')
+        # per browser session: the scene and result cache key of the last generation
+        session = gr.State({'scene': 'scene', 'key': None})
+        # per browser session: the SAM embeddings of its last images
+        sam_embeddings = gr.State(OrderedDict())
             
         print('Launching...')
         run_btn.click(
-            fn=partial(preprocess, predictor), inputs=[input_image, input_processing], outputs=[processed_image_highres, processed_image], queue=True
+            fn=partial(preprocess, predictor), inputs=[input_image, input_processing, sam_embeddings],
+            outputs=[processed_image_highres, processed_image, sam_embeddings], queue=True
         ).success(
-            fn=partial(run_pipeline, pipeline, cfg),
-            inputs=[processed_image_highres, scale_slider, steps_slider, seed, crop_size, output_processing],
-            outputs=[view_gallery, normal_gallery],
+            fn=partial(run_pipeline, runtime),
+            inputs=[processed_image_highres, scale_slider, steps_slider, seed, crop_size, output_processing, session],
+            outputs=[view_gallery, normal_gallery, session],
         )
         # recon_btn.click(
-        #     process_3d, inputs=[mode, data_dir, scale_slider, crop_size], outputs=[obj_3d]
+        #     partial(process_3d, runtime), inputs=[mode, data_dir, scale_slider, crop_size, session], outputs=[obj_3d]
         # )
 
         demo.queue().launch(share=True, max_threads=80)
         
 
 if __name__ == '__main__':
+    import fire
+
     fire.Fire(run_demo)
\ No newline at end of file
@@ -0,0 +1,70 @@
+"""
+Import cost of the Era3D entry points, measured with `python -X importtime` in a fresh interpreter.
+
+    python benchmarks/importtime.py --top 15
+    python benchmarks/importtime.py --modules app --budget_ms 3000
+
+Reports the total cumulative import time of each module and its heaviest imports, recorded in `importtime.md`. With
+`--budget_ms` the script exits non-zero when a module takes longer, so it can guard against heavy imports creeping back
+to module level.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = ['test_mvdiffusion_unclip', 'app', 'mvdiffusion.data.single_image_dataset']
+
+
+def measure(module):
+    r"""
+    Returns `(total_us, entries)` where entries are `(self_us, cumulative_us, package)` of every import made while
+    importing `module`, nested imports indented by two more spaces per level.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f'importing {module} failed:\n{proc.stderr.strip().splitlines()[-1]}')
+    entries = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, package = line[len('import time:'):].split('|', 2)
+        entries.append((int(self_us), int(cumulative_us), package.rstrip()))
+    # an import is reported after everything it pulled in, so the tree of `module` ends with its own line
+    end = next(i for i, entry in enumerate(entries) if entry[2].strip() == module and not entry[2].startswith('  '))
+    start = end
+    while start > 0 and entries[start - 1][2].startswith('  '):
+        start -= 1
+    return entries[end][1], entries[start:end]
+
+
+def main(args):
+    over_budget = []
+    for module in args.modules:
+        total_us, entries = measure(module)
+        print(f'{module}: {total_us / 1000:.0f} ms')
+        # direct imports of `module` only, their cumulative time includes everything they pull in
+        top_level = [entry for entry in entries if not entry[2].startswith('    ')]
+        for _, cumulative_us, package in sorted(top_level, reverse=True, key=lambda entry: entry[1])[:args.top]:
+            print(f'    {cumulative_us / 1000:>8.1f} ms  {package.strip()}')
+        if args.budget_ms is not None and total_us / 1000 > args.budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f'over the {args.budget_ms} ms budget: {", ".join(over_budget)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=str, nargs='+', default=DEFAULT_MODULES)
+    parser.add_argument('--top', type=int, default=10, help='number of heaviest imports to list per module')
+    parser.add_argument('--budget_ms', type=float, default=None)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,136 @@
+"""
+Host memory of N inference workers with private weights vs. weights shared through `shared_pipeline`.
+
+    python benchmarks/shared_memory.py --config configs/test_unclip-512-6view.yaml --num_workers 4
+    # without the released weights: a random-weight model of the same architecture, narrower, on the cpu
+    python benchmarks/shared_memory.py --random_width 512 --num_workers 4 --device cpu
+
+Each worker builds its pipeline, runs one denoising step when a `--device` is given and reports RSS and PSS. RSS
+counts shared pages in every process that maps them, PSS splits them, so the per-worker PSS is what an extra worker
+really costs. Results are recorded in `shared_memory.md`.
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import torch
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf
+
+from mvdiffusion.pipelines.shared_pipeline import launch_shared_workers, memory_usage_mb, share_pipeline
+
+
+def load_pipeline(cfg, random_width, device):
+    # the fp16 pipeline and its prompt embeddings, on the cpu unless `device` is given
+    if random_width > 0:
+        from mvdiffusion.pipelines.inference_service import build_tiny_pipeline
+
+        pipeline, prompt_embeddings = build_tiny_pipeline(width=random_width)
+        pipeline.to(device=device, dtype=torch.float16)
+        normal, color = prompt_embeddings.to(torch.float16).chunk(2, dim=0)
+        return pipeline, {'normal': normal, 'color': color}
+
+    from mvdiffusion.pipelines.pipeline_loading import load_era3d_pipeline
+
+    return load_era3d_pipeline(cfg, device=device, root=ROOT)
+
+
+def run_step(pipeline, prompt_embeds, device):
+    if device is None:
+        return
+    num_views = pipeline.num_views
+    size = pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    imgs_in = torch.rand(2 * num_views, 3, size, size)
+    prompt_embeddings = torch.cat([prompt_embeds['normal'], prompt_embeds['color']], dim=0).to(device)
+    pipeline(imgs_in, None, prompt_embeds=prompt_embeddings, guidance_scale=3.0, num_inference_steps=1,
+             output_type='latent')
+
+
+def report(rank, mode, queue):
+    usage = memory_usage_mb()
+    queue.put((mode, rank, usage['rss'], usage['pss']))
+
+
+def shared_worker(rank, pipeline, prompt_embeds, device, queue):
+    run_step(pipeline, prompt_embeds, device)
+    report(rank, 'shared', queue)
+
+
+def runtime_worker(rank, queue):
+    # the interpreter, torch and the pipeline code without any weights, the floor of every worker
+    import mvdiffusion.pipelines.pipeline_mvdiffusion_unclip  # noqa: F401
+    import mvdiffusion.models.unet_mv2d_condition  # noqa: F401
+
+    report(rank, 'runtime', queue)
+
+
+def private_worker(rank, cfg, random_width, device, queue):
+    torch.set_grad_enabled(False)
+    pipeline, prompt_embeds = load_pipeline(cfg, random_width, device)
+    run_step(pipeline, prompt_embeds, device)
+    report(rank, 'private', queue)
+
+
+def main(args, cfg):
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+
+    processes = [ctx.Process(target=runtime_worker, args=(rank, queue)) for rank in range(args.num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    processes = [
+        ctx.Process(target=private_worker, args=(rank, cfg, args.random_width, args.device, queue))
+        for rank in range(args.num_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    pipeline, prompt_embeds = load_pipeline(cfg, args.random_width, None)
+    weights_mb = sum(
+        tensor.numel() * tensor.element_size()
+        for name in ('unet', 'vae', 'image_encoder', 'image_normalizer')
+        for tensor in getattr(pipeline, name).state_dict().values()
+    ) / 2**20
+    state = share_pipeline(pipeline, prompt_embeds)
+    del pipeline
+    parent = memory_usage_mb()
+    processes = launch_shared_workers(
+        state, shared_worker, args.num_workers, devices=[args.device] * args.num_workers,
+        args=(args.device, queue)
+    )
+    for process in processes:
+        process.join()
+
+    results = [queue.get() for _ in range(3 * args.num_workers)]
+    print(f"fp16 weights: {weights_mb:.0f}MB")
+    print(f"parent holding the shared weights: rss={parent['rss']:.0f}MB pss={parent['pss']:.0f}MB")
+    print(f"{'mode':<8} {'worker':>6} {'rss_mb':>8} {'pss_mb':>8}")
+    order = {'runtime': 0, 'private': 1, 'shared': 2}
+    for mode, rank, rss, pss in sorted(results, key=lambda result: (order[result[0]], result[1])):
+        print(f"{mode:<8} {rank:>6} {rss:>8.0f} {pss:>8.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/test_unclip-512-6view.yaml')
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--device', type=str, default=None,
+                        help='where the denoising step runs, e.g. cuda:0 or cpu; none skips it')
+    parser.add_argument('--random_width', type=int, default=0,
+                        help='> 0: a random-weight model with this UNet width instead of the configured weights')
+    args, extras = parser.parse_known_args()
+
+    from utils.misc import load_config
+    from test_mvdiffusion_unclip import TestConfig
+
+    os.chdir(ROOT)
+    cfg = OmegaConf.merge(OmegaConf.structured(TestConfig), load_config(args.config, cli_args=extras))
+    main(args, cfg)
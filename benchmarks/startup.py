@@ -0,0 +1,89 @@
+"""
+Cold-start benchmark for the Era3D pipeline and the 2D -> multiview UNet initialization.
+
+Every run happens in a fresh interpreter, so imports and allocations are paid each time like on a newly scaled
+worker (the OS page cache stays warm after the first run). Compare the eager and the meta-device (`low_cpu_mem_usage`) loading paths with
+
+    python benchmarks/startup.py --config configs/test_unclip-512-6view.yaml --target pipeline --repeats 3
+    python benchmarks/startup.py --config configs/test_unclip-512-6view.yaml --target unet_2d \
+        --pretrained_2d stabilityai/stable-diffusion-2-1-unclip
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_once(args):
+    sys.path.insert(0, ROOT)
+    start = time.perf_counter()
+    import torch
+    from utils.misc import load_config
+    from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
+    from mvdiffusion.models.unet_mv2d_condition import UNetMV2DConditionModel
+    imported = time.perf_counter()
+
+    cfg = load_config(args.config)
+    if args.target == 'pipeline':
+        module = StableUnCLIPImg2ImgPipeline.from_pretrained(
+            cfg.pretrained_model_name_or_path, torch_dtype=torch.float16, low_cpu_mem_usage=args.low_cpu_mem_usage
+        )
+    else:
+        module = UNetMV2DConditionModel.from_pretrained_2d(
+            args.pretrained_2d, subfolder="unet", low_cpu_mem_usage=args.low_cpu_mem_usage,
+            **cfg.unet_from_pretrained_kwargs
+        )
+    loaded = time.perf_counter()
+
+    if torch.cuda.is_available():
+        module.to('cuda:0')
+        torch.cuda.synchronize()
+    placed = time.perf_counter()
+
+    print(json.dumps({
+        'import_s': imported - start,
+        'load_s': loaded - imported,
+        'to_device_s': placed - loaded,
+        'total_s': placed - start,
+        # kilobytes on linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def main(args):
+    for low_cpu_mem_usage in [False, True]:
+        runs = []
+        for _ in range(args.repeats):
+            cmd = [
+                sys.executable, os.path.abspath(__file__), '--single',
+                '--config', args.config, '--target', args.target, '--pretrained_2d', args.pretrained_2d,
+            ]
+            if low_cpu_mem_usage:
+                cmd.append('--low_cpu_mem_usage')
+            out = subprocess.run(cmd, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+        summary = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"{args.target} low_cpu_mem_usage={low_cpu_mem_usage} (median of {args.repeats}): "
+              + ", ".join(f"{key}={value:.2f}" for key, value in summary.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='configs/test_unclip-512-6view.yaml')
+    parser.add_argument('--target', type=str, default='pipeline', choices=['pipeline', 'unet_2d'])
+    parser.add_argument('--pretrained_2d', type=str, default='stabilityai/stable-diffusion-2-1-unclip')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--low_cpu_mem_usage', action='store_true')
+    parser.add_argument('--single', action='store_true', help='run one measurement in this process')
+    args = parser.parse_args()
+
+    if args.single:
+        run_once(args)
+    else:
+        main(args)
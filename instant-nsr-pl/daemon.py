@@ -0,0 +1,349 @@
+"""
+Persistent reconstruction worker: keeps Python, Lightning and the CUDA extensions warm and fits one scene after the
+other, instead of paying the startup of `launch.py` (and its code snapshot) per scene.
+
+Jobs are JSON files in a local spool directory. A client drops them into `pending/` (written to a temporary name and
+renamed, so the daemon never sees half a job), a worker claims one by moving it to `running/` and writes the outcome,
+with the seconds spent in every stage, to `done/` or `failed/`:
+
+    python daemon.py serve --queue_dir jobs --gpus 0,1 --workers_per_gpu 1 --exp_dir exp
+    python daemon.py submit --queue_dir jobs --root_dir ../mv_res --scene A_bulldog_with_a_black_pirate_hat_rgba \
+        trainer.max_steps=2000
+    python daemon.py status --queue_dir jobs
+
+Every worker is a process bound to one GPU; `--workers_per_gpu 2` runs two scenes at a time on each GPU.
+A worker that dies is restarted, the job it was running is recorded in `failed/`.
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import time
+import traceback
+import uuid
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+QUEUE_STATES = ('pending', 'running', 'done', 'failed')
+# a daemon refreshes the files of its running jobs every poll; a job not refreshed for this long has lost its owner
+LEASE_S = 60.0
+
+
+def _write_json(path, payload):
+    tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+    with open(tmp_path, 'w') as f:
+        json.dump(payload, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def init_queue_dir(queue_dir):
+    for state in QUEUE_STATES:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+
+def submit_job(queue_dir, root_dir, scene, overrides=(), config=None, job_id=None):
+    r"""
+    Queues the reconstruction of `root_dir/scene`; `overrides` are dotlist entries on top of the config, like the
+    extra arguments of `launch.py`. Returns the job id.
+    """
+    init_queue_dir(queue_dir)
+    job_id = job_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{scene}-{uuid.uuid4().hex[:8]}"
+    job = {
+        'id': job_id,
+        'root_dir': os.path.abspath(root_dir),
+        'scene': scene,
+        'overrides': list(overrides),
+        'config': os.path.abspath(config) if config is not None else None,
+        'submitted': time.time(),
+    }
+    _write_json(os.path.join(queue_dir, 'pending', f'{job_id}.json'), job)
+    return job_id
+
+
+def claim_jobs(queue_dir):
+    # the oldest pending jobs first, the ids of `submit_job` start with the submission time; the rename makes a
+    # claim exclusive between daemons sharing a queue. The claimed file keeps a name other daemons ignore until the
+    # job, marked with its owner and a fresh lease, replaces it in `running/` in one step
+    pending_dir = os.path.join(queue_dir, 'pending')
+    for filename in sorted(os.listdir(pending_dir)):
+        if not filename.endswith('.json'):
+            continue
+        claim_path = os.path.join(queue_dir, 'running', f'{filename}.claim-{uuid.uuid4().hex}')
+        try:
+            os.rename(os.path.join(pending_dir, filename), claim_path)
+        except FileNotFoundError:
+            continue
+        # the rename keeps the submission mtime, the lease of a claim starts now
+        os.utime(claim_path)
+        with open(claim_path) as f:
+            job = json.load(f)
+        # the owner lets other daemons tell a live job from one left behind by a dead daemon
+        job['owner'] = {'host': socket.gethostname(), 'pid': os.getpid()}
+        _write_json(claim_path, job)
+        os.replace(claim_path, os.path.join(queue_dir, 'running', filename))
+        yield job
+
+
+def _owner_alive(owner, mtime, lease_s):
+    if owner is not None and owner.get('host') == socket.gethostname():
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    # another host (or a claim not yet marked): alive while its owner keeps renewing the lease
+    return time.time() - mtime < lease_s
+
+
+def requeue_orphaned_jobs(queue_dir, lease_s=LEASE_S):
+    r"""
+    Moves the running jobs whose daemon is gone back to `pending/`: on this host, the owner process has exited; on
+    another host, the job file has not been refreshed for `lease_s` seconds. Jobs of live daemons stay where they are,
+    so do claims younger than `lease_s`, which their daemon is still marking.
+    """
+    running_dir = os.path.join(queue_dir, 'running')
+    for filename in os.listdir(running_dir):
+        if '.tmp-' in filename:
+            continue
+        job_filename = filename.split('.claim-')[0]
+        if not job_filename.endswith('.json'):
+            continue
+        running_path = os.path.join(running_dir, filename)
+        try:
+            mtime = os.path.getmtime(running_path)
+            owner = None
+            if job_filename == filename:
+                with open(running_path) as f:
+                    owner = json.load(f).get('owner')
+        except (FileNotFoundError, json.JSONDecodeError):
+            # finished or being rewritten by its owner
+            continue
+        if _owner_alive(owner, mtime, lease_s):
+            continue
+        try:
+            os.rename(running_path, os.path.join(queue_dir, 'pending', job_filename))
+        except FileNotFoundError:
+            continue
+        print(f"[requeued] {job_filename[:-len('.json')]}, its daemon is gone")
+
+
+def run_job(job, exp_dir, config=None):
+    from reconstruct import reconstruct_mesh
+
+    timings = {}
+    start = time.perf_counter()
+    save_dir = os.path.join(exp_dir, job['id'])
+    mesh = reconstruct_mesh(
+        scene=job['scene'],
+        config_path=job.get('config') or config or os.path.join(ROOT, 'configs/neuralangelo-ortho-wmask.yaml'),
+        overrides=[f"dataset.root_dir={job['root_dir']}"] + list(job.get('overrides', [])),
+        gpu=0,
+        save_dir=save_dir,
+        timings=timings,
+    )
+    mesh_path = os.path.join(save_dir, f"{job['scene']}.obj")
+    mesh.export(mesh_path)
+    timings['total'] = time.perf_counter() - start
+    return {'mesh': mesh_path, 'save_dir': save_dir, 'timings': timings}
+
+
+def _worker_main(rank, gpu, job_queue, result_queue, exp_dir, config):
+    # one GPU per worker, visible as cuda:0 (the ortho datasets place their tensors on the local rank)
+    os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu)
+    start = time.perf_counter()
+    # paid once per worker instead of once per scene
+    import pytorch_lightning  # noqa: F401
+    import datasets  # noqa: F401
+    import systems  # noqa: F401
+    import reconstruct  # noqa: F401
+    warmup_s = time.perf_counter() - start
+    print(f"[worker {rank} gpu {gpu}] ready after {warmup_s:.1f}s")
+    result_queue.put((rank, None))
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            return
+        # the daemon knows the job from handing it over, this tells it when the worker got to it
+        result_queue.put((rank, job['id']))
+        started = time.time()
+        try:
+            result = {**job, **run_job(job, exp_dir, config), 'status': 'done'}
+        except Exception:
+            result = {**job, 'status': 'failed', 'error': traceback.format_exc()}
+        result.update({'worker': rank, 'gpu': gpu, 'started': started, 'finished': time.time(),
+                       'queue_wait_s': started - job['submitted']})
+        result_queue.put(result)
+
+
+def _record_result(queue_dir, result):
+    state = result['status']
+    _write_json(os.path.join(queue_dir, state, f"{result['id']}.json"), result)
+    try:
+        os.remove(os.path.join(queue_dir, 'running', f"{result['id']}.json"))
+    except FileNotFoundError:
+        # requeued by another daemon that took this one for dead
+        pass
+    timings = ', '.join(f'{k} {v:.1f}s' for k, v in result.get('timings', {}).items())
+    print(f"[{state}] {result['id']} on gpu {result['gpu']}: queued {result.get('queue_wait_s', 0.0):.1f}s, {timings}")
+
+
+def serve(queue_dir, gpus, workers_per_gpu=1, exp_dir='exp', config=None, poll_s=1.0, lease_s=LEASE_S):
+    import multiprocessing as mp
+
+    init_queue_dir(queue_dir)
+    # jobs left running by a daemon that died are queued again, those of live daemons sharing the queue are not
+    requeue_orphaned_jobs(queue_dir, lease_s)
+
+    ctx = mp.get_context('spawn')
+    worker_gpus = [gpu for gpu in gpus for _ in range(workers_per_gpu)]
+    result_queue = ctx.Queue()
+
+    def spawn(rank):
+        # a queue per worker: the daemon knows which job every worker holds, and a worker that dies takes no other
+        # worker's queue with it
+        job_queue = ctx.Queue(maxsize=1)
+        worker = ctx.Process(target=_worker_main, args=(rank, worker_gpus[rank], job_queue, result_queue,
+                                                        os.path.abspath(exp_dir), config))
+        worker.start()
+        return worker, job_queue
+
+    workers = [spawn(rank) for rank in range(len(worker_gpus))]
+    ready = set()
+    # the job handed to each worker, by rank; their files in `running/` are refreshed to hold the lease
+    assigned = {}
+
+    def collect():
+        while True:
+            try:
+                message = result_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if isinstance(message, tuple):
+                    # `(rank, None)` once a worker is ready, `(rank, job_id)` when it starts a job
+                    rank, job_id = message
+                    if job_id is None:
+                        ready.add(rank)
+                    elif assigned.get(rank, {}).get('id') == job_id:
+                        assigned[rank]['started'] = time.time()
+                    continue
+                if assigned.get(message['worker'], {}).get('id') == message['id']:
+                    del assigned[message['worker']]
+                _record_result(queue_dir, message)
+            except Exception:
+                # keep recording the next results
+                traceback.print_exc()
+
+    def replace_dead_workers():
+        dead = [rank for rank, (worker, _) in enumerate(workers) if not worker.is_alive()]
+        # whatever the dead workers sent before exiting is in the queue by now
+        collect()
+        for rank in dead:
+            worker, _ = workers[rank]
+            if rank not in ready:
+                # it would die the same way again, no use restarting it
+                raise RuntimeError(f'worker {rank} exited with code {worker.exitcode} before it was ready')
+            ready.discard(rank)
+            job = assigned.pop(rank, None)
+            if job is not None and 'started' not in job:
+                # never taken off the worker's queue, another worker can run it
+                try:
+                    os.rename(os.path.join(queue_dir, 'running', f"{job['id']}.json"),
+                              os.path.join(queue_dir, 'pending', f"{job['id']}.json"))
+                except FileNotFoundError:
+                    pass
+            elif job is not None:
+                # a crash like an out of memory kill would likely repeat, the job is failed rather than requeued
+                now = time.time()
+                _record_result(queue_dir, {
+                    **job, 'status': 'failed', 'worker': rank, 'gpu': worker_gpus[rank],
+                    'started': job.get('started', now), 'finished': now,
+                    'queue_wait_s': job.get('started', now) - job['submitted'],
+                    'error': f'worker {rank} exited with code {worker.exitcode}',
+                })
+            print(f"[worker {rank} gpu {worker_gpus[rank]}] exited with code {worker.exitcode}, restarting")
+            workers[rank] = spawn(rank)
+
+    print(f"watching {os.path.join(queue_dir, 'pending')} with {len(workers)} workers")
+    last_requeue = time.time()
+    try:
+        while True:
+            replace_dead_workers()
+            for job in list(assigned.values()):
+                try:
+                    os.utime(os.path.join(queue_dir, 'running', f"{job['id']}.json"))
+                except FileNotFoundError:
+                    pass
+            if time.time() - last_requeue > lease_s:
+                requeue_orphaned_jobs(queue_dir, lease_s)
+                last_requeue = time.time()
+            # a job is only claimed once a worker can take it, the rest stays in `pending/` for other daemons
+            idle = [rank for rank in range(len(workers)) if rank not in assigned]
+            job = next(claim_jobs(queue_dir), None) if idle else None
+            if job is None:
+                time.sleep(poll_s)
+                continue
+            assigned[idle[0]] = job
+            workers[idle[0]][1].put(job)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for _, job_queue in workers:
+            try:
+                job_queue.put(None, timeout=1)
+            except queue.Full:
+                pass
+        for worker, _ in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        collect()
+
+
+def status(queue_dir):
+    init_queue_dir(queue_dir)
+    for state in QUEUE_STATES:
+        jobs = sorted(f[:-len('.json')] for f in os.listdir(os.path.join(queue_dir, state)) if f.endswith('.json'))
+        print(f"{state}: {len(jobs)}")
+        if state in ('done', 'failed'):
+            jobs = jobs[-10:]
+        for job_id in jobs:
+            line = f"  {job_id}"
+            if state == 'done':
+                with open(os.path.join(queue_dir, state, f'{job_id}.json')) as f:
+                    line += f"  {json.load(f)['timings']['total']:.1f}s"
+            print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='run the workers')
+    serve_parser.add_argument('--queue_dir', type=str, required=True)
+    serve_parser.add_argument('--gpus', type=str, default='0', help='comma separated GPU ids')
+    serve_parser.add_argument('--workers_per_gpu', type=int, default=1)
+    serve_parser.add_argument('--exp_dir', type=str, default='./exp')
+    serve_parser.add_argument('--config', type=str, default=None, help='default config of jobs that set none')
+    serve_parser.add_argument('--poll_s', type=float, default=1.0)
+    serve_parser.add_argument('--lease_s', type=float, default=LEASE_S,
+                              help='seconds after which a running job of a daemon on another host counts as orphaned')
+    submit_parser = subparsers.add_parser('submit', help='queue a scene')
+    submit_parser.add_argument('--queue_dir', type=str, required=True)
+    submit_parser.add_argument('--root_dir', type=str, required=True)
+    submit_parser.add_argument('--scene', type=str, required=True)
+    submit_parser.add_argument('--config', type=str, default=None)
+    status_parser = subparsers.add_parser('status', help='list the jobs per state')
+    status_parser.add_argument('--queue_dir', type=str, required=True)
+    args, extras = parser.parse_known_args()
+
+    if args.command == 'serve':
+        serve(args.queue_dir, [int(gpu) for gpu in args.gpus.split(',')], args.workers_per_gpu, args.exp_dir,
+              args.config, args.poll_s, args.lease_s)
+    elif args.command == 'submit':
+        print(submit_job(args.queue_dir, args.root_dir, args.scene, overrides=extras, config=args.config))
+    else:
+        status(args.queue_dir)
@@ -11,6 +11,7 @@ import torchvision.transforms.functional as TF
 import pytorch_lightning as pl
 
 import datasets
+from datasets.utils import in_process_loader
 from models.ray_utils import get_ray_directions
 from utils.misc import get_rank
 
@@ -113,14 +114,7 @@ class BlenderDataModule(pl.LightningDataModule):
         pass
     
     def general_loader(self, dataset, batch_size):
-        sampler = None
-        return DataLoader(
-            dataset, 
-            num_workers=os.cpu_count(), 
-            batch_size=batch_size,
-            pin_memory=True,
-            sampler=sampler
-        )
+        return in_process_loader(dataset, batch_size)
     
     def train_dataloader(self):
         return self.general_loader(self.train_dataset, batch_size=1)
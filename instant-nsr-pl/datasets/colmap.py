@@ -11,6 +11,7 @@ import torchvision.transforms.functional as TF
 import pytorch_lightning as pl
 
 import datasets
+from datasets.utils import in_process_loader
 from datasets.colmap_utils import \
     read_cameras_binary, read_images_binary, read_points3d_binary
 from models.ray_utils import get_ray_directions
@@ -310,14 +311,7 @@ class ColmapDataModule(pl.LightningDataModule):
         pass
     
     def general_loader(self, dataset, batch_size):
-        sampler = None
-        return DataLoader(
-            dataset, 
-            num_workers=os.cpu_count(), 
-            batch_size=batch_size,
-            pin_memory=True,
-            sampler=sampler
-        )
+        return in_process_loader(dataset, batch_size)
     
     def train_dataloader(self):
         return self.general_loader(self.train_dataset, batch_size=1)
@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import math
 import numpy as np
@@ -11,14 +12,20 @@ from torch.utils.data import Dataset, DataLoader, IterableDataset
 import torchvision.transforms.functional as TF
 
 import pytorch_lightning as pl
+from omegaconf import OmegaConf
 
 import datasets
-from models.ray_utils import get_ortho_ray_directions_origins, get_ortho_rays, get_ray_directions
+from datasets.utils import in_process_loader
+from models.ray_utils import get_ortho_ray_directions_origins, get_ortho_ray_tables, get_ortho_rays, get_ray_directions
 from utils.misc import get_rank
 
 from glob import glob
 import PIL.Image
-from rembg import remove
+
+# the batched normal transforms are shared with the Era3D datasets, appended last so the local packages win
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from mvdiffusion.data.background_removal import remove_background_batch
+from mvdiffusion.data.normal_transforms import normal_to_img, transform_normals
 
 
 def camNormal2worldNormal(rot_c2w, camNormal):
@@ -86,12 +93,35 @@ def inv_RT(RT):
     return RT_inv[:3, :]
 
 
+def load_rgba_views(filepaths, imSize):
+    # RGB predictions have their background removed, all of them in one rembg call
+    images = [PIL.Image.open(filepath) for filepath in filepaths]
+    rgb_ids = [i for i, image in enumerate(images) if image.mode == 'RGB']
+    if len(rgb_ids) > 0:
+        for i, image in zip(rgb_ids, remove_background_batch([images[i] for i in rgb_ids])):
+            images[i] = image
+    return [image.resize(imSize) for image in images]
+
+
+def rgba_views_from_arrays(normals, colors, imSize, masks=None):
+    # in-memory predictions, (Nv, H, W, 3) uint8 normals and colors: no PNG round trip, and with (Nv, H, W) uint8
+    # `masks` (e.g. from `derive_view_masks`) no rembg either
+    views = [PIL.Image.fromarray(np.asarray(image)) for image in list(normals) + list(colors)]
+    if masks is None:
+        views = remove_background_batch(views)
+    else:
+        masks = [PIL.Image.fromarray(np.asarray(mask)) for mask in masks]
+        for i, view in enumerate(views):
+            view.putalpha(masks[i % len(masks)])
+    return [view.resize(imSize) for view in views]
+
+
 def load_a_prediction(root_dir, test_object, imSize, view_types, load_color=False, cam_pose_dir=None,
-                         normal_system='front', erode_mask=True, camera_type='ortho', cam_params=None):
+                         normal_system='front', erode_mask=True, camera_type='ortho', cam_params=None, prediction=None):
 
     all_images = []
     all_normals = []
-    all_normals_world = []
+    all_rot_c2w = []
     all_masks = []
     all_color_masks = []
     all_poses = []
@@ -101,24 +131,19 @@ def load_a_prediction(root_dir, test_object, imSize, view_types, load_color=Fals
 
     RT_front = np.loadtxt(glob(os.path.join(cam_pose_dir, '*_%s_RT.txt'%( 'front')))[0])   # world2cam matrix
     RT_front_cv = RT_opengl2opencv(RT_front)   # convert normal from opengl to opencv
+    if prediction is None:
+        normal_filepaths = [os.path.join(root_dir, test_object, 'normals_%s_masked.png'%( view)) for view in view_types]
+        rgba_views = load_rgba_views(
+            normal_filepaths + [filepath.replace("normals", "color") for filepath in normal_filepaths], imSize
+        )
+    else:
+        rgba_views = rgba_views_from_arrays(imSize=imSize, **prediction)
     for idx, view in enumerate(view_types):
-        print(os.path.join(root_dir,test_object))
         
-        normal_filepath = os.path.join(root_dir, test_object, 'normals_%s_masked.png'%( view))
-        normal_rgba = PIL.Image.open(normal_filepath)
-        if normal_rgba.mode == 'RGB':
-            normal_rgba = remove(normal_rgba).resize(imSize)
-        else:
-            normal_rgba = normal_rgba.resize(imSize)
-        normal = np.array(normal_rgba)
+        normal = np.array(rgba_views[idx])
         normal, mask = normal[:, :, :3], normal[:, :, 3]
 
-        image_rgba = PIL.Image.open(normal_filepath.replace("normals", "color"))
-        if image_rgba.mode == 'RGB':
-            image_rgba = remove(image_rgba).resize(imSize)
-        else:
-            image_rgba = image_rgba.resize(imSize)
-        image_rgba =np.array(image_rgba)
+        image_rgba =np.array(rgba_views[len(view_types) + idx])
         image, color_mask = image_rgba[:, :, :3], image_rgba[:, :, 3]
         
         invalid_color_mask = color_mask < 255*0.5
@@ -151,12 +176,11 @@ def load_a_prediction(root_dir, test_object, imSize, view_types, load_color=Fals
 
         if normal_system == 'front':
             print("the loaded normals are defined in the system of front view")
-            normal_world = camNormal2worldNormal(inv_RT(RT_front_cv)[:3, :3], normal_cam_cv)
+            all_rot_c2w.append(inv_RT(RT_front_cv)[:3, :3])
         elif normal_system == 'self':
             print("the loaded normals are in their independent camera systems")
-            normal_world = camNormal2worldNormal(inv_RT(RT_cv)[:3, :3], normal_cam_cv)
+            all_rot_c2w.append(inv_RT(RT_cv)[:3, :3])
         all_normals.append(normal_cam_cv)
-        all_normals_world.append(normal_world)
 
         if camera_type == 'ortho':
             origins, dirs = get_ortho_ray_directions_origins(W=imSize[0], H=imSize[1])
@@ -168,18 +192,40 @@ def load_a_prediction(root_dir, test_object, imSize, view_types, load_color=Fals
             raise Exception("not support camera type")
         ray_origins.append(origins)
         directions.append(dirs)
-        
-        
-        if not load_color:
-            all_images = [normal2img(x) for x in all_normals_world]
+
+    # camera -> world for all views in one float32 einsum
+    all_normals_world = transform_normals(np.stack(all_normals), np.stack(all_rot_c2w))
+    if not load_color:
+        all_images = normal_to_img(all_normals_world).numpy()
+    all_normals_world = all_normals_world.numpy()
 
 
     return np.stack(all_images), np.stack(all_masks), np.stack(all_normals), \
-        np.stack(all_normals_world), np.stack(all_poses), np.stack(all_w2cs), np.stack(ray_origins), np.stack(directions), np.stack(all_color_masks)
+        all_normals_world, np.stack(all_poses), np.stack(all_w2cs), np.stack(ray_origins), np.stack(directions), np.stack(all_color_masks)
+
+
+def pack_pixel_records(images, normals, fg_masks, rgb_masks):
+    # one 16-byte float16 record per pixel: color in [0, 1], world normal, the foreground and color masks as bits 0
+    # and 1, padding; a training step fetches everything about its rays with one gather
+    records = np.zeros((*fg_masks.shape, 8), dtype=np.float16)
+    records[..., 0:3] = images
+    records[..., 3:6] = normals
+    records[..., 6] = (fg_masks > 0).astype(np.uint8) | ((rgb_masks > 0).astype(np.uint8) << 1)
+    return torch.from_numpy(records)
+
+
+def unpack_pixel_records(records):
+    bits = records[..., 6].int()
+    return {
+        'rgb': records[..., 0:3].float(),
+        'normal': records[..., 3:6].float(),
+        'fg_mask': (bits & 1).float(),
+        'rgb_mask': (bits >> 1).float(),
+    }
 
 
 class OrthoDatasetBase():
-    def setup(self, config, split):
+    def setup(self, config, split, prediction=None):
         self.config = config
         self.split = split
         self.rank = get_rank()
@@ -197,11 +243,11 @@ class OrthoDatasetBase():
         
         self.view_types = ['front', 'front_right', 'right', 'back', 'left', 'front_left']
 
+        # one weight per view, looked up by the view index of a ray
         self.view_weights = torch.from_numpy(np.array(self.config.view_weights)).float().to(self.rank).view(-1)
-        self.view_weights = self.view_weights.view(-1,1,1).repeat(1, self.h, self.w)
 
         if self.config.cam_pose_dir is None:
-            self.cam_pose_dir = "./datasets/fixed_poses"
+            self.cam_pose_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixed_poses")
             # self.cam_pose_dir = "./datasets/fixed_poses_dreamdata"
         else:
             self.cam_pose_dir = self.config.cam_pose_dir
@@ -210,27 +256,93 @@ class OrthoDatasetBase():
             self.pose_all_np, self.w2c_all_np, self.origins_np, self.directions_np, self.rgb_masks_np = load_a_prediction(
                 self.data_dir, self.object_name, self.imSize, self.view_types,
                 self.load_color, self.cam_pose_dir, normal_system='front', 
-                camera_type=self.camera_type, cam_params=self.camera_params)
+                camera_type=self.camera_type, cam_params=self.camera_params, prediction=prediction)
 
         self.has_mask = True
         self.apply_mask = self.config.apply_mask
 
-        self.all_c2w = torch.from_numpy(self.pose_all_np)
-        self.all_images = torch.from_numpy(self.images_np) / 255.
-        self.all_fg_masks = torch.from_numpy(self.masks_np)
-        self.all_rgb_masks = torch.from_numpy(self.rgb_masks_np)
-        self.all_normals_world = torch.from_numpy(self.normals_world_np)
-        self.origins = torch.from_numpy(self.origins_np)
-        self.directions = torch.from_numpy(self.directions_np)
-
-        self.directions = self.directions.float().to(self.rank)
-        self.origins = self.origins.float().to(self.rank)
-        self.all_rgb_masks = self.all_rgb_masks.float().to(self.rank)
-        self.all_c2w, self.all_images, self.all_fg_masks, self.all_normals_world = \
-            self.all_c2w.float().to(self.rank), \
-            self.all_images.float().to(self.rank), \
-            self.all_fg_masks.float().to(self.rank), \
-            self.all_normals_world.float().to(self.rank)
+        self.num_views = len(self.pose_all_np)
+        self.all_c2w = torch.from_numpy(self.pose_all_np).float().to(self.rank)
+        # all views share the camera-space ray origins and directions, (H, W, 3)
+        self.origins = torch.from_numpy(self.origins_np[0]).float().to(self.rank)
+        self.directions = torch.from_numpy(self.directions_np[0]).float().to(self.rank)
+        # fixed orthographic views: the rays of any pixel follow from four vectors per view
+        self.ray_tables = get_ortho_ray_tables(self.all_c2w) if self.camera_type == 'ortho' else None
+        self.pixel_records = pack_pixel_records(
+            self.images_np / 255., self.normals_world_np, self.masks_np, self.rgb_masks_np
+        ).to(self.rank)
+        self.pixel_tables = None
+
+    def fg_masks(self):
+        # (N, H, W) bool
+        return (self.pixel_records[..., 6].int() & 1) > 0
+
+    def build_pixel_tables(self, boundary_width):
+        # flat (view, y, x) indices of the interior, the band of `boundary_width` pixels around the silhouette and the
+        # background of every view
+        masks = self.fg_masks().float()[:, None]
+        kernel_size = 2 * boundary_width + 1
+        dilated = F.max_pool2d(masks, kernel_size, stride=1, padding=boundary_width)[:, 0].view(-1) > 0
+        eroded = F.max_pool2d(1 - masks, kernel_size, stride=1, padding=boundary_width)[:, 0].view(-1) == 0
+        self.pixel_tables = [
+            torch.nonzero(eroded).squeeze(-1),
+            torch.nonzero(dilated & ~eroded).squeeze(-1),
+            torch.nonzero(~dilated).squeeze(-1),
+        ]
+
+    @torch.no_grad()
+    def visual_hull(self, resolution, radius, margin=0):
+        r"""
+        `(R, R, R)` bool grid over `[-radius, radius]^3`, indexed `[x, y, z]` like the nerfacc occupancy grid, of the
+        cells whose center projects into the foreground of every view. The silhouettes are grown by the footprint of
+        a cell plus `margin` pixels, so the hull keeps every cell the surface passes through.
+        """
+        cell = 2 * radius / resolution
+        grow = math.ceil(cell * math.sqrt(3) / 2 * max(self.w, self.h) / 2) + margin
+        masks = F.max_pool2d(self.fg_masks().float()[:, None], 2 * grow + 1, stride=1, padding=grow)[:, 0] > 0
+
+        centers = (torch.arange(resolution, dtype=torch.float32, device=masks.device) + 0.5) * cell - radius
+        points = torch.stack(torch.meshgrid(centers, centers, centers, indexing='ij'), dim=-1).view(-1, 3)
+        w2c = torch.from_numpy(self.w2c_all_np).float().to(masks.device)
+        hull = torch.ones(len(points), dtype=torch.bool, device=masks.device)
+        for mask, view_w2c in zip(masks, w2c):
+            # orthographic cameras: the camera x and y of a point are its pixel coordinates in [-1, 1]
+            points_cam = points @ view_w2c[:3, :3].T + view_w2c[:3, 3]
+            u = ((points_cam[:, 0] / 2 + 0.5) * self.w).floor().long()
+            v = ((points_cam[:, 1] / 2 + 0.5) * self.h).floor().long()
+            inside = (u >= 0) & (u < self.w) & (v >= 0) & (v < self.h)
+            hull &= inside & mask[v.clamp(0, self.h - 1), u.clamp(0, self.w - 1)]
+        return hull.view(resolution, resolution, resolution)
+
+    def sample_pixels(self, num_rays, config):
+        r"""
+        Draws `num_rays` pixels of all views, the fractions `config.foreground`, `config.boundary` and
+        `config.background` of them from the respective pixel table. Returns the view indices, `y`, `x` and the
+        weight of every ray, the ratio of its probability under uniform sampling to its probability here: weighted
+        means of per-ray losses estimate the means under uniform sampling. Losses that drop the largest errors,
+        like the ranking losses, are only approximated.
+        """
+        if self.pixel_tables is None:
+            self.build_pixel_tables(config.boundary_width)
+        fractions = torch.tensor([config.foreground, config.boundary, config.background], dtype=torch.float32)
+        sizes = torch.tensor([len(table) for table in self.pixel_tables], dtype=torch.float32)
+        # an empty table, e.g. no background in a view-filling object, gives its rays to the others
+        fractions = fractions * (sizes > 0)
+        counts = (fractions / fractions.sum() * num_rays).floor().long()
+        counts[fractions.argmax()] += num_rays - counts.sum()
+
+        device = self.pixel_records.device
+        pixels, weights = [], []
+        for table, size, count in zip(self.pixel_tables, sizes, counts.tolist()):
+            if count == 0:
+                continue
+            pixels.append(table[torch.randint(0, len(table), size=(count,), device=device)])
+            weights.append(torch.full((count,), (size / sizes.sum() * num_rays / count).item(), device=device))
+        pixels = torch.cat(pixels)
+        index = pixels // (self.h * self.w)
+        y = pixels % (self.h * self.w) // self.w
+        x = pixels % self.w
+        return index, y, x, torch.cat(weights)
 
 def load_a_validate_prediction(root_dir, test_object, imSize, cam_pose_dir=None,
                           camera_type='ortho', cam_params=None, view_num=60):
@@ -281,7 +393,7 @@ class OrthoDatasetBaseTest():
         self.camera_params = self.config.camera_params  # [fx, fy, cx, cy]
   
         if self.config.cam_pose_dir is None:
-            self.cam_pose_dir = "./datasets/val_poses"
+            self.cam_pose_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "val_poses")
         else:
             self.cam_pose_dir = self.config.cam_pose_dir
             
@@ -292,22 +404,20 @@ class OrthoDatasetBaseTest():
         self.has_mask = True
         self.apply_mask = self.config.apply_mask
 
-        self.all_c2w = torch.from_numpy(self.pose_all_np)
-        self.origins = torch.from_numpy(self.origins_np)
-        self.directions = torch.from_numpy(self.directions_np)
-
-        self.directions = self.directions.float().to(self.rank)
-        self.origins = self.origins.float().to(self.rank)
-        self.all_c2w = self.all_c2w.float().to(self.rank)
+        self.all_c2w = torch.from_numpy(self.pose_all_np).float().to(self.rank)
+        # all views share the camera-space ray origins and directions, (H, W, 3)
+        self.origins = torch.from_numpy(self.origins_np[0]).float().to(self.rank)
+        self.directions = torch.from_numpy(self.directions_np[0]).float().to(self.rank)
+        self.ray_tables = get_ortho_ray_tables(self.all_c2w) if self.camera_type == 'ortho' else None
         
 
 
 class OrthoDataset(Dataset, OrthoDatasetBase):
-    def __init__(self, config, split):
-        self.setup(config, split)
+    def __init__(self, config, split, prediction=None):
+        self.setup(config, split, prediction)
 
     def __len__(self):
-        return len(self.all_images)
+        return self.num_views
     
     def __getitem__(self, index):
         return {
@@ -316,7 +426,8 @@ class OrthoDataset(Dataset, OrthoDatasetBase):
 
 
 class OrthoTestDataset(Dataset, OrthoDatasetBaseTest):
-    def __init__(self, config, split):
+    def __init__(self, config, split, prediction=None):
+        # the test views are rendered from the fitted model, no prediction is read
         self.setup(config, split)
 
     def __len__(self):
@@ -328,8 +439,8 @@ class OrthoTestDataset(Dataset, OrthoDatasetBaseTest):
         }
 
 class OrthoIterableDataset(IterableDataset, OrthoDatasetBase):
-    def __init__(self, config, split):
-        self.setup(config, split)
+    def __init__(self, config, split, prediction=None):
+        self.setup(config, split, prediction)
 
     def __iter__(self):
         while True:
@@ -338,32 +449,27 @@ class OrthoIterableDataset(IterableDataset, OrthoDatasetBase):
 
 @datasets.register('ortho')
 class OrthoDataModule(pl.LightningDataModule):
-    def __init__(self, config):
+    def __init__(self, config, prediction=None):
         super().__init__()
         self.config = config
+        # {'normals', 'colors', 'masks'} arrays, see `rgba_views_from_arrays`; replaces reading `root_dir/scene`
+        self.prediction = prediction
     
     def setup(self, stage=None):
         if stage in [None, 'fit']:
-            self.train_dataset = OrthoIterableDataset(self.config, 'train')
+            self.train_dataset = OrthoIterableDataset(self.config, 'train', self.prediction)
         if stage in [None, 'fit', 'validate']:
-            self.val_dataset = OrthoDataset(self.config, self.config.get('val_split', 'train'))
+            self.val_dataset = OrthoDataset(self.config, self.config.get('val_split', 'train'), self.prediction)
         if stage in [None, 'test']:
             self.test_dataset = OrthoTestDataset(self.config, self.config.get('test_split', 'test'))
         if stage in [None, 'predict']:
-            self.predict_dataset = OrthoDataset(self.config, 'train')    
+            self.predict_dataset = OrthoDataset(self.config, 'train', self.prediction)    
 
     def prepare_data(self):
         pass
     
     def general_loader(self, dataset, batch_size):
-        sampler = None
-        return DataLoader(
-            dataset, 
-            num_workers=os.cpu_count(), 
-            batch_size=batch_size,
-            pin_memory=True,
-            sampler=sampler
-        )
+        return in_process_loader(dataset, batch_size)
     
     def train_dataloader(self):
         return self.general_loader(self.train_dataset, batch_size=1)
@@ -376,3 +482,57 @@ class OrthoDataModule(pl.LightningDataModule):
 
     def predict_dataloader(self):
         return self.general_loader(self.predict_dataset, batch_size=1)       
+
+
+class OrthoMultiDataset(Dataset):
+    def __init__(self, configs, split, predictions):
+        self.scenes = [OrthoDataset(config, split, prediction) for config, prediction in zip(configs, predictions)]
+
+    def __len__(self):
+        return len(self.scenes[0])
+
+    def __getitem__(self, index):
+        return {
+            'index': index
+        }
+
+
+class OrthoMultiTestDataset(Dataset):
+    def __init__(self, configs, split):
+        self.scenes = [OrthoTestDataset(config, split) for config in configs]
+
+    def __len__(self):
+        return len(self.scenes[0])
+
+    def __getitem__(self, index):
+        return {
+            'index': index
+        }
+
+
+class OrthoMultiIterableDataset(IterableDataset):
+    def __init__(self, configs, split, predictions):
+        self.scenes = [OrthoIterableDataset(config, split, prediction) for config, prediction in zip(configs, predictions)]
+
+    def __iter__(self):
+        while True:
+            yield {}
+
+
+@datasets.register('ortho-multi')
+class OrthoMultiDataModule(OrthoDataModule):
+    def __init__(self, config, predictions=None):
+        super().__init__(config)
+        # the scenes `config.scenes` of `root_dir`, or one in-memory prediction per scene
+        self.scene_configs = [OmegaConf.merge(config, {'scene': scene}) for scene in config.scenes]
+        self.predictions = predictions if predictions is not None else [None] * len(self.scene_configs)
+
+    def setup(self, stage=None):
+        if stage in [None, 'fit']:
+            self.train_dataset = OrthoMultiIterableDataset(self.scene_configs, 'train', self.predictions)
+        if stage in [None, 'fit', 'validate']:
+            self.val_dataset = OrthoMultiDataset(self.scene_configs, self.config.get('val_split', 'train'), self.predictions)
+        if stage in [None, 'test']:
+            self.test_dataset = OrthoMultiTestDataset(self.scene_configs, self.config.get('test_split', 'test'))
+        if stage in [None, 'predict']:
+            self.predict_dataset = OrthoMultiDataset(self.scene_configs, 'train', self.predictions)
@@ -0,0 +1,14 @@
+from torch.utils.data import DataLoader
+
+
+def in_process_loader(dataset, batch_size, num_workers=0):
+    # the datasets here only hand out `{}` (training) or a view index, the systems draw the rays from tensors that are
+    # already on the device: worker processes and pinned host copies would only cost startup time and memory. Keep
+    # `num_workers` for datasets that read files per item.
+    return DataLoader(
+        dataset,
+        num_workers=num_workers,
+        batch_size=batch_size,
+        pin_memory=num_workers > 0,
+        persistent_workers=num_workers > 0
+    )
@@ -62,10 +62,13 @@ class NeuSModel(BaseModel):
 
         self.variance = VarianceNetwork(self.config.variance)
         self.register_buffer('scene_aabb', torch.as_tensor([-self.config.radius, -self.config.radius, -self.config.radius, self.config.radius, self.config.radius, self.config.radius], dtype=torch.float32))
+        # set by `carve_visual_hull`
+        self.register_buffer('visual_hull', None, persistent=False)
+        self.grid_resolution = 128
         if self.config.grid_prune:
             self.occupancy_grid = OccupancyGrid(
                 roi_aabb=self.scene_aabb,
-                resolution=128,
+                resolution=self.grid_resolution,
                 contraction_type=ContractionType.AABB
             )
             if self.config.learned_background:
@@ -109,6 +112,10 @@ class NeuSModel(BaseModel):
         
         if self.training and self.config.grid_prune:
             self.occupancy_grid.every_n_step(step=global_step, occ_eval_fn=occ_eval_fn, occ_thre=self.config.get('grid_prune_occ_thre', 0.01))
+            if self.visual_hull is not None:
+                # nothing outside the hull is ever marched
+                self.occupancy_grid.occs *= self.visual_hull.view(-1)
+                self.occupancy_grid._binary &= self.visual_hull
             if self.config.learned_background:
                 self.occupancy_grid_bg.every_n_step(step=global_step, occ_eval_fn=occ_eval_fn_bg, occ_thre=self.config.get('grid_prune_occ_thre_bg', 0.01))
 
@@ -116,6 +123,63 @@ class NeuSModel(BaseModel):
         mesh = self.geometry.isosurface()
         return mesh
 
+    @torch.no_grad()
+    def carve_visual_hull(self, hull):
+        """
+        Restricts the model to the `(R, R, R)` visual `hull` over the grid cells of `[-radius, radius]^3`: the rays are
+        clipped to the bounding box of the hull and the occupancy grid starts as, and stays inside, the hull. An empty
+        hull leaves the model unchanged; returns whether the hull was applied.
+        """
+        cell = 2 * self.config.radius / self.grid_resolution
+        occupied = torch.nonzero(hull)
+        if len(occupied) == 0:
+            return False
+        self.visual_hull = hull
+        # a new tensor, the occupancy grid keeps the full cube as its region
+        self.scene_aabb = torch.cat([
+            occupied.amin(dim=0) * cell - self.config.radius,
+            (occupied.amax(dim=0) + 1) * cell - self.config.radius
+        ]).float().clamp(-self.config.radius, self.config.radius)
+        if self.config.grid_prune:
+            self.occupancy_grid.occs.copy_(hull.view(-1).float())
+            self.occupancy_grid._binary.copy_(hull)
+        return True
+
+    def fit_sdf_to_hull(self, steps, truncation=4, batch_size=2**16, lr=1e-3):
+        """
+        Fits the geometry to the signed distance of the visual hull, truncated at `truncation` grid cells, as a
+        starting shape closer to the object than the initial sphere.
+        """
+        hull = self.visual_hull[None, None].float()
+        resolution = self.grid_resolution
+        cell = 2 * self.config.radius / resolution
+
+        # distances in cells, by growing the hull and its complement one cell at a time
+        with torch.no_grad():
+            dist_out, dist_in = torch.full_like(hull, truncation), torch.full_like(hull, truncation)
+            grown_out, grown_in = hull, 1 - hull
+            dist_out[grown_out > 0] = 0
+            dist_in[grown_in > 0] = 0
+            for step in range(1, truncation):
+                grown_out = F.max_pool3d(grown_out, 3, stride=1, padding=1)
+                grown_in = F.max_pool3d(grown_in, 3, stride=1, padding=1)
+                dist_out[(grown_out > 0) & (dist_out == truncation)] = step
+                dist_in[(grown_in > 0) & (dist_in == truncation)] = step
+            target_sdf = torch.where(hull > 0, 0.5 - dist_in, dist_out - 0.5).view(-1) * cell
+
+        optimizer = torch.optim.Adam(self.geometry.parameters(), lr=lr)
+        self.geometry.train()
+        with torch.enable_grad():
+            for _ in range(steps):
+                points = (torch.rand(batch_size, 3, device=target_sdf.device) * 2 - 1) * self.config.radius
+                cells = ((points + self.config.radius) / cell).long().clamp(0, resolution - 1)
+                target = target_sdf[(cells[:, 0] * resolution + cells[:, 1]) * resolution + cells[:, 2]]
+                sdf = self.geometry(points, with_grad=False, with_feature=False)
+                loss = F.l1_loss(sdf, target)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
     def get_alpha(self, sdf, normal, dirs, dists):
         inv_s = self.variance(torch.zeros([1, 3]))[:, :1].clip(1e-6, 1e6)           # Single parameter
         inv_s = inv_s.expand(sdf.shape[0], 1)
@@ -222,12 +286,18 @@ class NeuSModel(BaseModel):
             )
         
         ray_indices = ray_indices.long()
+        samples = self.shade_(rays_o, rays_d, ray_indices, t_starts, t_ends)
+        weights = render_weight_from_alpha(samples['alpha'], ray_indices=ray_indices, n_rays=n_rays)
+        return self.render_(rays, ray_indices, weights, samples)
+
+    def shade_(self, rays_o, rays_d, ray_indices, t_starts, t_ends):
         t_origins = rays_o[ray_indices]
         t_dirs = rays_d[ray_indices]
         midpoints = (t_starts + t_ends) / 2.
         positions = t_origins + t_dirs * midpoints
         dists = t_ends - t_starts
 
+        sdf_laplace = None
         if self.config.geometry.grad_type == 'finite_difference':
             sdf, sdf_grad, feature, sdf_laplace = self.geometry(positions, with_grad=True, with_feature=True, with_laplace=True)
         else:
@@ -236,13 +306,27 @@ class NeuSModel(BaseModel):
         normal = F.normalize(sdf_grad, p=2, dim=-1)
         alpha = self.get_alpha(sdf, normal, t_dirs, dists)[...,None]
         rgb = self.texture(feature, t_dirs, normal)
+        return {
+            'positions': positions,
+            'midpoints': midpoints,
+            'dists': dists,
+            'sdf': sdf,
+            'sdf_grad': sdf_grad,
+            'sdf_laplace': sdf_laplace,
+            'normal': normal,
+            'alpha': alpha,
+            'rgb': rgb
+        }
+
+    def render_(self, rays, ray_indices, weights, samples):
+        n_rays = rays.shape[0]
+        sdf, positions, midpoints = samples['sdf'], samples['positions'], samples['midpoints']
 
-        weights = render_weight_from_alpha(alpha, ray_indices=ray_indices, n_rays=n_rays)
         opacity = accumulate_along_rays(weights, ray_indices, values=None, n_rays=n_rays)
         depth = accumulate_along_rays(weights, ray_indices, values=midpoints, n_rays=n_rays)
-        comp_rgb = accumulate_along_rays(weights, ray_indices, values=rgb, n_rays=n_rays)
+        comp_rgb = accumulate_along_rays(weights, ray_indices, values=samples['rgb'], n_rays=n_rays)
 
-        comp_normal = accumulate_along_rays(weights, ray_indices, values=normal, n_rays=n_rays)
+        comp_normal = accumulate_along_rays(weights, ray_indices, values=samples['normal'], n_rays=n_rays)
         comp_normal = F.normalize(comp_normal, p=2, dim=-1)
 
         pts_random = torch.rand([1024*2, 3]).to(sdf.dtype).to(sdf.device) * 2 - 1  # normalized to (-1, 1)
@@ -265,24 +349,24 @@ class NeuSModel(BaseModel):
             'opacity': opacity,
             'depth': depth,
             'rays_valid': opacity > 0,
-            'num_samples': torch.as_tensor([len(t_starts)], dtype=torch.int32, device=rays.device)
+            'num_samples': torch.as_tensor([len(midpoints)], dtype=torch.int32, device=rays.device)
         }
 
         if self.training:
             out.update({
                 'sdf_samples': sdf,
-                'sdf_grad_samples': sdf_grad,
+                'sdf_grad_samples': samples['sdf_grad'],
                 'random_sdf': random_sdf,
                 'random_sdf_grad': random_sdf_grad,
                 'normal_perturb' : normal_perturb,
                 'weights': weights.view(-1),
                 'points': midpoints.view(-1),
-                'intervals': dists.view(-1),
+                'intervals': samples['dists'].view(-1),
                 'ray_indices': ray_indices.view(-1)                
             })
             if self.config.geometry.grad_type == 'finite_difference':
                 out.update({
-                    'sdf_laplace_samples': sdf_laplace
+                    'sdf_laplace_samples': samples['sdf_laplace']
                 })
 
         if self.config.learned_background:
@@ -339,3 +423,103 @@ class NeuSModel(BaseModel):
             rgb = self.texture(feature, -normal, normal) # set the viewing directions to the normal to get "albedo"
             mesh['v_rgb'] = rgb.cpu()
         return mesh
+
+
+class PackedOccupancyGrid():
+    """
+    The occupancy grids of several scenes sharing one AABB, laid side by side along x. Shifted by `offsets[k]` and
+    clipped to the AABB of its scene, a ray of scene k marches through the grid of scene k only, so one `ray_marching`
+    call serves the rays of all scenes.
+    """
+    contraction_type = ContractionType.AABB
+
+    def __init__(self, grids):
+        roi_aabb = grids[0].roi_aabb
+        width = roi_aabb[3] - roi_aabb[0]
+        shift = torch.arange(len(grids), dtype=roi_aabb.dtype, device=roi_aabb.device) * width
+        self.offsets = F.pad(shift[:, None], (0, 2))
+        self.roi_aabb = torch.cat([roi_aabb[:3], roi_aabb[3:] + self.offsets[-1]])
+        self.binary = torch.cat([grid.binary for grid in grids], dim=0)
+
+
+@models.register('neus-multi')
+class MultiNeuSModel(BaseModel):
+    """
+    `num_scenes` independent NeuS models, each with its own networks, variance and occupancy grid, trained in
+    lockstep. In training, the rays of all scenes are marched in one call and weighted in one call; only the networks
+    are evaluated scene by scene, and so is a learned background. Takes and returns one entry per scene.
+    """
+    def setup(self):
+        self.scenes = nn.ModuleList([NeuSModel(self.config) for _ in range(self.config.num_scenes)])
+
+    def update_step(self, epoch, global_step):
+        for scene in self.scenes:
+            update_module_step(scene, epoch, global_step)
+
+    def forward_(self, rays_list):
+        rays = torch.cat(rays_list, dim=0)
+        rays_o, rays_d = rays[:, 0:3], rays[:, 3:6] # both (N_rays, 3)
+        n_rays = [len(scene_rays) for scene_rays in rays_list]
+        scene_ids = torch.repeat_interleave(
+            torch.arange(len(rays_list), device=rays.device), torch.as_tensor(n_rays, device=rays.device)
+        )
+        leader = self.scenes[0]
+
+        with torch.no_grad():
+            # the same near and far distances as `scene_aabb` gives a single scene
+            bounds = [
+                ray_aabb_intersect(scene_rays[:, 0:3], scene_rays[:, 3:6], scene.scene_aabb)
+                for scene, scene_rays in zip(self.scenes, rays_list)
+            ]
+            t_min, t_max = torch.cat([t[0] for t in bounds]), torch.cat([t[1] for t in bounds])
+            grid, marching_rays_o = None, rays_o
+            if self.config.grid_prune:
+                grid = PackedOccupancyGrid([scene.occupancy_grid for scene in self.scenes])
+                marching_rays_o = rays_o + grid.offsets[scene_ids]
+            ray_indices, t_starts, t_ends = ray_marching(
+                marching_rays_o, rays_d,
+                t_min=t_min, t_max=t_max,
+                grid=grid,
+                render_step_size=leader.render_step_size,
+                stratified=leader.randomized,
+                cone_angle=0.0,
+                alpha_thre=0.0
+            )
+
+        # samples come sorted by ray, hence by scene
+        ray_indices = ray_indices.long()
+        n_samples = torch.bincount(scene_ids[ray_indices], minlength=len(rays_list)).tolist()
+        samples = [
+            scene.shade_(rays_o, rays_d, scene_ray_indices, scene_t_starts, scene_t_ends)
+            for scene, scene_ray_indices, scene_t_starts, scene_t_ends in zip(
+                self.scenes, ray_indices.split(n_samples), t_starts.split(n_samples), t_ends.split(n_samples)
+            )
+        ]
+        weights = render_weight_from_alpha(
+            torch.cat([scene_samples['alpha'] for scene_samples in samples], dim=0),
+            ray_indices=ray_indices, n_rays=len(rays)
+        )
+
+        outs = []
+        ray_offset = 0
+        for scene, scene_rays, scene_ray_indices, scene_weights, scene_samples in zip(
+            self.scenes, rays_list, ray_indices.split(n_samples), weights.split(n_samples), samples
+        ):
+            outs.append(scene.render_(scene_rays, scene_ray_indices - ray_offset, scene_weights, scene_samples))
+            ray_offset += len(scene_rays)
+        return outs
+
+    def forward(self, rays_list):
+        if not self.training:
+            return [scene(scene_rays) for scene, scene_rays in zip(self.scenes, rays_list)]
+        return [
+            {**out, 'inv_s': scene.variance.inv_s}
+            for scene, out in zip(self.scenes, self.forward_(rays_list))
+        ]
+
+    def regularizations(self, out):
+        return [scene.regularizations(scene_out) for scene, scene_out in zip(self.scenes, out)]
+
+    @torch.no_grad()
+    def export(self, export_config):
+        return [scene.export(export_config) for scene in self.scenes]
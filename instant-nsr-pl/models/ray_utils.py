@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
 
 
@@ -90,3 +91,29 @@ def get_ortho_rays(origins, directions, c2w, keepdim=False):
         rays_o, rays_d = rays_o.reshape(-1, 3), rays_d.reshape(-1, 3)
 
     return rays_o, rays_d
+
+
+def get_ortho_ray_tables(c2w):
+    # (N, 3, 4) cam2world of orthographic views -> (N, 4, 3): per view, the world origin of the ray through the image
+    # center, the world offsets of one unit of camera x and y (the image spans [-1, 1]) and the unit ray direction
+    rot, trans = c2w[:, :3, :3], c2w[:, :3, 3]
+    return torch.stack([trans, rot[:, :, 0], rot[:, :, 1], F.normalize(rot[:, :, 2], p=2, dim=-1)], dim=1)
+
+
+def get_ortho_rays_from_tables(tables, index, x, y, W, H):
+    # the world rays of pixels (x, y) of views `index`, as `get_ortho_rays` on the origins and directions of
+    # `get_ortho_ray_directions_origins` gives them, with unit directions
+    view = tables[index]
+    u = ((x.float() + 0.5) / W - 0.5) * 2
+    v = ((y.float() + 0.5) / H - 0.5) * 2
+    rays_o = view[:, 0] + view[:, 1] * u[:, None] + view[:, 2] * v[:, None]
+    rays_d = view[:, 3].expand(rays_o.shape)
+    return rays_o, rays_d
+
+
+def get_ortho_view_rays_from_tables(tables, index, W, H):
+    # all H * W rays of view `index`, row by row
+    y, x = torch.meshgrid(
+        torch.arange(H, device=tables.device), torch.arange(W, device=tables.device), indexing='ij'
+    )
+    return get_ortho_rays_from_tables(tables, index, x.reshape(-1), y.reshape(-1), W, H)
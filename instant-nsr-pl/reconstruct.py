@@ -0,0 +1,329 @@
+"""
+In-process image -> multiview -> mesh, without the PNG files and the `bash run.sh` subprocess in between.
+
+`reconstruct_mesh` fits NeuS to multiview predictions held in memory (the ortho datamodule reads them instead of
+`root_dir/scene`), exports the mesh in memory and refines its vertex colors against the same color views; nothing is
+written unless `save_dir` is given. Run from this directory, like `launch.py`:
+
+    python reconstruct.py --image ../examples/A_bulldog_with_a_black_pirate_hat_rgba.png --save_dir recon
+
+or from Python, with the output of `StableUnCLIPImg2ImgPipeline(..., output_type='pt')`:
+
+    prediction = prediction_from_pipeline_output(out.images, num_views=6, masks=derive_view_masks(normals, colors))
+    mesh = reconstruct_mesh(prediction, scene='bulldog')
+
+`reconstruct_meshes` fits a batch of scenes together in one process, see `ortho-neus-multi-system`:
+
+    meshes = reconstruct_meshes([prediction_a, prediction_b, prediction_c], scenes=['a', 'b', 'c'])
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ERA3D_ROOT = os.path.dirname(ROOT)
+# appended last so the local packages (`datasets`, `utils`, ...) win, as in `datasets/ortho.py`
+sys.path.append(ERA3D_ROOT)
+# the views of `OrthoDatasetBase`
+VIEWS = ['front', 'front_right', 'right', 'back', 'left', 'front_left']
+
+
+def prediction_from_pipeline_output(images, num_views, masks=None):
+    r"""
+    `(2 * Nv, 3, H, W)` pipeline output in [0, 1], normals first, and optional `(Nv, 1, H, W)` masks in [0, 1] ->
+    the uint8 `{'normals', 'colors', 'masks'}` arrays `OrthoDataModule` takes as `prediction`. Without masks, the
+    views are segmented by rembg like the files written by `test_mvdiffusion_unclip.py`.
+    """
+    def to_uint8(x):
+        return x.mul(255).add_(0.5).clamp_(0, 255).to("cpu", torch.uint8).numpy()
+
+    images = images.float()
+    prediction = {
+        'normals': to_uint8(images[:num_views].permute(0, 2, 3, 1)),
+        'colors': to_uint8(images[num_views:2 * num_views].permute(0, 2, 3, 1)),
+        'masks': None,
+    }
+    if masks is not None:
+        prediction['masks'] = to_uint8(masks.float()[:, 0])
+    return prediction
+
+
+def _setup_config(config_path, overrides, scene, save_dir):
+    from utils.misc import load_config
+
+    config = load_config(config_path, cli_args=list(overrides) + [f'dataset.scene={scene}'])
+    config.trial_name = config.get('trial_name') or (config.tag + datetime.now().strftime('@%Y%m%d-%H%M%S'))
+    # the systems save through `config.save_dir`, a throw-away directory when nothing should be kept
+    work_dir = save_dir if save_dir is not None else tempfile.mkdtemp(prefix='era3d-recon-')
+    config.exp_dir = os.path.join(work_dir, config.name)
+    config.save_dir = os.path.join(config.exp_dir, config.trial_name, 'save')
+    config.ckpt_dir = os.path.join(config.exp_dir, config.trial_name, 'ckpt')
+    config.code_dir = os.path.join(config.exp_dir, config.trial_name, 'code')
+    config.config_dir = os.path.join(config.exp_dir, config.trial_name, 'config')
+    return config, work_dir
+
+
+def _refine_mesh_colors(mesh, prediction, config, scene, device, save_path=None):
+    from datasets.ortho import load_rgba_views, rgba_views_from_arrays
+    from texture_refine import make_target_colors, refine_colors
+    from utils.func import save_obj
+
+    vertices = torch.tensor(mesh.vertices, dtype=torch.float32, device=device)
+    faces = torch.tensor(mesh.faces, dtype=torch.long, device=device)
+    init_colors = torch.tensor(mesh.visual.vertex_colors[:, :3] / 255., dtype=torch.float32, device=device)
+    imSize = list(config.dataset.imSize)
+    if prediction is not None:
+        color_views = rgba_views_from_arrays(imSize=imSize, **prediction)[len(prediction['colors']):]
+    else:
+        color_views = load_rgba_views([
+            os.path.join(config.dataset.root_dir, scene, f'color_{view}_masked.png') for view in VIEWS
+        ], imSize)
+    colors = refine_colors(vertices, faces, init_colors, make_target_colors(color_views, device), device)
+    mesh.visual.vertex_colors = np.concatenate([
+        (colors.clamp(0, 1).cpu().numpy() * 255).round().astype(np.uint8),
+        np.full((len(colors), 1), 255, dtype=np.uint8),
+    ], axis=-1)
+    if save_path is not None:
+        save_obj(vertices, faces, save_path, colors)
+
+
+def reconstruct_mesh(
+    prediction=None,
+    scene='scene',
+    config_path=os.path.join(ROOT, 'configs/neuralangelo-ortho-wmask.yaml'),
+    overrides=(),
+    gpu=0,
+    save_dir=None,
+    refine_texture=True,
+    timings=None,
+):
+    r"""
+    Fits NeuS to one multiview prediction and returns the textured mesh.
+
+    Args:
+        prediction (`dict`, *optional*):
+            `{'normals', 'colors'}` `(Nv, H, W, 3)` uint8 views and `'masks'`, `(Nv, H, W)` uint8 or `None` for rembg,
+            see `prediction_from_pipeline_output`. Without it, the views are read from `dataset.root_dir/scene` like
+            `launch.py` does.
+        scene (`str`, *optional*):
+            The name of the experiment and of the saved files.
+        config_path (`str`, *optional*):
+            The instant-nsr-pl config, `overrides` are dotlist entries on top of it, e.g. `['trainer.max_steps=2000']`.
+        gpu (`int`, *optional*, defaults to 0):
+            The GPU to fit on.
+        save_dir (`str`, *optional*):
+            Where to write the test renderings, the NeuS mesh and the refined mesh, as `launch.py` does. Nothing is
+            written when `None`.
+        refine_texture (`bool`, *optional*, defaults to `True`):
+            Whether to optimize the vertex colors against the color views, as `texture_refine` does.
+        timings (`dict`, *optional*):
+            Filled with the seconds spent in each stage: `setup`, `fit`, `test`, `export`, `refine`.
+
+    Returns:
+        `trimesh.Trimesh`: the mesh, with the (refined) vertex colors.
+    """
+    import pytorch_lightning as pl
+    from pytorch_lightning import Trainer
+
+    import systems
+    from datasets.ortho import OrthoDataModule
+
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = now - start
+        start = now
+
+    config, work_dir = _setup_config(config_path, overrides, scene, save_dir)
+    device = torch.device(f'cuda:{gpu}')
+
+    try:
+        pl.seed_everything(config.seed)
+        dm = OrthoDataModule(config.dataset, prediction=prediction)
+        system = systems.make(config.system.name, config)
+        trainer = Trainer(
+            devices=[gpu], accelerator='gpu', logger=False, enable_checkpointing=False, **config.trainer
+        )
+        lap('setup')
+        trainer.fit(system, datamodule=dm)
+        lap('fit')
+        if save_dir is not None:
+            # the renderings of the test views, the video and the mesh file, like `launch.py --train`
+            trainer.test(system, datamodule=dm)
+            lap('test')
+
+        system.to(device).eval()
+        mesh = system.make_mesh(ortho_scale=config.export.ortho_scale, **system.model.export(config.export))
+        lap('export')
+        if refine_texture:
+            save_path = os.path.join(config.save_dir, f'refine_{scene}.obj') if save_dir is not None else None
+            _refine_mesh_colors(mesh, prediction, config, scene, device, save_path)
+            lap('refine')
+        return mesh
+    finally:
+        if save_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def reconstruct_meshes(
+    predictions=None,
+    scenes=None,
+    config_path=os.path.join(ROOT, 'configs/neuralangelo-ortho-wmask.yaml'),
+    overrides=(),
+    gpu=0,
+    save_dir=None,
+    refine_texture=True,
+    timings=None,
+):
+    r"""
+    Fits NeuS to several multiview predictions at once and returns their textured meshes, in order. The scenes are
+    trained in lockstep by `ortho-neus-multi-system`, with the hyper-parameters `config_path` gives a single scene,
+    so each mesh matches the one of `reconstruct_mesh` up to the random draws while a batch of K scenes takes far
+    less than K fits on a small GPU workload.
+
+    Args:
+        predictions (`List[dict]`, *optional*):
+            One prediction per scene, see `reconstruct_mesh`. Without them, the views of `scenes` are read from
+            `dataset.root_dir`.
+        scenes (`List[str]`, *optional*):
+            The names of the scenes, required without `predictions`.
+        save_dir (`str`, *optional*):
+            Where to write the NeuS meshes and the refined meshes. Nothing is written when `None`.
+        timings (`dict`, *optional*):
+            Filled with the seconds spent in each stage of the whole batch: `setup`, `fit`, `export`, `refine`.
+
+    The other arguments are those of `reconstruct_mesh`.
+    """
+    import pytorch_lightning as pl
+    from pytorch_lightning import Trainer
+
+    import systems
+    from datasets.ortho import OrthoMultiDataModule
+
+    if scenes is None:
+        scenes = [f'scene_{i}' for i in range(len(predictions))]
+    predictions = predictions if predictions is not None else [None] * len(scenes)
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = now - start
+        start = now
+
+    config, work_dir = _setup_config(config_path, overrides, f'{scenes[0]}-x{len(scenes)}', save_dir)
+    config.dataset.name = 'ortho-multi'
+    config.dataset.scenes = list(scenes)
+    config.model.name = 'neus-multi'
+    config.model.num_scenes = len(scenes)
+    config.system.name = 'ortho-neus-multi-system'
+    device = torch.device(f'cuda:{gpu}')
+
+    try:
+        pl.seed_everything(config.seed)
+        dm = OrthoMultiDataModule(config.dataset, predictions=predictions)
+        system = systems.make(config.system.name, config)
+        trainer = Trainer(
+            devices=[gpu], accelerator='gpu', logger=False, enable_checkpointing=False, **config.trainer
+        )
+        lap('setup')
+        trainer.fit(system, datamodule=dm)
+        lap('fit')
+
+        system.to(device).eval()
+        meshes = [
+            system.make_mesh(ortho_scale=config.export.ortho_scale, **mesh)
+            for mesh in system.model.export(config.export)
+        ]
+        if save_dir is not None:
+            os.makedirs(config.save_dir, exist_ok=True)
+            for scene, mesh in zip(scenes, meshes):
+                mesh.export(os.path.join(config.save_dir, f'{scene}.obj'))
+        lap('export')
+        if refine_texture:
+            for scene, prediction, mesh in zip(scenes, predictions, meshes):
+                save_path = os.path.join(config.save_dir, f'refine_{scene}.obj') if save_dir is not None else None
+                _refine_mesh_colors(mesh, prediction, config, scene, device, save_path)
+            lap('refine')
+        return meshes
+    finally:
+        if save_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def generate_prediction(image, era3d_config, crop_size=420, guidance_scale=3.0, seed=600, rgba_mask='refined'):
+    r"""
+    Runs Era3D on an RGBA `image` (PIL, background removed) and returns the prediction for `reconstruct_mesh`; the
+    pipeline is freed before returning, so NeuS gets the whole GPU.
+    """
+    from omegaconf import OmegaConf
+
+    from mvdiffusion.data.single_image_dataset import SingleImageDataset
+    from mvdiffusion.data.view_masks import derive_view_masks
+    from mvdiffusion.pipelines.pipeline_loading import load_era3d_pipeline
+    from test_mvdiffusion_unclip import TestConfig, expand_views, weight_dtype
+
+    # plain OmegaConf: this directory's `utils` package shadows the one of Era3D
+    cfg = OmegaConf.merge(OmegaConf.structured(TestConfig), OmegaConf.load(era3d_config))
+    pipeline, prompt_embeds = load_era3d_pipeline(cfg, dtype=weight_dtype, root=ERA3D_ROOT)
+    pipeline.set_progress_bar_config(disable=True)
+    num_views = pipeline.num_views
+    dataset = SingleImageDataset(
+        root_dir='', num_views=num_views, img_wh=cfg.validation_dataset.img_wh, bg_color='white',
+        crop_size=crop_size, single_image=image, prompt_embeds_path=None,
+    )
+    batch = dataset[0]
+    device = pipeline.unet.device
+
+    imgs_in = expand_views(torch.stack([batch['imgs_in']] * 2).to(device=device, dtype=weight_dtype), num_views)
+    prompt_embeds = torch.cat([prompt_embeds['normal'], prompt_embeds['color']], dim=0)
+    generator = torch.Generator(device=device).manual_seed(seed)
+    with torch.no_grad():
+        out = pipeline(
+            imgs_in, None, prompt_embeds=prompt_embeds.to(device=device, dtype=weight_dtype), generator=generator,
+            guidance_scale=guidance_scale, output_type='pt', num_images_per_prompt=1, **cfg.pipe_validation_kwargs
+        ).images.float()
+        masks = None
+        if rgba_mask != 'rembg':
+            masks = derive_view_masks(out[:num_views], out[num_views:], refine=rgba_mask == 'refined')
+    del pipeline
+    torch.cuda.empty_cache()
+    return prediction_from_pipeline_output(out, num_views, masks=masks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', type=str, required=True, help='RGBA input with the background removed')
+    parser.add_argument('--era3d_config', type=str, default=os.path.join(ERA3D_ROOT, 'configs/test_unclip-512-6view.yaml'))
+    parser.add_argument('--config', type=str, default=os.path.join(ROOT, 'configs/neuralangelo-ortho-wmask.yaml'))
+    parser.add_argument('--gpu', type=int, default=0)
+    parser.add_argument('--crop_size', type=int, default=420)
+    parser.add_argument('--guidance_scale', type=float, default=3.0)
+    parser.add_argument('--seed', type=int, default=600)
+    parser.add_argument('--rgba_mask', type=str, default='refined', choices=['rembg', 'threshold', 'refined'])
+    parser.add_argument('--save_dir', type=str, default=None)
+    parser.add_argument('--output', type=str, default=None, help='where to write the mesh, e.g. mesh.obj or mesh.glb')
+    args, extras = parser.parse_known_args()
+
+    from PIL import Image
+
+    scene = os.path.splitext(os.path.basename(args.image))[0]
+    prediction = generate_prediction(
+        Image.open(args.image), args.era3d_config, crop_size=args.crop_size, guidance_scale=args.guidance_scale,
+        seed=args.seed, rgba_mask=args.rgba_mask,
+    )
+    mesh = reconstruct_mesh(prediction, scene=scene, config_path=args.config, overrides=extras, gpu=args.gpu,
+                            save_dir=args.save_dir)
+    if args.output is not None:
+        mesh.export(args.output)
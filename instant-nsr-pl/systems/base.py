@@ -115,8 +115,11 @@ class BaseSystem(pl.LightningModule, SaverMixin):
     def export(self):
         raise NotImplementedError
 
+    def optimized_models(self):
+        return self.model
+
     def configure_optimizers(self):
-        optim = parse_optimizer(self.config.system.optimizer, self.model)
+        optim = parse_optimizer(self.config.system.optimizer, self.optimized_models())
         ret = {
             'optimizer': optim,
         }
@@ -4,24 +4,26 @@ import torch.nn.functional as F
 from torch_efficient_distloss import flatten_eff_distloss
 
 import pytorch_lightning as pl
-from pytorch_lightning.utilities.rank_zero import rank_zero_info, rank_zero_debug
+from pytorch_lightning.utilities.rank_zero import rank_zero_info, rank_zero_debug, rank_zero_warn
 
 import models
 from models.utils import cleanup
-from models.ray_utils import get_ortho_rays
+from models.ray_utils import get_ortho_rays, get_ortho_rays_from_tables, get_ortho_view_rays_from_tables
 import systems
 from systems.base import BaseSystem
 from systems.criterions import PSNR, binary_cross_entropy
+from datasets.ortho import unpack_pixel_records
 
 import pdb
 
 def ranking_loss(error, penalize_ratio=0.7, extra_weights=None , type='mean'):
     error, indices = torch.sort(error)
     # only sum relatively small errors
-    s_error = torch.index_select(error, 0, index=indices[:int(penalize_ratio * indices.shape[0])])
+    k = int(penalize_ratio * indices.shape[0])
+    s_error = error[:k]
     if extra_weights is not None:
-        weights = torch.index_select(extra_weights, 0, index=indices[:int(penalize_ratio * indices.shape[0])])
-        s_error = s_error * weights
+        # `indices` maps the sorted errors back to their rays
+        s_error = s_error * extra_weights[indices[:k]]
 
     if type == 'mean':
         return torch.mean(s_error)
@@ -42,9 +44,34 @@ class OrthoNeuSSystem(BaseSystem):
         self.train_num_samples = self.config.model.train_num_rays * (self.config.model.num_samples_per_ray + self.config.model.get('num_samples_per_ray_bg', 0))
         self.train_num_rays = self.config.model.train_num_rays
         self.cos = torch.nn.CosineSimilarity(dim=-1, eps=1e-6)
+        self.restored_from_checkpoint = False
 
     def forward(self, batch):
         return self.model(batch['rays'])
+
+    def on_load_checkpoint(self, checkpoint):
+        # `--resume` and `--resume_weights_only` alike
+        self.restored_from_checkpoint = True
+
+    def on_fit_start(self):
+        self.carve_visual_hull(self.trainer.datamodule.train_dataloader().dataset, self.model)
+
+    def carve_visual_hull(self, dataset, model):
+        # the views are orthographic with known poses, their silhouettes bound the object before any training
+        hull_config = self.config.model.get('visual_hull', None)
+        if hull_config is None:
+            return
+        hull = dataset.visual_hull(model.grid_resolution, self.config.model.radius, margin=hull_config.get('margin', 0))
+        if self.restored_from_checkpoint or self.trainer.ckpt_path is not None or self.global_step > 0:
+            # the occupancy grid, the bounds and the geometry come from the checkpoint, only the hull is not saved
+            if hull.any():
+                model.visual_hull = hull
+            return
+        if not model.carve_visual_hull(hull):
+            rank_zero_warn("The visual hull is empty, check the masks of the views; training without it.")
+            return
+        if hull_config.get('seed_sdf_steps', 0) > 0:
+            model.fit_sdf_to_hull(hull_config.seed_sdf_steps)
     
     def preprocess_test_data(self, batch, stage):
         if 'index' in batch: # validation / testing
@@ -55,130 +82,180 @@ class OrthoNeuSSystem(BaseSystem):
             else:
                 index = torch.randint(0, len(self.dataset.all_images), size=(1,), device=self.dataset.all_images.device)
     
-        c2w = self.dataset.all_c2w[index][0]
-        if self.dataset.directions.ndim == 3: # (H, W, 3)
-            directions = self.dataset.directions
-            origins = self.dataset.origins
-        elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
-            directions = self.dataset.directions[index][0] 
-            origins = self.dataset.origins[index][0]
-        rays_o, rays_d = get_ortho_rays(origins, directions, c2w)
-
-        rays = torch.cat([rays_o, F.normalize(rays_d, p=2, dim=-1)], dim=-1)
-
-        self.model.background_color = torch.ones((3,), dtype=torch.float32, device=self.rank)
-        
-        
         batch.update({
-            'rays': rays,
+            'rays': self.test_rays(self.dataset, self.model, index),
                 })      
+
+    def test_rays(self, dataset, model, index):
+        # the rays of the test view `index` of `dataset`, rendered by `model` on a white background
+        if dataset.ray_tables is not None:
+            rays_o, rays_d = get_ortho_view_rays_from_tables(dataset.ray_tables, index, dataset.w, dataset.h)
+            rays = torch.cat([rays_o, rays_d], dim=-1)
+        else:
+            c2w = dataset.all_c2w[index][0]
+            if dataset.directions.ndim == 3: # (H, W, 3)
+                directions = dataset.directions
+                origins = dataset.origins
+            elif dataset.directions.ndim == 4: # (N, H, W, 3)
+                directions = dataset.directions[index][0] 
+                origins = dataset.origins[index][0]
+            rays_o, rays_d = get_ortho_rays(origins, directions, c2w)
+
+            rays = torch.cat([rays_o, F.normalize(rays_d, p=2, dim=-1)], dim=-1)
+
+        model.background_color = torch.ones((3,), dtype=torch.float32, device=self.rank)
+        return rays
     
     def preprocess_data(self, batch, stage):
-        if 'index' in batch: # validation / testing
-            index = batch['index']
-        else:
-            if self.config.model.batch_image_sampling:
-                index = torch.randint(0, len(self.dataset.all_images), size=(self.train_num_rays,), device=self.dataset.all_images.device)
+        batch.update(self.sample_rays(self.dataset, self.model, batch.get('index'), stage, self.train_num_rays))
+
+    def sample_rays(self, dataset, model, index, stage, train_num_rays):
+        importance_sampling = self.config.model.get('importance_sampling', None)
+        sample_weights = None
+        # `index` is given in validation / testing
+        if index is None:
+            if importance_sampling is not None:
+                index, y, x, sample_weights = dataset.sample_pixels(train_num_rays, importance_sampling)
+            elif self.config.model.batch_image_sampling:
+                index = torch.randint(0, dataset.num_views, size=(train_num_rays,), device=dataset.pixel_records.device)
             else:
-                index = torch.randint(0, len(self.dataset.all_images), size=(1,), device=self.dataset.all_images.device)
+                index = torch.randint(0, dataset.num_views, size=(1,), device=dataset.pixel_records.device)
         if stage in ['train']:
-            c2w = self.dataset.all_c2w[index]
-            x = torch.randint(
-                0, self.dataset.w, size=(self.train_num_rays,), device=self.dataset.all_images.device
-            )
-            y = torch.randint(
-                0, self.dataset.h, size=(self.train_num_rays,), device=self.dataset.all_images.device
-            )
-            if self.dataset.directions.ndim == 3: # (H, W, 3)
-                directions = self.dataset.directions[y, x]
-                origins = self.dataset.origins[y, x]
-            elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
-                directions = self.dataset.directions[index, y, x]
-                origins = self.dataset.origins[index, y, x]
-            rays_o, rays_d = get_ortho_rays(origins, directions, c2w)
-            rgb = self.dataset.all_images[index, y, x].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            normal = self.dataset.all_normals_world[index, y, x].view(-1, self.dataset.all_normals_world.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index, y, x].view(-1).to(self.rank)
-            rgb_mask = self.dataset.all_rgb_masks[index, y, x].view(-1).to(self.rank)
-            view_weights = self.dataset.view_weights[index, y, x].view(-1).to(self.rank)
+            if sample_weights is None:
+                x = torch.randint(
+                    0, dataset.w, size=(train_num_rays,), device=dataset.pixel_records.device
+                )
+                y = torch.randint(
+                    0, dataset.h, size=(train_num_rays,), device=dataset.pixel_records.device
+                )
+            if dataset.ray_tables is not None:
+                rays_o, rays_d = get_ortho_rays_from_tables(dataset.ray_tables, index, x, y, dataset.w, dataset.h)
+            else:
+                c2w = dataset.all_c2w[index]
+                if dataset.directions.ndim == 3: # (H, W, 3)
+                    directions = dataset.directions[y, x]
+                    origins = dataset.origins[y, x]
+                elif dataset.directions.ndim == 4: # (N, H, W, 3)
+                    directions = dataset.directions[index, y, x]
+                    origins = dataset.origins[index, y, x]
+                rays_o, rays_d = get_ortho_rays(origins, directions, c2w)
+            pixels = unpack_pixel_records(dataset.pixel_records[index, y, x].view(-1, 8))
+            view_weights = dataset.view_weights[index].expand(train_num_rays)
         else:
-            c2w = self.dataset.all_c2w[index][0]
-            if self.dataset.directions.ndim == 3: # (H, W, 3)
-                directions = self.dataset.directions
-                origins = self.dataset.origins
-            elif self.dataset.directions.ndim == 4: # (N, H, W, 3)
-                directions = self.dataset.directions[index][0] 
-                origins = self.dataset.origins[index][0]
-            rays_o, rays_d = get_ortho_rays(origins, directions, c2w)
-            rgb = self.dataset.all_images[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            normal = self.dataset.all_normals_world[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index].view(-1).to(self.rank)
-            rgb_mask = self.dataset.all_rgb_masks[index].view(-1).to(self.rank)
+            if dataset.ray_tables is not None:
+                rays_o, rays_d = get_ortho_view_rays_from_tables(dataset.ray_tables, index, dataset.w, dataset.h)
+            else:
+                c2w = dataset.all_c2w[index][0]
+                if dataset.directions.ndim == 3: # (H, W, 3)
+                    directions = dataset.directions
+                    origins = dataset.origins
+                elif dataset.directions.ndim == 4: # (N, H, W, 3)
+                    directions = dataset.directions[index][0] 
+                    origins = dataset.origins[index][0]
+                rays_o, rays_d = get_ortho_rays(origins, directions, c2w)
+            pixels = unpack_pixel_records(dataset.pixel_records[index].view(-1, 8))
             view_weights = None
+        rgb, normal, fg_mask, rgb_mask = pixels['rgb'], pixels['normal'], pixels['fg_mask'], pixels['rgb_mask']
 
         cosines = self.cos(rays_d, normal)
-        rays = torch.cat([rays_o, F.normalize(rays_d, p=2, dim=-1)], dim=-1)
+        if dataset.ray_tables is None:
+            rays_d = F.normalize(rays_d, p=2, dim=-1)
+        rays = torch.cat([rays_o, rays_d], dim=-1)
 
         if stage in ['train']:
             if self.config.model.background_color == 'white':
-                self.model.background_color = torch.ones((3,), dtype=torch.float32, device=self.rank)
+                model.background_color = torch.ones((3,), dtype=torch.float32, device=self.rank)
             elif self.config.model.background_color == 'black':
-                self.model.background_color = torch.zeros((3,), dtype=torch.float32, device=self.rank)
+                model.background_color = torch.zeros((3,), dtype=torch.float32, device=self.rank)
             elif self.config.model.background_color == 'random':
-                self.model.background_color = torch.rand((3,), dtype=torch.float32, device=self.rank)
+                model.background_color = torch.rand((3,), dtype=torch.float32, device=self.rank)
             else:
                 raise NotImplementedError
         else:
-            self.model.background_color = torch.ones((3,), dtype=torch.float32, device=self.rank)
+            model.background_color = torch.ones((3,), dtype=torch.float32, device=self.rank)
         
-        if self.dataset.apply_mask:
-            rgb = rgb * fg_mask[...,None] + self.model.background_color * (1 - fg_mask[...,None])
+        if dataset.apply_mask:
+            rgb = rgb * fg_mask[...,None] + model.background_color * (1 - fg_mask[...,None])
         
-        batch.update({
+        return {
             'rays': rays,
             'rgb': rgb,
             'normal': normal,
             'fg_mask': fg_mask,
             'rgb_mask': rgb_mask,
             'cosines': cosines,
-            'view_weights': view_weights
-        })      
+            'view_weights': view_weights,
+            'sample_weights': sample_weights
+        }
     
     def training_step(self, batch, batch_idx):
         out = self(batch)
 
+        # update train_num_rays
+        if self.config.model.dynamic_ray_sampling:
+            self.train_num_rays = self.next_train_num_rays(self.train_num_rays, out)
+
+        loss = self.compute_loss(out, batch, self.model, self.dataset.has_mask, log_prefix='train/')
+
+        self.log('train/inv_s', out['inv_s'], prog_bar=True)
+
+        for name, value in self.config.system.loss.items():
+            if name.startswith('lambda'):
+                self.log(f'train_params/{name}', self.C(value))
+
+        self.log('train/num_rays', float(self.train_num_rays), prog_bar=True)
+
+        return {
+            'loss': loss
+        }
+    
+    def next_train_num_rays(self, train_num_rays, out):
+        # the number of rays that keeps the number of samples near `train_num_samples`
+        num_rays = int(train_num_rays * (self.train_num_samples / out['num_samples_full'].sum().item()))
+        return min(int(train_num_rays * 0.9 + num_rays * 0.1), self.config.model.max_train_num_rays)
+
+    def compute_loss(self, out, batch, model, has_mask, log_prefix=None):
+        def log(name, value, **kwargs):
+            if log_prefix is not None:
+                self.log(log_prefix + name, value, **kwargs)
+
         cosines = batch['cosines']
         fg_mask = batch['fg_mask']
         rgb_mask = batch['rgb_mask']
         view_weights =  batch['view_weights']
+        # rays drawn by importance sampling weigh their losses by the inverse of their relative probability;
+        # the ranking losses still drop the largest errors, so they only approximate the uniform-sampling losses
+        sample_weights = batch.get('sample_weights')
+        rgb_weights = None
+        if sample_weights is not None:
+            view_weights = view_weights * sample_weights
 
         cosines[cosines > -0.1] = 0
         mask = ((fg_mask > 0) & (cosines < -0.1))
         rgb_mask = out['rays_valid_full'][...,0] & (rgb_mask > 0)
+        if sample_weights is not None:
+            rgb_weights = sample_weights[rgb_mask]
 
         grad_cosines = self.cos(batch['rays'][...,3:], out['comp_normal']).detach()
         # grad_cosines = cosines
 
         loss = 0.
 
-        # update train_num_rays
-        if self.config.model.dynamic_ray_sampling:
-            train_num_rays = int(self.train_num_rays * (self.train_num_samples / out['num_samples_full'].sum().item()))        
-            self.train_num_rays = min(int(self.train_num_rays * 0.9 + train_num_rays * 0.1), self.config.model.max_train_num_rays)
-
         erros_rgb_mse = F.mse_loss(out['comp_rgb_full'][rgb_mask], batch['rgb'][rgb_mask], reduction='none')
         # erros_rgb_mse = erros_rgb_mse * torch.exp(grad_cosines.abs())[:, None][rgb_mask] / torch.exp(grad_cosines.abs()[rgb_mask]).sum()
         # loss_rgb_mse = ranking_loss(erros_rgb_mse.sum(dim=1), penalize_ratio=0.7, type='sum')
         loss_rgb_mse = ranking_loss(erros_rgb_mse.sum(dim=1), 
-                                    penalize_ratio=self.config.system.loss.rgb_p_ratio, type='mean')
-        self.log('train/loss_rgb_mse', loss_rgb_mse, prog_bar=True, rank_zero_only=True)
+                                    penalize_ratio=self.config.system.loss.rgb_p_ratio, 
+                                    extra_weights=rgb_weights, type='mean')
+        log('loss_rgb_mse', loss_rgb_mse, prog_bar=True, rank_zero_only=True)
         loss += loss_rgb_mse * self.C(self.config.system.loss.lambda_rgb_mse)
 
         loss_rgb_l1 = F.l1_loss(out['comp_rgb_full'][rgb_mask], batch['rgb'][rgb_mask], reduction='none')
         loss_rgb_l1 = ranking_loss(loss_rgb_l1.sum(dim=1),
                                     # extra_weights=view_weights[rgb_mask],
+                                    extra_weights=rgb_weights,
                                       penalize_ratio=0.8)
-        self.log('train/loss_rgb', loss_rgb_l1)
+        log('loss_rgb', loss_rgb_l1)
         loss += loss_rgb_l1 * self.C(self.config.system.loss.lambda_rgb_l1)    
 
         normal_errors = 1 - F.cosine_similarity(out['comp_normal'], batch['normal'], dim=1)
@@ -195,11 +272,16 @@ class OrthoNeuSSystem(BaseSystem):
                                     extra_weights=view_weights[mask],
                                     type='mean')    
         
-        self.log('train/loss_normal', loss_normal, prog_bar=True, rank_zero_only=True)
+        log('loss_normal', loss_normal, prog_bar=True, rank_zero_only=True)
         loss += loss_normal * self.C(self.config.system.loss.lambda_normal)       
 
-        loss_eikonal = ((torch.linalg.norm(out['sdf_grad_samples'], ord=2, dim=-1) - 1.)**2).mean()
-        self.log('train/loss_eikonal', loss_eikonal, prog_bar=True, rank_zero_only=True)
+        loss_eikonal = ((torch.linalg.norm(out['sdf_grad_samples'], ord=2, dim=-1) - 1.)**2)
+        if sample_weights is not None:
+            eikonal_weights = sample_weights[out['ray_indices']]
+            loss_eikonal = (loss_eikonal * eikonal_weights).sum() / eikonal_weights.sum().clamp_min(1e-6)
+        else:
+            loss_eikonal = loss_eikonal.mean()
+        log('loss_eikonal', loss_eikonal, prog_bar=True, rank_zero_only=True)
         loss += loss_eikonal * self.C(self.config.system.loss.lambda_eikonal)
         
         opacity = torch.clamp(out['opacity'].squeeze(-1), 1.e-3, 1.-1.e-3)
@@ -207,33 +289,33 @@ class OrthoNeuSSystem(BaseSystem):
         loss_mask = ranking_loss(loss_mask, 
                                  penalize_ratio=self.config.system.loss.mask_p_ratio, 
                                  extra_weights=view_weights)
-        self.log('train/loss_mask', loss_mask, prog_bar=True, rank_zero_only=True)
-        loss += loss_mask * (self.C(self.config.system.loss.lambda_mask) if self.dataset.has_mask else 0.0)
+        log('loss_mask', loss_mask, prog_bar=True, rank_zero_only=True)
+        loss += loss_mask * (self.C(self.config.system.loss.lambda_mask) if has_mask else 0.0)
 
         loss_opaque = binary_cross_entropy(opacity, opacity)
-        self.log('train/loss_opaque', loss_opaque)
+        log('loss_opaque', loss_opaque)
         loss += loss_opaque * self.C(self.config.system.loss.lambda_opaque)
 
         loss_sparsity = torch.exp(-self.config.system.loss.sparsity_scale * out['random_sdf'].abs()).mean()
-        self.log('train/loss_sparsity', loss_sparsity, prog_bar=True, rank_zero_only=True)
+        log('loss_sparsity', loss_sparsity, prog_bar=True, rank_zero_only=True)
         loss += loss_sparsity * self.C(self.config.system.loss.lambda_sparsity)
 
         if self.C(self.config.system.loss.lambda_curvature) > 0:
             assert 'sdf_laplace_samples' in out, "Need geometry.grad_type='finite_difference' to get SDF Laplace samples"
             loss_curvature = out['sdf_laplace_samples'].abs().mean()
-            self.log('train/loss_curvature', loss_curvature)
+            log('loss_curvature', loss_curvature)
             loss += loss_curvature * self.C(self.config.system.loss.lambda_curvature)
 
         # distortion loss proposed in MipNeRF360
         # an efficient implementation from https://github.com/sunset1995/torch_efficient_distloss
         if self.C(self.config.system.loss.lambda_distortion) > 0:
             loss_distortion = flatten_eff_distloss(out['weights'], out['points'], out['intervals'], out['ray_indices'])
-            self.log('train/loss_distortion', loss_distortion)
+            log('loss_distortion', loss_distortion)
             loss += loss_distortion * self.C(self.config.system.loss.lambda_distortion)    
 
         if self.config.model.learned_background and self.C(self.config.system.loss.lambda_distortion_bg) > 0:
             loss_distortion_bg = flatten_eff_distloss(out['weights_bg'], out['points_bg'], out['intervals_bg'], out['ray_indices_bg'])
-            self.log('train/loss_distortion_bg', loss_distortion_bg)
+            log('loss_distortion_bg', loss_distortion_bg)
             loss += loss_distortion_bg * self.C(self.config.system.loss.lambda_distortion_bg)     
 
         if self.C(self.config.system.loss.lambda_3d_normal_smooth) > 0:
@@ -248,28 +330,18 @@ class OrthoNeuSSystem(BaseSystem):
             normals_3d = out["random_sdf_grad"]
             normals_perturb_3d = out["normal_perturb"]
             loss_3d_normal_smooth = (normals_3d - normals_perturb_3d).abs().mean()
-            self.log('train/loss_3d_normal_smooth', loss_3d_normal_smooth, prog_bar=True )
+            log('loss_3d_normal_smooth', loss_3d_normal_smooth, prog_bar=True )
 
             loss += loss_3d_normal_smooth *  self.C(self.config.system.loss.lambda_3d_normal_smooth)  
 
-        losses_model_reg = self.model.regularizations(out)
+        losses_model_reg = model.regularizations(out)
         for name, value in losses_model_reg.items():
-            self.log(f'train/loss_{name}', value)
+            log(f'loss_{name}', value)
             loss_ = value * self.C(self.config.system.loss[f"lambda_{name}"])
             loss += loss_
-        
-        self.log('train/inv_s', out['inv_s'], prog_bar=True)
 
-        for name, value in self.config.system.loss.items():
-            if name.startswith('lambda'):
-                self.log(f'train_params/{name}', self.C(value))
+        return loss
 
-        self.log('train/num_rays', float(self.train_num_rays), prog_bar=True)
-
-        return {
-            'loss': loss
-        }
-    
     """
     # aggregate outputs from different devices (DP)
     def training_step_end(self, out):
@@ -384,3 +456,145 @@ class OrthoNeuSSystem(BaseSystem):
             ortho_scale=self.config.export.ortho_scale,
             **mesh
         )        
+
+
+@systems.register('ortho-neus-multi-system')
+class OrthoNeuSMultiSystem(OrthoNeuSSystem):
+    """
+    Trains the scenes of the `ortho-multi` datamodule with a `neus-multi` model in lockstep: every step samples the
+    rays of each scene as `OrthoNeuSSystem` does, renders them in one packed forward pass and sums the per-scene
+    losses. The scenes share no parameters, so each one gets the gradients, the dynamic ray count and the optimizer
+    updates of training it alone. With fp16, a scene whose gradients overflow skips its update alone, see
+    `on_after_backward`.
+    """
+    def prepare(self):
+        super().prepare()
+        self.train_num_rays = [self.config.model.train_num_rays] * self.config.model.num_scenes
+        # scenes whose gradients overflowed in this step
+        self.overflowed_scenes = []
+
+    def forward(self, batch):
+        return self.model([scene_batch['rays'] for scene_batch in batch['scenes']])
+
+    def on_fit_start(self):
+        for dataset, model in zip(self.trainer.datamodule.train_dataloader().dataset.scenes, self.model.scenes):
+            self.carve_visual_hull(dataset, model)
+
+    def preprocess_data(self, batch, stage):
+        batch['scenes'] = [
+            self.sample_rays(dataset, model, batch.get('index'), stage, train_num_rays)
+            for dataset, model, train_num_rays in zip(self.dataset.scenes, self.model.scenes, self.train_num_rays)
+        ]
+
+    def training_step(self, batch, batch_idx):
+        outs = self(batch)
+
+        # update train_num_rays
+        if self.config.model.dynamic_ray_sampling:
+            self.train_num_rays = [
+                self.next_train_num_rays(train_num_rays, out) for train_num_rays, out in zip(self.train_num_rays, outs)
+            ]
+
+        loss = 0.
+        for out, scene_batch, model, dataset in zip(outs, batch['scenes'], self.model.scenes, self.dataset.scenes):
+            loss += self.compute_loss(out, scene_batch, model, dataset.has_mask)
+
+        self.log('train/loss', loss / len(outs), prog_bar=True, rank_zero_only=True)
+        self.log('train/num_rays', float(sum(self.train_num_rays)), prog_bar=True)
+
+        return {
+            'loss': loss
+        }
+
+    def on_after_backward(self):
+        # one GradScaler serves all scenes, and an inf in any gradient would make it skip the step of every scene.
+        # The gradients of the overflowing scenes are dropped instead: AdamW leaves parameters without gradients
+        # untouched, and the other scenes step. If every scene overflowed, the scaler skips the step itself.
+        scaler = getattr(self.trainer.precision_plugin, 'scaler', None)
+        if scaler is None or not scaler.is_enabled():
+            return
+        scene_params = [[p for p in scene.parameters() if p.grad is not None] for scene in self.model.scenes]
+        finite = torch.stack([
+            torch.stack([p.grad.isfinite().all() for p in params]).all() if params else torch.tensor(True, device=self.device)
+            for params in scene_params
+        ]).tolist()
+        if all(finite) or not any(finite):
+            return
+        self.overflowed_scenes = [i for i, is_finite in enumerate(finite) if not is_finite]
+        for i in self.overflowed_scenes:
+            for p in scene_params[i]:
+                p.grad = None
+
+    def on_train_batch_end(self, out, batch, batch_idx, unused=0):
+        if len(self.overflowed_scenes) > 0:
+            # the scaler saw finite gradients only; back the loss scale off as it would have after the overflow
+            scaler = self.trainer.precision_plugin.scaler
+            scaler.update(scaler.get_scale() * scaler.get_backoff_factor())
+            self.overflowed_scenes = []
+
+    def validation_step(self, batch, batch_idx):
+        outs = self(batch)
+        W, H = self.dataset.scenes[0].img_wh
+        psnrs = []
+        for dataset, out, scene_batch in zip(self.dataset.scenes, outs, batch['scenes']):
+            psnrs.append(self.criterions['psnr'](out['comp_rgb_full'].to(scene_batch['rgb']), scene_batch['rgb']))
+            self.save_image_grid(f"it{self.global_step}-{dataset.scene}-{batch['index'][0].item()}.png", [
+                {'type': 'rgb', 'img': scene_batch['rgb'].view(H, W, 3), 'kwargs': {'data_format': 'HWC'}},
+                {'type': 'rgb', 'img': out['comp_rgb_full'].view(H, W, 3), 'kwargs': {'data_format': 'HWC'}}
+            ] + ([
+                {'type': 'rgb', 'img': out['comp_rgb_bg'].view(H, W, 3), 'kwargs': {'data_format': 'HWC'}},
+                {'type': 'rgb', 'img': out['comp_rgb'].view(H, W, 3), 'kwargs': {'data_format': 'HWC'}},
+            ] if self.config.model.learned_background else []) + [
+                {'type': 'grayscale', 'img': out['depth'].view(H, W), 'kwargs': {}},
+                {'type': 'rgb', 'img': out['comp_normal'].view(H, W, 3), 'kwargs': {'data_format': 'HWC', 'data_range': (-1, 1)}}
+            ])
+        return {
+            'psnr': torch.stack(psnrs).mean(),
+            'index': batch['index']
+        }
+
+    def preprocess_test_data(self, batch, stage):
+        batch['scenes'] = [
+            {'rays': self.test_rays(dataset, model, batch['index'])}
+            for dataset, model in zip(self.dataset.scenes, self.model.scenes)
+        ]
+
+    def test_step(self, batch, batch_idx):
+        outs = self(batch)
+        W, H = self.dataset.scenes[0].img_wh
+        for dataset, out in zip(self.dataset.scenes, outs):
+            normal = out['comp_normal']
+            normal[out['opacity'][:, 0] < 0.5, :] = 1.
+            self.save_image_grid(f"it{self.global_step}-test/{dataset.scene}/{batch['index'][0].item()}.png", ([
+                {'type': 'rgb', 'img': out['comp_rgb_bg'].view(H, W, 3), 'kwargs': {'data_format': 'HWC'}},
+                {'type': 'rgb', 'img': out['comp_rgb'].view(H, W, 3), 'kwargs': {'data_format': 'HWC'}},
+            ] if self.config.model.learned_background else []) + [
+                {'type': 'rgb', 'img': normal.view(H, W, 3), 'kwargs': {'data_format': 'HWC', 'data_range': (-1, 1)}}
+            ])
+        return {
+            'index': batch['index']
+        }
+
+    def test_epoch_end(self, out):
+        if self.trainer.is_global_zero:
+            for dataset in self.dataset.scenes:
+                self.save_img_sequence(
+                    f"it{self.global_step}-test-{dataset.scene}",
+                    f"it{self.global_step}-test/{dataset.scene}",
+                    '(\d+)\.png',
+                    save_format='mp4',
+                    fps=25
+                )
+            self.export()
+
+    def optimized_models(self):
+        # one set of parameter groups per scene, with the learning rates of a single scene
+        return self.model.scenes
+
+    def export(self):
+        for dataset, mesh in zip(self.dataset.scenes, self.model.export(self.config.export)):
+            self.save_mesh(
+                f"it{self.global_step}-{dataset.scene}-{self.config.model.geometry.isosurface.method}{self.config.model.geometry.isosurface.resolution}.obj",
+                ortho_scale=self.config.export.ortho_scale,
+                **mesh
+            )
@@ -12,16 +12,18 @@ from models.ray_utils import get_rays
 import systems
 from systems.base import BaseSystem
 from systems.criterions import PSNR, binary_cross_entropy
+from datasets.ortho import unpack_pixel_records
 
 import pdb
 
 def ranking_loss(error, penalize_ratio=0.7, extra_weights=None , type='mean'):
     error, indices = torch.sort(error)
     # only sum relatively small errors
-    s_error = torch.index_select(error, 0, index=indices[:int(penalize_ratio * indices.shape[0])])
+    k = int(penalize_ratio * indices.shape[0])
+    s_error = error[:k]
     if extra_weights is not None:
-        weights = torch.index_select(extra_weights, 0, index=indices[:int(penalize_ratio * indices.shape[0])])
-        s_error = s_error * weights
+        # `indices` maps the sorted errors back to their rays
+        s_error = s_error * extra_weights[indices[:k]]
 
     if type == 'mean':
         return torch.mean(s_error)
@@ -51,16 +53,16 @@ class PinholeNeuSSystem(BaseSystem):
             index = batch['index']
         else:
             if self.config.model.batch_image_sampling:
-                index = torch.randint(0, len(self.dataset.all_images), size=(self.train_num_rays,), device=self.dataset.all_images.device)
+                index = torch.randint(0, self.dataset.num_views, size=(self.train_num_rays,), device=self.dataset.pixel_records.device)
             else:
-                index = torch.randint(0, len(self.dataset.all_images), size=(1,), device=self.dataset.all_images.device)
+                index = torch.randint(0, self.dataset.num_views, size=(1,), device=self.dataset.pixel_records.device)
         if stage in ['train']:
             c2w = self.dataset.all_c2w[index]
             x = torch.randint(
-                0, self.dataset.w, size=(self.train_num_rays,), device=self.dataset.all_images.device
+                0, self.dataset.w, size=(self.train_num_rays,), device=self.dataset.pixel_records.device
             )
             y = torch.randint(
-                0, self.dataset.h, size=(self.train_num_rays,), device=self.dataset.all_images.device
+                0, self.dataset.h, size=(self.train_num_rays,), device=self.dataset.pixel_records.device
             )
             if self.dataset.directions.ndim == 3: # (H, W, 3)
                 directions = self.dataset.directions[y, x]
@@ -69,11 +71,8 @@ class PinholeNeuSSystem(BaseSystem):
                 directions = self.dataset.directions[index, y, x]
                 # origins = self.dataset.origins[index, y, x]
             rays_o, rays_d = get_rays(directions, c2w)
-            rgb = self.dataset.all_images[index, y, x].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            normal = self.dataset.all_normals_world[index, y, x].view(-1, self.dataset.all_normals_world.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index, y, x].view(-1).to(self.rank)
-            rgb_mask = self.dataset.all_rgb_masks[index, y, x].view(-1).to(self.rank)
-            view_weights = self.dataset.view_weights[index, y, x].view(-1).to(self.rank)
+            pixels = unpack_pixel_records(self.dataset.pixel_records[index, y, x].view(-1, 8))
+            view_weights = self.dataset.view_weights[index].expand(self.train_num_rays)
         else:
             c2w = self.dataset.all_c2w[index][0]
             if self.dataset.directions.ndim == 3: # (H, W, 3)
@@ -83,11 +82,9 @@ class PinholeNeuSSystem(BaseSystem):
                 directions = self.dataset.directions[index][0] 
                 # origins = self.dataset.origins[index][0]
             rays_o, rays_d = get_rays(directions, c2w)
-            rgb = self.dataset.all_images[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            normal = self.dataset.all_normals_world[index].view(-1, self.dataset.all_images.shape[-1]).to(self.rank)
-            fg_mask = self.dataset.all_fg_masks[index].view(-1).to(self.rank)
-            rgb_mask = self.dataset.all_rgb_masks[index].view(-1).to(self.rank)
+            pixels = unpack_pixel_records(self.dataset.pixel_records[index].view(-1, 8))
             view_weights = None
+        rgb, normal, fg_mask, rgb_mask = pixels['rgb'], pixels['normal'], pixels['fg_mask'], pixels['rgb_mask']
 
         cosines = self.cos(rays_d, normal)
         rays = torch.cat([rays_o, F.normalize(rays_d, p=2, dim=-1)], dim=-1)
@@ -313,7 +313,9 @@ def get_parameters(model, name):
 
 def parse_optimizer(config, model):
     if hasattr(config, 'params'):
-        params = [{'params': get_parameters(model, name), 'name': name, **args} for name, args in config.params.items()]
+        # a list of models, e.g. the scenes of a multi-scene model, gets the groups of `config.params` per model
+        models = model if isinstance(model, (list, tuple, nn.ModuleList)) else [model]
+        params = [{'params': get_parameters(m, name), 'name': name, **args} for m in models for name, args in config.params.items()]
         rank_zero_debug('Specify optimizer params:', config.params)
     else:
         params = model.parameters()
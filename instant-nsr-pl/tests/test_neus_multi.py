@@ -0,0 +1,72 @@
+"""
+A `neus-multi` model of one scene trains exactly like the single-scene `neus` model it packs:
+
+    cd instant-nsr-pl && python -m pytest tests/test_neus_multi.py
+
+Needs a GPU with nerfacc and tiny-cuda-nn.
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("nerfacc")
+pytest.importorskip("tinycudann")
+if not torch.cuda.is_available():
+    pytest.skip("needs a GPU", allow_module_level=True)
+
+from omegaconf import OmegaConf
+
+import models
+from systems.utils import update_module_step
+from utils.misc import load_config
+
+CONFIG = 'configs/neuralangelo-ortho-wmask.yaml'
+
+
+def ortho_rays(n_rays, seed=0):
+    # parallel rays along -z through random points of the front face
+    generator = torch.Generator().manual_seed(seed)
+    rays_o = torch.cat([torch.rand(n_rays, 2, generator=generator) * 1.6 - 0.8, torch.full((n_rays, 1), 2.)], dim=-1)
+    rays_d = torch.tensor([0., 0., -1.]).expand(n_rays, 3)
+    return torch.cat([rays_o, rays_d], dim=-1).cuda()
+
+
+@pytest.fixture
+def models_pair():
+    config = load_config(CONFIG).model
+    # no stratified sampling, the two models march the same samples
+    config.randomized = False
+    single = models.make('neus', config).cuda().train()
+    multi = models.make('neus-multi', OmegaConf.merge(config, {'name': 'neus-multi', 'num_scenes': 1})).cuda().train()
+    single.background_color = multi.scenes[0].background_color = torch.zeros(3).cuda()
+
+    # the occupancy grid update samples random points: run it once and give both models its result
+    update_module_step(single, 0, 0)
+    multi.scenes[0].load_state_dict(single.state_dict())
+    update_module_step(single, 0, 1)
+    update_module_step(multi, 0, 1)
+    return single, multi
+
+
+def test_one_scene_matches_the_single_model(models_pair):
+    single, multi = models_pair
+    rays = ortho_rays(512)
+
+    torch.manual_seed(0)
+    out_single = single(rays)
+    torch.manual_seed(0)
+    out_multi, = multi([rays])
+
+    assert out_single['num_samples'].item() > 0
+    for key in ('comp_rgb_full', 'comp_normal', 'opacity', 'depth', 'weights', 'ray_indices', 'sdf_samples'):
+        torch.testing.assert_close(out_multi[key], out_single[key], msg=key)
+
+    loss_single = out_single['comp_rgb_full'].square().mean() + out_single['sdf_grad_samples'].norm(dim=-1).mean()
+    loss_multi = out_multi['comp_rgb_full'].square().mean() + out_multi['sdf_grad_samples'].norm(dim=-1).mean()
+    loss_single.backward()
+    loss_multi.backward()
+    for (name, p_single), p_multi in zip(single.named_parameters(), multi.scenes[0].parameters()):
+        if p_single.grad is None:
+            assert p_multi.grad is None, name
+            continue
+        # the hash grid accumulates its gradients with atomics, in another order every run
+        torch.testing.assert_close(p_multi.grad, p_single.grad, rtol=1e-3, atol=1e-5, msg=name)
@@ -4,7 +4,6 @@ from utils.video_utils import *
 import  torch.optim as optim
 from tqdm import tqdm
 import cv2
-from rembg import remove
 # try:
 #     from util.view import show
 # except:
@@ -23,7 +22,7 @@ steps = 200
 lr_clr = 2e-3
 scale = 1
 bg_color = np.array([1,1,1])
-cam_path = './datasets/fixed_poses'
+cam_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datasets/fixed_poses')
 views = ['front', 'front_right', 'right', 'back', 'left', 'front_left']
 view_nums = len(views)
 addition_angles = [135, 225]
@@ -59,20 +58,22 @@ def prepare_renderer(device):
     renderer = nvdiffRenderer(mv, proj, [res,res], device=device)
     return renderer
     
-def load_training_data(img_path, obj_path, case, device):
-    target_vertices, init_colors, target_faces =  load_obj(obj_path, device=device)
-
+def make_target_colors(color_views, device):
+    # the color views (PIL images) composited on bg_color at the render resolution
     colors = []
-    for view in views:
-        color = Image.open(f'{img_path}/{case}/color_{view}_masked.png')
+    for color in color_views:
         color = color.convert('RGBA').resize((res, res), Image.BILINEAR)
         color = np.array(color).astype(np.float32) / 255.
         color_mask = color[..., 3:]  # alpha
         color = color[..., :3] * color_mask  + bg_color * (1 - color_mask)
         colors.append(color)
     colors = np.stack(colors, 0)
-    target_colors = torch.from_numpy(colors).to(device)
-    return target_vertices, target_faces, init_colors, target_colors
+    return torch.from_numpy(colors).to(device)
+
+def load_training_data(img_path, obj_path, case, device):
+    target_vertices, init_colors, target_faces =  load_obj(obj_path, device=device)
+    color_views = [Image.open(f'{img_path}/{case}/color_{view}_masked.png') for view in views]
+    return target_vertices, target_faces, init_colors, make_target_colors(color_views, device)
 
 
 class ColorModel(nn.Module):
@@ -91,8 +92,7 @@ class ColorModel(nn.Module):
         return rgba[..., :3] * mask + self.bg_color * (1 - mask)
         
 
-def optim_clr(case, img_path, mesh_dir, save_dir, device):
-    vert, face, init_colors, target_colors = load_training_data(img_path, f'{mesh_dir}/it3000-mc256.obj', case, device)
+def refine_colors(vert, face, init_colors, target_colors, device):
     ###----------------------- refine color-------------------------------------
     weight = torch.Tensor([1., .2, .7, 1., .7, .2, ] + [0.,]*num_additions).view(view_nums+num_additions,1,1,1).to(device)
     color_model = ColorModel(vert, face, init_colors, device)
@@ -111,9 +111,13 @@ def optim_clr(case, img_path, mesh_dir, save_dir, device):
         loss.backward()
         clr_opt.step()
         clr_scheduler.step()
+    return color_model.colors.detach()
 
-    save_obj(vert, face, f'{save_dir}/refine_{case}.obj', color_model.colors.detach())
-    return evaluate(vert, color_model.colors.detach(), face, device=device, save_nrm=False, save_path=f'{save_dir}/refine_{case}.mp4')
+def optim_clr(case, img_path, mesh_dir, save_dir, device):
+    vert, face, init_colors, target_colors = load_training_data(img_path, f'{mesh_dir}/it3000-mc256.obj', case, device)
+    colors = refine_colors(vert, face, init_colors, target_colors, device)
+    save_obj(vert, face, f'{save_dir}/refine_{case}.obj', colors)
+    return evaluate(vert, colors, face, device=device, save_nrm=False, save_path=f'{save_dir}/refine_{case}.mp4')
 
 def crop_input(image_input):
     def add_margin(pil_img, color=0, size=256):
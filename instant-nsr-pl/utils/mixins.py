@@ -209,6 +209,11 @@ class SaverMixin():
             imageio.mimsave(self.get_save_path(filename), imgs, fps=fps)
     
     def save_mesh(self, filename, v_pos, t_pos_idx, v_tex=None, t_tex_idx=None, v_rgb=None, ortho_scale=1):
+        mesh = self.make_mesh(v_pos, t_pos_idx, v_rgb=v_rgb, ortho_scale=ortho_scale)
+        mesh.export(self.get_save_path(filename))
+
+    def make_mesh(self, v_pos, t_pos_idx, v_tex=None, t_tex_idx=None, v_rgb=None, ortho_scale=1):
+        # the trimesh `save_mesh` writes, front-facing and scaled to the ortho cameras
         v_pos, t_pos_idx = self.convert_data(v_pos), self.convert_data(t_pos_idx)
         if v_rgb is not None:
             v_rgb = self.convert_data(v_rgb)
@@ -230,7 +235,7 @@ class SaverMixin():
             vertex_colors=v_rgb
         )
         trimesh.repair.fix_inversion(mesh)
-        mesh.export(self.get_save_path(filename))
+        return mesh
         # mesh.export(self.get_save_path(filename.replace(".obj", "-meshlab.obj")))
 
         # v_pos_copy[:, 0] = v_pos[:, 1] * -1
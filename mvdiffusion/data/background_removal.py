@@ -0,0 +1,128 @@
+"""
+Process-wide rembg sessions.
+
+`rembg.remove(image)` without a `session` builds a new ONNX session, i.e. reloads the model, on every call. The
+helpers here create one session per process and model, with a configurable number of ONNX intra-op threads, and can
+segment a batch of views in one inference call:
+
+    rgba = remove_background(image)
+    rgbas = remove_background_batch([normal_0, color_0, normal_1, color_1])
+
+Images are PIL images or uint8 numpy arrays and come back in the same type, like `rembg.remove`.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# rembg sessions producing a single 320x320 saliency map, which can be predicted for a batch at once
+_BATCHED_MODELS = ("u2net", "u2netp", "u2net_human_seg", "silueta")
+
+_SESSIONS: Dict[Tuple, object] = {}
+# models whose ONNX graph turned out to have a fixed batch size of one
+_UNBATCHABLE = set()
+
+
+def get_rembg_session(model_name: str = "u2net", num_threads: Optional[int] = None, providers: Optional[List[str]] = None):
+    r"""
+    Returns the rembg session of `model_name` for this process, creating it on first use.
+
+    Args:
+        model_name (`str`, *optional*, defaults to `"u2net"`):
+            The rembg model.
+        num_threads (`int`, *optional*):
+            ONNX intra-op threads, defaults to onnxruntime's choice (all cores). Lower it when several processes
+            segment at once.
+        providers (`List[str]`, *optional*):
+            ONNX execution providers, e.g. `["CUDAExecutionProvider"]`.
+    """
+    # sessions do not survive a fork, every process builds its own
+    key = (os.getpid(), model_name, num_threads, tuple(providers or ()))
+    if key not in _SESSIONS:
+        import onnxruntime as ort
+        from rembg.sessions import sessions_class
+
+        sess_opts = ort.SessionOptions()
+        if num_threads is not None:
+            sess_opts.intra_op_num_threads = num_threads
+            sess_opts.inter_op_num_threads = 1
+        session_classes = {session_class.name(): session_class for session_class in sessions_class}
+        if model_name not in session_classes:
+            raise ValueError(f"Unknown rembg model {model_name}, choose from {list(session_classes.keys())}.")
+        _SESSIONS[key] = session_classes[model_name](model_name, sess_opts, providers=providers)
+    return _SESSIONS[key]
+
+
+def remove_background(image, session=None, **kwargs):
+    r"""
+    `rembg.remove` on the pooled session; `kwargs` are passed on (`alpha_matting`, `only_mask`, ...).
+    """
+    from rembg import remove
+
+    return remove(image, session=session or get_rembg_session(), **kwargs)
+
+
+def _is_batchable(session) -> bool:
+    if session.model_name in _UNBATCHABLE:
+        return False
+    # a symbolic (str) or missing batch dimension accepts any batch size
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim != -1:
+        _UNBATCHABLE.add(session.model_name)
+        return False
+    return True
+
+
+def _predict_masks(session, images: List[Image.Image]) -> List[Image.Image]:
+    # batched version of `U2netSession.predict`
+    inputs = [session.normalize(img, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)) for img in images]
+    input_name = next(iter(inputs[0].keys()))
+    preds = None
+    if len(images) > 1 and _is_batchable(session):
+        from onnxruntime.capi.onnxruntime_pybind11_state import InvalidArgument
+
+        try:
+            preds = session.inner_session.run(None, {input_name: np.concatenate([x[input_name] for x in inputs])})[0]
+        except InvalidArgument as e:
+            # a batch dimension fixed somewhere inside the graph; other errors (OOM, bad input) are real failures
+            if "dimension" not in str(e):
+                raise
+            _UNBATCHABLE.add(session.model_name)
+    if preds is None:
+        preds = np.concatenate([session.inner_session.run(None, x)[0] for x in inputs])
+
+    masks = []
+    for pred, img in zip(preds[:, 0], images):
+        pred = (pred - pred.min()) / (pred.max() - pred.min())
+        mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+        masks.append(mask.resize(img.size, Image.Resampling.LANCZOS))
+    return masks
+
+
+def predict_masks_batch(images: list, session=None) -> List[Image.Image]:
+    r"""
+    The rembg alpha masks (`"L"` images) of all `images`, in one ONNX inference call for the u2net-family models.
+    """
+    session = session or get_rembg_session()
+    pil_images = [Image.fromarray(image) if isinstance(image, np.ndarray) else image for image in images]
+    if session.model_name not in _BATCHED_MODELS:
+        return [remove_background(image, session=session, only_mask=True) for image in pil_images]
+    return _predict_masks(session, [img.convert("RGB") for img in pil_images])
+
+
+def remove_background_batch(images: list, session=None, **kwargs) -> list:
+    r"""
+    Segments all `images` with one ONNX inference call. Falls back to `remove_background` per image for models
+    or options (alpha matting, post-processing, ...) the batched path does not cover.
+    """
+    session = session or get_rembg_session()
+    if len(kwargs) > 0 or session.model_name not in _BATCHED_MODELS:
+        return [remove_background(image, session=session, **kwargs) for image in images]
+
+    from rembg.bg import naive_cutout
+
+    pil_images = [Image.fromarray(image) if isinstance(image, np.ndarray) else image for image in images]
+    masks = _predict_masks(session, [img.convert("RGB") for img in pil_images])
+    cutouts = [naive_cutout(img, mask) for img, mask in zip(pil_images, masks)]
+    return [np.asarray(cutout) if isinstance(image, np.ndarray) else cutout for image, cutout in zip(images, cutouts)]
@@ -14,6 +14,7 @@ import numpy as np
 import torch
 from PIL import Image
 from .normal_utils import trans_normal, img2normal, normal2img
+from .normal_transforms import img_to_normal, normal_to_img, trans_normals
 
 """
 load normal and color images together
@@ -108,25 +109,21 @@ class MVDiffusionDatasetV2(Dataset):
     def __len__(self):
         return len(self.all_obj_ids)
 
-    def __getitem__(self, index):
-        obj_path = self.all_obj_paths[index]
-        obj_id = self.all_obj_ids[index]
-        with open(os.path.join(obj_path, 'meta.json')) as f:
-            meta = json.loads(f.read())
-
-        num_views_all = len(meta['locations'])
+    def sample_view_ids(self, num_views_all):
         num_groups = num_views_all // self.num_views
 
         # random a set of 4 views
         # the data is arranged in ascending order of the azimuth angle
         group_ids = random.sample(range(num_groups), k=2)
         cond_group_id, tgt_group_id = group_ids
-        cond_location = meta['locations'][cond_group_id * self.num_views + random.randint(0, self.num_views - 1)]
-        tgt_locations = meta['locations'][tgt_group_id * self.num_views : tgt_group_id * self.num_views + self.num_views]
+        cond_view_id = cond_group_id * self.num_views + random.randint(0, self.num_views - 1)
+        tgt_view_ids = list(range(tgt_group_id * self.num_views, tgt_group_id * self.num_views + self.num_views))
         # random an order
         start_id = random.randint(0, self.num_views - 1)
-        tgt_locations = tgt_locations[start_id:] + tgt_locations[:start_id]
-        
+        tgt_view_ids = tgt_view_ids[start_id:] + tgt_view_ids[:start_id]
+        return cond_view_id, tgt_view_ids
+
+    def camera_params(self, cond_location, tgt_locations):
         cond_elevation = cond_location['elevation']
         cond_azimuth = cond_location['azimuth']
         cond_c2w = cond_location['transform_matrix']
@@ -141,38 +138,59 @@ class MVDiffusionDatasetV2(Dataset):
         elevations = torch.as_tensor(elevations).float()
         azimuths = torch.as_tensor(azimuths).float()
         elevations_cond = torch.as_tensor([cond_elevation] * self.num_views).float()
+        camera_embeddings = torch.stack([elevations_cond, elevations, azimuths], dim=-1) # (Nv, 3)
+
+        return {
+            'elevations_cond': elevations_cond,
+            'elevations_cond_deg': torch.rad2deg(elevations_cond),
+            'elevations': elevations,
+            'azimuths': azimuths,
+            'elevations_deg': torch.rad2deg(elevations),
+            'azimuths_deg': torch.rad2deg(azimuths),
+            'camera_embeddings': camera_embeddings
+        }, cond_w2c, tgt_w2cs
+
+    def __getitem__(self, index):
+        obj_path = self.all_obj_paths[index]
+        obj_id = self.all_obj_ids[index]
+        with open(os.path.join(obj_path, 'meta.json')) as f:
+            meta = json.loads(f.read())
+
+        cond_view_id, tgt_view_ids = self.sample_view_ids(len(meta['locations']))
+        cond_location = meta['locations'][cond_view_id]
+        tgt_locations = [meta['locations'][view_id] for view_id in tgt_view_ids]
+        camera_params, cond_w2c, tgt_w2cs = self.camera_params(cond_location, tgt_locations)
 
         bg_color = self.get_bg_color()
         img_tensors_in = [
             self.load_image(os.path.join(obj_path, cond_location['frames'][0]['name']), bg_color, return_type='pt')[0].permute(2, 0, 1)
         ] * self.num_views
         img_tensors_out = []
-        normal_tensors_out = []
-        for loc, tgt_w2c in zip(tgt_locations, tgt_w2cs):
+        alphas = []
+        normals = []
+        for loc in tgt_locations:
             img_path = os.path.join(obj_path, loc['frames'][0]['name'])
             img_tensor, alpha = self.load_image(img_path, bg_color, return_type="pt")
             img_tensor = img_tensor.permute(2, 0, 1)
             img_tensors_out.append(img_tensor)
+            alphas.append(alpha)
 
             normal_path = os.path.join(obj_path, loc['frames'][1]['name'])
-            normal_tensor = self.load_normal(normal_path, bg_color, alpha, RT_w2c=tgt_w2c, RT_w2c_cond=cond_w2c, return_type="pt").permute(2, 0, 1)
-            normal_tensors_out.append(normal_tensor)
+            normals.append(np.array(Image.open(normal_path).resize(self.img_wh)))
+        # all target normals into the condition camera at once
+        normals = trans_normals(img_to_normal(np.stack(normals)), np.stack(tgt_w2cs), cond_w2c)
+        normals = normal_to_img(normals).float() / 255.
+        alphas = torch.from_numpy(np.stack(alphas))
+        normal_tensors_out = normals * alphas + torch.from_numpy(bg_color).float() * (1 - alphas)
+
         img_tensors_in = torch.stack(img_tensors_in, dim=0).float() # (Nv, 3, H, W)
         img_tensors_out = torch.stack(img_tensors_out, dim=0).float() # (Nv, 3, H, W)
-        normal_tensors_out = torch.stack(normal_tensors_out, dim=0).float() # (Nv, 3, H, W)
-
-        camera_embeddings = torch.stack([elevations_cond, elevations, azimuths], dim=-1) # (Nv, 3)
+        normal_tensors_out = normal_tensors_out.permute(0, 3, 1, 2).float() # (Nv, 3, H, W)
 
         return {
-            'elevations_cond': elevations_cond,
-            'elevations_cond_deg': torch.rad2deg(elevations_cond),
-            'elevations': elevations,
-            'azimuths': azimuths,
-            'elevations_deg': torch.rad2deg(elevations),
-            'azimuths_deg': torch.rad2deg(azimuths),
+            **camera_params,
             'imgs_in': img_tensors_in,
             'imgs_out': img_tensors_out,
             'normals_out': normal_tensors_out,
-            'camera_embeddings': camera_embeddings
         }
 
@@ -0,0 +1,70 @@
+"""
+Batched normal map transforms in torch, shared by the diffusion datasets and the instant-nsr-pl ortho loader.
+
+Every function takes a whole `(Nv, H, W, 3)` stack of normals and `(Nv, 3, 3)` (or one `(3, 3)`) rotations and works
+in float32 on whatever device the inputs live on; the rotations are computed once per stack instead of once per view.
+"""
+from typing import Union
+
+import numpy as np
+import torch
+
+ArrayLike = Union[np.ndarray, torch.Tensor]
+
+
+def _as_tensor(x: ArrayLike, device=None) -> torch.Tensor:
+    if isinstance(x, np.ndarray):
+        x = torch.from_numpy(np.ascontiguousarray(x))
+    return x.to(device=device, dtype=torch.float32)
+
+
+def img_to_normal(img: ArrayLike, device=None) -> torch.Tensor:
+    r"""
+    uint8 normal images in [0, 255] -> normals in [-1, 1], like `normal_utils.img2normal`.
+    """
+    return _as_tensor(img, device) / 255. * 2 - 1
+
+
+def normal_to_img(normal: torch.Tensor) -> torch.Tensor:
+    r"""
+    Normals in [-1, 1] -> uint8 images, rounded down like `normal_utils.normal2img`.
+    """
+    return torch.floor((normal * 0.5 + 0.5) * 255).clamp(0, 255).to(torch.uint8)
+
+
+def transform_normals(normals: ArrayLike, rotations: ArrayLike) -> torch.Tensor:
+    r"""
+    Applies `rotations` to every normal of a stack: `out[v, h, w] = rotations[v] @ normals[v, h, w]`.
+
+    Args:
+        normals (`np.ndarray` or `torch.Tensor`):
+            `(Nv, H, W, 3)` or `(H, W, 3)` normals.
+        rotations (`np.ndarray` or `torch.Tensor`):
+            `(Nv, 3, 3)` rotations, one per view, or one `(3, 3)` rotation for all views.
+
+    Returns:
+        `torch.Tensor`: float32 normals of the same shape, on the device of `normals`.
+    """
+    normals = _as_tensor(normals)
+    rotations = _as_tensor(rotations, normals.device)
+    if rotations.ndim == 2:
+        return torch.einsum('...c,dc->...d', normals, rotations)
+    return torch.einsum('vhwc,vdc->vhwd', normals, rotations)
+
+
+def relative_rotations(w2cs: ArrayLike, w2c_target: ArrayLike) -> torch.Tensor:
+    r"""
+    Rotations taking normals from the cameras `w2cs` (`(Nv, 3 or 4, 4)`) into the camera `w2c_target`, batched
+    `R_target @ inv(R_v)` as in `normal_utils.trans_normal`.
+    """
+    w2cs = _as_tensor(w2cs)
+    w2c_target = _as_tensor(w2c_target, w2cs.device)
+    return w2c_target[:3, :3] @ torch.linalg.inv(w2cs[:, :3, :3])
+
+
+def trans_normals(normals: ArrayLike, w2cs: ArrayLike, w2c_target: ArrayLike) -> torch.Tensor:
+    r"""
+    Batched `normal_utils.trans_normal`: moves each view of `normals` from its camera `w2cs[v]` into `w2c_target`.
+    """
+    normals = _as_tensor(normals)
+    return transform_normals(normals, relative_rotations(w2cs, w2c_target).to(normals.device))
@@ -0,0 +1,234 @@
+"""
+Packed, memory-mappable shards of the MVDiffusionDatasetV2 training data.
+
+The packer decodes and resizes every view once and writes the objects into shards of uint8 `.npy` arrays
+(`color` RGB, `alpha` and `normal` RGB, all `(views, H, W, C)`) plus an `index.json` with the camera of every view:
+
+    python -m mvdiffusion.data.packed_dataset --root_dir /data/objaverse_renders --output_dir /data/packed-512 \
+        --img_wh 512 512 --objects_per_shard 256 --num_workers 16
+
+`PackedMVDiffusionDataset` reads them with random access through `np.load(mmap_mode='r')`, so a sample only
+touches the pages of its own views and the page cache is shared by all DataLoader workers and ranks of a host.
+"""
+import argparse
+import glob
+import json
+import os
+from multiprocessing import Pool
+from typing import Any, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .dataset_nc import MVDiffusionDatasetV2
+from .normal_transforms import img_to_normal, normal_to_img, trans_normals
+
+PACKED_FORMAT = "era3d-packed-mv"
+PACKED_VERSION = "1"
+PACKED_ARRAYS = ("color", "alpha", "normal")
+
+
+def _shard_name(shard_id, array):
+    return f"shard-{shard_id:05d}.{array}.npy"
+
+
+def _pack_shard(shard_id, obj_paths, output_dir, img_wh):
+    w, h = img_wh
+    metas = []
+    for obj_path in obj_paths:
+        with open(os.path.join(obj_path, 'meta.json')) as f:
+            metas.append(json.loads(f.read()))
+    num_views = sum(len(meta['locations']) for meta in metas)
+
+    # written to temporary names and renamed once complete, an interrupted run leaves no truncated shard behind
+    arrays = {
+        array: np.lib.format.open_memmap(
+            os.path.join(output_dir, _shard_name(shard_id, array) + '.tmp'), mode='w+', dtype=np.uint8,
+            shape=(num_views, h, w, 1 if array == 'alpha' else 3)
+        )
+        for array in PACKED_ARRAYS
+    }
+    objects = []
+    offset = 0
+    for obj_path, meta in zip(obj_paths, metas):
+        locations = []
+        for view_id, loc in enumerate(meta['locations']):
+            # same decoding and resizing as MVDiffusionDatasetV2.load_image / load_normal
+            color = np.array(Image.open(os.path.join(obj_path, loc['frames'][0]['name'])).resize(img_wh))
+            normal = np.array(Image.open(os.path.join(obj_path, loc['frames'][1]['name'])).resize(img_wh))
+            assert color.shape[-1] == 4 and normal.shape[-1] == 3
+            arrays['color'][offset + view_id] = color[..., :3]
+            arrays['alpha'][offset + view_id] = color[..., 3:4]
+            arrays['normal'][offset + view_id] = normal
+            locations.append({
+                'elevation': loc['elevation'],
+                'azimuth': loc['azimuth'],
+                'transform_matrix': loc['transform_matrix'],
+            })
+        objects.append({
+            'obj_id': os.path.basename(obj_path),
+            'obj_path': obj_path,
+            'shard': shard_id,
+            'offset': offset,
+            'locations': locations,
+        })
+        offset += len(locations)
+
+    for array in PACKED_ARRAYS:
+        arrays[array].flush()
+        del arrays[array]
+        path = os.path.join(output_dir, _shard_name(shard_id, array))
+        os.replace(path + '.tmp', path)
+    return objects
+
+
+def pack_mvdiffusion_dataset(
+    root_dir: str,
+    output_dir: str,
+    img_wh: Tuple[int, int],
+    objects_per_shard: int = 256,
+    num_workers: int = 1,
+):
+    r"""
+    Packs the objects of `root_dir` (laid out as for `MVDiffusionDatasetV2`) into shards in `output_dir`.
+
+    Args:
+        root_dir (`str`):
+            The rendered objects, `root_dir/*/*/meta.json`.
+        output_dir (`str`):
+            Where the shards and `index.json` are written.
+        img_wh (`Tuple[int, int]`):
+            The resolution the views are stored in; the dataset has to be read with the same `img_wh`.
+        objects_per_shard (`int`, *optional*, defaults to 256):
+            The number of objects in each shard.
+        num_workers (`int`, *optional*, defaults to 1):
+            The number of processes packing shards in parallel.
+    """
+    img_wh = tuple(img_wh)
+    # sorted like MVDiffusionDatasetV2, so the train / validation split of both datasets is the same
+    obj_paths = sorted(glob.glob(os.path.join(root_dir, "*/*")))
+    shards = [obj_paths[i:i + objects_per_shard] for i in range(0, len(obj_paths), objects_per_shard)]
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = [(shard_id, shard, output_dir, img_wh) for shard_id, shard in enumerate(shards)]
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            shard_objects = pool.starmap(_pack_shard, jobs)
+    else:
+        shard_objects = [_pack_shard(*job) for job in jobs]
+
+    index = {
+        'format': PACKED_FORMAT,
+        'version': PACKED_VERSION,
+        'img_wh': list(img_wh),
+        'num_shards': len(shards),
+        'objects': [obj for objects in shard_objects for obj in objects],
+    }
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+class PackedMVDiffusionDataset(MVDiffusionDatasetV2):
+    r"""
+    `MVDiffusionDatasetV2` reading the shards written by `pack_mvdiffusion_dataset`; `root_dir` is the packed
+    directory. Samples are drawn exactly like `MVDiffusionDatasetV2` does.
+    """
+    def __init__(
+        self,
+        root_dir: str,
+        num_views: int,
+        bg_color: Any,
+        img_wh: Tuple[int, int],
+        validation: bool = False,
+        num_validation_samples: int = 64,
+        num_samples: Optional[int] = None,
+        caption_path: Optional[str] = None,
+        elevation_range_deg: Tuple[float,float] = (-90, 90),
+        azimuth_range_deg: Tuple[float, float] = (0, 360),
+    ):
+        with open(os.path.join(root_dir, 'index.json')) as f:
+            index = json.load(f)
+        if index.get('format') != PACKED_FORMAT or index.get('version') != PACKED_VERSION:
+            raise ValueError(f"{root_dir} does not contain version {PACKED_VERSION} packed shards.")
+        if tuple(index['img_wh']) != tuple(img_wh):
+            raise ValueError(f"The shards in {root_dir} are packed at {index['img_wh']}, but img_wh is {img_wh}.")
+
+        objects = index['objects']
+        if not validation:
+            objects = objects[:-num_validation_samples]
+        else:
+            objects = objects[-num_validation_samples:]
+        if num_samples is not None:
+            objects = objects[:num_samples]
+        self.objects = objects
+        self.all_obj_paths = [obj['obj_path'] for obj in objects]
+        self.all_obj_ids = [obj['obj_id'] for obj in objects]
+        self.root_dir = root_dir
+        self.num_views = num_views
+        self.bg_color = bg_color
+        self.img_wh = img_wh
+        # opened lazily in each DataLoader worker
+        self._shards = {}
+
+    def __getstate__(self):
+        # memory maps would be pickled by value
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = {
+                array: np.load(os.path.join(self.root_dir, _shard_name(shard_id, array)), mmap_mode='r')
+                for array in PACKED_ARRAYS
+            }
+        return self._shards[shard_id]
+
+    def __getitem__(self, index):
+        obj = self.objects[index]
+        cond_view_id, tgt_view_ids = self.sample_view_ids(len(obj['locations']))
+        cond_location = obj['locations'][cond_view_id]
+        tgt_locations = [obj['locations'][view_id] for view_id in tgt_view_ids]
+        camera_params, cond_w2c, tgt_w2cs = self.camera_params(cond_location, tgt_locations)
+
+        shard = self.shard(obj['shard'])
+        # fancy indexing copies just these views out of the memory map
+        view_ids = [obj['offset'] + view_id for view_id in [cond_view_id] + tgt_view_ids]
+        colors = torch.from_numpy(shard['color'][view_ids]).float() / 255. # (1 + Nv, H, W, 3)
+        alphas = torch.from_numpy(shard['alpha'][view_ids]).float() / 255. # (1 + Nv, H, W, 1)
+        normals = img_to_normal(shard['normal'][view_ids[1:]]) # (Nv, H, W, 3)
+
+        # rotate the target normals into the condition camera
+        normals = trans_normals(normals, np.stack(tgt_w2cs), cond_w2c)
+        normals = normal_to_img(normals).float() / 255.
+
+        bg_color = torch.from_numpy(np.asarray(self.get_bg_color(), dtype=np.float32))
+        colors = colors * alphas + bg_color * (1 - alphas)
+        normals = normals * alphas[1:] + bg_color * (1 - alphas[1:])
+
+        img_tensors_in = colors[:1].permute(0, 3, 1, 2).expand(self.num_views, -1, -1, -1) # (Nv, 3, H, W)
+        img_tensors_out = colors[1:].permute(0, 3, 1, 2) # (Nv, 3, H, W)
+        normal_tensors_out = normals.permute(0, 3, 1, 2) # (Nv, 3, H, W)
+
+        return {
+            **camera_params,
+            'imgs_in': img_tensors_in,
+            'imgs_out': img_tensors_out,
+            'normals_out': normal_tensors_out,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root_dir', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--img_wh', type=int, nargs=2, default=[512, 512])
+    parser.add_argument('--objects_per_shard', type=int, default=256)
+    parser.add_argument('--num_workers', type=int, default=1)
+    args = parser.parse_args()
+
+    pack_mvdiffusion_dataset(
+        args.root_dir, args.output_dir, args.img_wh, objects_per_shard=args.objects_per_shard,
+        num_workers=args.num_workers
+    )
@@ -6,24 +6,20 @@ from torch.utils.data import Dataset
 from pathlib import Path
 import json
 from PIL import Image
-from torchvision import transforms
 from einops import rearrange
 from typing import Literal, Tuple, Optional, Any
-import cv2
 import random
 
 import json
 import os, sys
 import math
+import hashlib
 
 from glob import glob
 
 import PIL.Image
 from .normal_utils import trans_normal, normal2img, img2normal
-import pdb
-from icecream import ic
 
-import cv2
 import numpy as np
 
 def add_margin(pil_img, color=0, size=256):
@@ -33,6 +29,8 @@ def add_margin(pil_img, color=0, size=256):
     return result
 
 def scale_and_place_object(image, scale_factor):
+    import cv2
+
     assert np.shape(image)[-1]==4  # RGBA
 
     # Extract the alpha channel (transparency) and the object (RGB channels)
@@ -89,11 +87,15 @@ class SingleImageDataset(Dataset):
         filepaths: Optional[list] = None,
         cond_type: Optional[str] = None,
         prompt_embeds_path: Optional[str] = None,
-        gt_path: Optional[str] = None
+        gt_path: Optional[str] = None,
+        cache_dir: Optional[str] = None
         ) -> None:
         """Create a dataset from a folder of images.
         If you pass in a root directory it will be searched for images
         ending in ext (ext can be a list)
+        Images are only indexed here and preprocessed in `__getitem__`, so DataLoader workers
+        share the decoding. With `cache_dir`, preprocessed tensors are kept on disk, keyed by the
+        file content and the preprocessing settings.
         """
         self.root_dir = root_dir
         self.num_views = num_views
@@ -102,6 +104,7 @@ class SingleImageDataset(Dataset):
         self.bg_color = bg_color
         self.cond_type = cond_type
         self.gt_path = gt_path
+        self.cache_dir = cache_dir
 
         
         if single_image is None:
@@ -113,31 +116,23 @@ class SingleImageDataset(Dataset):
 
             # Filter the files that end with .png or .jpg
             self.file_list = [file for file in file_list if file.endswith(('.png', '.jpg', '.webp'))]
+            self.file_list = self.file_list[:num_validation_samples]
         else:
             self.file_list = None
 
-        # load all images
-        self.all_images = []
-        self.all_alphas = []
-        bg_color = self.get_bg_color()
-
+        # drawn once, so a random background is shared by all images like before
+        self.bg_color_value = self.get_bg_color()
+        self.single_image = None
         if single_image is not None:
-            image, alpha = self.load_image(None, bg_color, return_type='pt', Imagefile=single_image)
-            self.all_images.append(image)
-            self.all_alphas.append(alpha)
-        else:
-            for file in self.file_list:
-                print(os.path.join(self.root_dir, file))
-                image, alpha = self.load_image(os.path.join(self.root_dir, file), bg_color, return_type='pt')
-                self.all_images.append(image)
-                self.all_alphas.append(alpha)
-                
-            
-
-        self.all_images = self.all_images[:num_validation_samples]
-        self.all_alphas = self.all_alphas[:num_validation_samples]
-        ic(len(self.all_images))
+            self.single_image = self.load_image(None, self.bg_color_value, return_type='pt', Imagefile=single_image)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
         
+        if prompt_embeds_path is None:
+            # the caller keeps its own prompt embeddings
+            self.normal_text_embeds = None
+            self.color_text_embeds = None
+            return
         try:
             self.normal_text_embeds = torch.load(f'{prompt_embeds_path}/normal_embeds.pt')
             self.color_text_embeds = torch.load(f'{prompt_embeds_path}/clr_embeds.pt') # 4view
@@ -146,7 +141,9 @@ class SingleImageDataset(Dataset):
             self.normal_text_embeds = None
 
     def __len__(self):
-        return len(self.all_images)
+        if self.file_list is None:
+            return 1
+        return len(self.file_list)
 
     def get_bg_color(self):
         if self.bg_color == 'white':
@@ -204,44 +201,60 @@ class SingleImageDataset(Dataset):
             raise NotImplementedError
         
         return img, alpha
+
+    def cache_path(self, img_path):
+        # a random background differs per dataset, its results are not reusable
+        if self.cache_dir is None or self.bg_color == 'random':
+            return None
+        with open(img_path, 'rb') as f:
+            key = hashlib.sha1(f.read())
+        key.update(f'{self.crop_size}-{self.img_wh[0]}-{self.bg_color}'.encode())
+        return os.path.join(self.cache_dir, f'{key.hexdigest()}.pt')
+
+    def load_cached_image(self, img_path):
+        cache_path = self.cache_path(img_path)
+        if cache_path is not None and os.path.exists(cache_path):
+            cached = torch.load(cache_path)
+            return cached['image'], cached['alpha']
+
+        image, alpha = self.load_image(img_path, self.bg_color_value, return_type='pt')
+        if cache_path is not None:
+            # write then rename, several DataLoader workers may fill the cache at once
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            torch.save({'image': image, 'alpha': alpha}, tmp_path)
+            os.replace(tmp_path, cache_path)
+        return image, alpha
     
 
     def __getitem__(self, index):
-        image = self.all_images[index%len(self.all_images)]
-        alpha = self.all_alphas[index%len(self.all_images)]
         if self.file_list is not None:
-            filename = self.file_list[index%len(self.all_images)].replace(".png", "")
+            file = self.file_list[index%len(self)]
+            image, alpha = self.load_cached_image(os.path.join(self.root_dir, file))
+            filename = file.replace(".png", "")
         else:
+            image, alpha = self.single_image
             filename = 'null'
-        img_tensors_in = [
-            image.permute(2, 0, 1)
-        ] * self.num_views
-
-        alpha_tensors_in = [
-            alpha.permute(2, 0, 1)
-        ] * self.num_views
-
-        img_tensors_in = torch.stack(img_tensors_in, dim=0).float() # (Nv, 3, H, W)
-        alpha_tensors_in = torch.stack(alpha_tensors_in, dim=0).float() # (Nv, 3, H, W)
+        # one conditioning image for all views, consumers `expand` it to (Nv, 3, H, W) without copying
+        img_tensors_in = image.permute(2, 0, 1).float() # (3, H, W)
+        alpha_tensors_in = alpha.permute(2, 0, 1).float() # (1, H, W)
         
         if self.gt_path is not None:
-            gt_image = self.gt_images[index%len(self.all_images)]
-            gt_alpha = self.gt_alpha[index%len(self.all_images)]
-            gt_img_tensors_in = [gt_image.permute(2, 0, 1) ] * self.num_views
-            gt_alpha_tensors_in = [gt_alpha.permute(2, 0, 1) ] * self.num_views
-            gt_img_tensors_in = torch.stack(gt_img_tensors_in, dim=0).float()
-            gt_alpha_tensors_in = torch.stack(gt_alpha_tensors_in, dim=0).float()
+            gt_image = self.gt_images[index%len(self)]
+            gt_alpha = self.gt_alpha[index%len(self)]
+            gt_img_tensors_in = gt_image.permute(2, 0, 1).float()
+            gt_alpha_tensors_in = gt_alpha.permute(2, 0, 1).float()
                 
-        normal_prompt_embeddings = self.normal_text_embeds if hasattr(self, 'normal_text_embeds') else None
-        color_prompt_embeddings = self.color_text_embeds if hasattr(self, 'color_text_embeds') else None
-        
         out =  {
             'imgs_in': img_tensors_in,
             'alphas': alpha_tensors_in,
-            'normal_prompt_embeddings': normal_prompt_embeddings,
-            'color_prompt_embeddings': color_prompt_embeddings,
+            'num_views': self.num_views,
             'filename': filename,
             }
+        # without `prompt_embeds_path` the caller keeps the embeddings, and `None` could not be collated
+        if self.normal_text_embeds is not None:
+            out['normal_prompt_embeddings'] = self.normal_text_embeds
+        if self.color_text_embeds is not None:
+            out['color_prompt_embeddings'] = self.color_text_embeds
             
         return out
 
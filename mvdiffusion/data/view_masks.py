@@ -0,0 +1,84 @@
+"""
+Foreground masks of generated views, without a segmentation network per image.
+
+Era3D generates normals and colors on a known background, and the normal and color image of a view share one
+silhouette. `derive_view_masks` builds one mask per view from both images by thresholding against the background and
+a morphological clean-up, optionally refined by a single batched rembg call on the color views; the same mask is
+then used as the alpha of both domains.
+"""
+from typing import Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def dilate_masks(masks: torch.Tensor, kernel_size: int) -> torch.Tensor:
+    return F.max_pool2d(masks, kernel_size, stride=1, padding=kernel_size // 2)
+
+
+def erode_masks(masks: torch.Tensor, kernel_size: int) -> torch.Tensor:
+    return 1 - dilate_masks(1 - masks, kernel_size)
+
+
+def threshold_masks(
+    normals: torch.Tensor,
+    colors: torch.Tensor,
+    bg_color: Sequence[float] = (1., 1., 1.),
+    tolerance: float = 0.04,
+    kernel_size: int = 5,
+) -> torch.Tensor:
+    r"""
+    `(N, 1, H, W)` binary masks of the pixels that differ from `bg_color` in the normal or the color image.
+
+    Args:
+        normals, colors (`torch.Tensor`):
+            `(N, 3, H, W)` images in [0, 1], view `i` of both domains at index `i`.
+        bg_color (`Sequence[float]`, *optional*, defaults to white):
+            The background the views were generated on.
+        tolerance (`float`, *optional*, defaults to 0.04):
+            The largest per-channel difference from `bg_color` still counted as background, absorbs the noise of
+            the VAE decoder.
+        kernel_size (`int`, *optional*, defaults to 5):
+            The (odd) size of the morphological closing and opening.
+    """
+    bg_color = torch.tensor(bg_color, device=colors.device, dtype=colors.dtype).view(1, 3, 1, 1)
+    # a unit normal never encodes to pure white, so the normals separate white surfaces from a white background
+    foreground = ((colors - bg_color).abs().amax(1, keepdim=True) > tolerance) | \
+        ((normals - bg_color).abs().amax(1, keepdim=True) > tolerance)
+    masks = foreground.float()
+    # closing fills pinholes where both domains happen to match the background, opening removes isolated specks
+    masks = erode_masks(dilate_masks(masks, kernel_size), kernel_size)
+    masks = dilate_masks(erode_masks(masks, kernel_size), kernel_size)
+    return masks
+
+
+def refine_masks_with_rembg(masks: torch.Tensor, colors: torch.Tensor, kernel_size: int = 5) -> torch.Tensor:
+    r"""
+    Soft rembg masks of the color views, in one batched call, restricted to a dilation of the threshold `masks`.
+    """
+    from .background_removal import predict_masks_batch
+
+    images = colors.mul(255).add_(0.5).clamp_(0, 255).permute(0, 2, 3, 1).to("cpu", torch.uint8).numpy()
+    rembg_masks = predict_masks_batch(list(images))
+    rembg_masks = torch.from_numpy(np.stack([np.asarray(mask) for mask in rembg_masks]))
+    rembg_masks = rembg_masks.to(device=masks.device, dtype=masks.dtype).unsqueeze(1) / 255.
+    return rembg_masks * dilate_masks(masks, 3 * kernel_size)
+
+
+def derive_view_masks(
+    normals: torch.Tensor,
+    colors: torch.Tensor,
+    refine: bool = False,
+    bg_color: Sequence[float] = (1., 1., 1.),
+    tolerance: float = 0.04,
+    kernel_size: int = 5,
+) -> torch.Tensor:
+    r"""
+    One `(N, 1, H, W)` mask in [0, 1] per view, shared by its normal and color image; see `threshold_masks`. With
+    `refine`, rembg segments the N color views in one call (instead of 2N separate calls on both domains).
+    """
+    masks = threshold_masks(normals, colors, bg_color=bg_color, tolerance=tolerance, kernel_size=kernel_size)
+    if refine:
+        masks = refine_masks_with_rembg(masks, colors, kernel_size=kernel_size)
+    return masks
@@ -0,0 +1,324 @@
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from diffusers.models.attention_processor import Attention, AttnProcessor, AttnProcessor2_0, XFormersAttnProcessor
+from diffusers.utils import logging
+from diffusers.utils.import_utils import is_xformers_available
+
+if is_xformers_available():
+    import xformers
+    import xformers.ops
+else:
+    xformers = None
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# name -> kernel(attn, query, key, value, attention_mask) working on `(batch * heads, tokens, head_dim)` tensors
+ATTENTION_BACKENDS: Dict[str, Callable] = {}
+_BACKEND_IS_AVAILABLE: Dict[str, Callable[[], bool]] = {}
+
+# query tokens per block for the blockwise backend
+ATTENTION_BLOCK_SIZE = 1024
+
+# set while tracing the attention shapes of a model, see `autotune_attention_backends`
+_traced_shapes = None
+
+
+def register_attention_backend(name: str, is_available: Optional[Callable[[], bool]] = None):
+    def decorator(fn):
+        ATTENTION_BACKENDS[name] = fn
+        _BACKEND_IS_AVAILABLE[name] = is_available if is_available is not None else (lambda: True)
+        return fn
+
+    return decorator
+
+
+def available_attention_backends() -> List[str]:
+    return [name for name in ATTENTION_BACKENDS if _BACKEND_IS_AVAILABLE[name]()]
+
+
+@register_attention_backend("eager")
+def eager_attention(attn: Attention, query, key, value, attention_mask=None):
+    attention_probs = attn.get_attention_scores(query, key, attention_mask)
+    return torch.bmm(attention_probs, value)
+
+
+@register_attention_backend("sdpa", is_available=lambda: hasattr(F, "scaled_dot_product_attention"))
+def sdpa_attention(attn: Attention, query, key, value, attention_mask=None):
+    if attention_mask is not None:
+        attention_mask = attention_mask.unsqueeze(1).to(query.dtype)
+    # the fused kernels expect `(batch, heads, tokens, head_dim)`
+    hidden_states = F.scaled_dot_product_attention(
+        query.unsqueeze(1), key.unsqueeze(1), value.unsqueeze(1),
+        attn_mask=attention_mask, dropout_p=0.0, is_causal=False, scale=attn.scale
+    )
+    return hidden_states.squeeze(1)
+
+
+@register_attention_backend("xformers", is_available=lambda: xformers is not None and torch.cuda.is_available())
+def xformers_attention(attn: Attention, query, key, value, attention_mask=None):
+    if attention_mask is not None:
+        # xformers doesn't broadcast the singleton query_tokens dimension
+        attention_mask = attention_mask.expand(-1, query.shape[1], -1)
+    return xformers.ops.memory_efficient_attention(
+        query.contiguous(), key.contiguous(), value.contiguous(), attn_bias=attention_mask, scale=attn.scale
+    )
+
+
+@register_attention_backend("blockwise")
+def blockwise_attention(attn: Attention, query, key, value, attention_mask=None):
+    # eager attention over blocks of query tokens, bounds the size of the score matrix
+    hidden_states = torch.empty(
+        query.shape[0], query.shape[1], value.shape[-1], device=query.device, dtype=query.dtype
+    )
+    for start_idx in range(0, query.shape[1], ATTENTION_BLOCK_SIZE):
+        end_idx = start_idx + ATTENTION_BLOCK_SIZE
+        mask_slice = attention_mask
+        if attention_mask is not None and attention_mask.shape[1] != 1:
+            mask_slice = attention_mask[:, start_idx:end_idx]
+        attention_probs = attn.get_attention_scores(query[:, start_idx:end_idx], key, mask_slice)
+        hidden_states[:, start_idx:end_idx] = torch.bmm(attention_probs, value)
+    return hidden_states
+
+
+def dispatch_attention(backend: str, attn: Attention, query, key, value, attention_mask=None):
+    if _traced_shapes is not None and attn not in _traced_shapes:
+        _traced_shapes[attn] = (
+            tuple(query.shape), tuple(key.shape), tuple(value.shape), query.dtype, query.device,
+            attention_mask is not None,
+        )
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {backend}, choose from {list(ATTENTION_BACKENDS.keys())}.")
+    fn = ATTENTION_BACKENDS[backend]
+
+    # set per layer by `set_attention_slice` of the multiview attention modules
+    slice_size = getattr(attn, "attention_slice_size", None)
+    batch_size_attention = query.shape[0]
+    if slice_size is None or slice_size >= batch_size_attention:
+        return fn(attn, query, key, value, attention_mask)
+
+    # sliced attention: attend `slice_size` entries of the `batch * heads` dimension at a time
+    hidden_states = torch.empty(
+        batch_size_attention, query.shape[1], value.shape[-1], device=query.device, dtype=query.dtype
+    )
+    for start_idx in range(0, batch_size_attention, slice_size):
+        end_idx = start_idx + slice_size
+        mask_slice = attention_mask[start_idx:end_idx] if attention_mask is not None else None
+        hidden_states[start_idx:end_idx] = fn(
+            attn, query[start_idx:end_idx], key[start_idx:end_idx], value[start_idx:end_idx], mask_slice
+        )
+    return hidden_states
+
+
+class BackendAttnProcessor:
+    r"""
+    Default processor for performing attention-related computations with a registered attention backend.
+    """
+
+    def __init__(self, backend="eager"):
+        self.backend = backend
+
+    def __call__(
+        self,
+        attn: Attention,
+        hidden_states,
+        encoder_hidden_states=None,
+        attention_mask=None,
+        temb=None,
+    ):
+        residual = hidden_states
+
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = (
+            hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+        )
+        attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
+        hidden_states = attn.batch_to_head_dim(hidden_states)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+
+        return hidden_states
+
+
+# stock diffusers processors that `BackendAttnProcessor` can replace without changing results
+_STOCK_PROCESSOR_BACKENDS = {
+    AttnProcessor: "eager",
+    AttnProcessor2_0: "sdpa",
+    XFormersAttnProcessor: "xformers",
+}
+
+
+def _backend_attention_layers(model: torch.nn.Module) -> Dict[str, Attention]:
+    r"""
+    Returns the attention layers of `model` whose processor dispatches through the backend registry. Layers still
+    using a stock diffusers processor are switched to the equivalent `BackendAttnProcessor` on the way.
+    """
+    layers = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, Attention):
+            continue
+        processor = module.processor
+        if type(processor) in _STOCK_PROCESSOR_BACKENDS:
+            module.set_processor(BackendAttnProcessor(_STOCK_PROCESSOR_BACKENDS[type(processor)]))
+        if hasattr(module.processor, "backend"):
+            layers[name] = module
+    return layers
+
+
+def set_attention_backend(model: torch.nn.Module, backend: str):
+    r"""
+    Pins `backend` for every attention layer of `model`.
+    """
+    if backend not in available_attention_backends():
+        raise ValueError(
+            f"Attention backend {backend} is not available, choose from {available_attention_backends()}."
+        )
+    for module in _backend_attention_layers(model).values():
+        module.processor.backend = backend
+
+
+def _device_name(device: torch.device) -> str:
+    if device.type == "cuda":
+        return torch.cuda.get_device_name(device)
+    return device.type
+
+
+def _time_backend(backend, attn, query, key, value, num_warmup, num_repeats):
+    fn = ATTENTION_BACKENDS[backend]
+    try:
+        for _ in range(num_warmup):
+            fn(attn, query, key, value)
+        if query.is_cuda:
+            torch.cuda.synchronize(query.device)
+        start = time.perf_counter()
+        for _ in range(num_repeats):
+            fn(attn, query, key, value)
+        if query.is_cuda:
+            torch.cuda.synchronize(query.device)
+    except (RuntimeError, NotImplementedError, ValueError) as e:
+        # unsupported shape / dtype or out of memory
+        logger.info(f"attention backend {backend} failed for query {tuple(query.shape)}: {e}")
+        return float("inf")
+    return (time.perf_counter() - start) / num_repeats
+
+
+@torch.no_grad()
+def autotune_attention_backends(
+    model: torch.nn.Module,
+    forward_fn: Callable[[], None],
+    backends: Optional[List[str]] = None,
+    cache_path: Optional[str] = None,
+    num_warmup: int = 2,
+    num_repeats: int = 5,
+) -> Dict[str, str]:
+    r"""
+    Times every backend for each distinct attention shape of `model` and pins the fastest one per layer.
+
+    Args:
+        model (`torch.nn.Module`):
+            The model to tune, usually the UNet.
+        forward_fn (`Callable`):
+            Runs `model` once on representative inputs; used to trace the attention shapes.
+        backends (`List[str]`, *optional*):
+            The candidates, defaults to all available backends.
+        cache_path (`str`, *optional*):
+            A json file keeping the winners keyed by device, dtype and shape, so the timing only happens once per
+            machine.
+
+    Returns:
+        `dict` mapping the attention layer names to their pinned backend.
+    """
+    global _traced_shapes
+
+    available = available_attention_backends()
+    backends = available if backends is None else [b for b in backends if b in available]
+    if len(backends) == 0:
+        raise ValueError(f"None of the requested attention backends is available, choose from {available}.")
+
+    layers = _backend_attention_layers(model)
+
+    _traced_shapes = {}
+    try:
+        forward_fn()
+        traced_shapes = _traced_shapes
+    finally:
+        _traced_shapes = None
+
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    pinned = {}
+    for name, module in layers.items():
+        if module not in traced_shapes:
+            continue
+        query_shape, key_shape, value_shape, dtype, device, has_mask = traced_shapes[module]
+        if has_mask:
+            # masked attention keeps its current backend
+            continue
+        cache_key = f"{_device_name(device)}|{dtype}|{query_shape}|{key_shape}|{value_shape}"
+        if cache_key not in cache or cache[cache_key]["backend"] not in backends:
+            query = torch.randn(query_shape, device=device, dtype=dtype)
+            key = torch.randn(key_shape, device=device, dtype=dtype)
+            value = torch.randn(value_shape, device=device, dtype=dtype)
+            timings = {
+                backend: _time_backend(backend, module, query, key, value, num_warmup, num_repeats)
+                for backend in backends
+            }
+            best = min(timings, key=timings.get)
+            cache[cache_key] = {"backend": best, "timings_ms": {k: v * 1000 for k, v in timings.items()}}
+            logger.info(f"attention {cache_key}: {best} ({timings[best] * 1000:.3f} ms)")
+        module.processor.backend = cache[cache_key]["backend"]
+        pinned[name] = module.processor.backend
+
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(cache, f, indent=2)
+
+    return pinned
@@ -33,6 +33,8 @@ import pdb
 import random
 import math
 
+from .attention_backends import BackendAttnProcessor, dispatch_attention
+
 
 if is_xformers_available():
     import xformers
@@ -308,8 +310,10 @@ class TransformerMV2DModel(ModelMixin, ConfigMixin):
                 hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(batch, height * width, inner_dim)
                 hidden_states = self.proj_in(hidden_states)
         elif self.is_input_vectorized:
+            height, width = self.height, self.width
             hidden_states = self.latent_image_embedding(hidden_states)
         elif self.is_input_patches:
+            height, width = hidden_states.shape[-2] // self.patch_size, hidden_states.shape[-1] // self.patch_size
             hidden_states = self.pos_embed(hidden_states)
 
         # 2. Blocks
@@ -322,6 +326,8 @@ class TransformerMV2DModel(ModelMixin, ConfigMixin):
                 timestep=timestep,
                 cross_attention_kwargs=cross_attention_kwargs,
                 class_labels=class_labels,
+                height=height,
+                width=width,
             )
 
         # 3. Output
@@ -535,6 +541,8 @@ class BasicMVTransformerBlock(nn.Module):
         timestep: Optional[torch.LongTensor] = None,
         cross_attention_kwargs: Dict[str, Any] = None,
         class_labels: Optional[torch.LongTensor] = None,
+        height: Optional[int] = None,
+        width: Optional[int] = None,
     ):
         assert attention_mask is None # not supported yet
         # Notice that normalization is always applied before the real computation in the following blocks.
@@ -557,6 +565,8 @@ class BasicMVTransformerBlock(nn.Module):
             multiview_attention=self.multiview_attention,
             mvcd_attention=self.mvcd_attention,
             num_views=self.num_views,
+            height=height,
+            width=width,
             **cross_attention_kwargs,
         )
 
@@ -621,6 +631,21 @@ class BasicMVTransformerBlock(nn.Module):
     
 
 class CustomAttention(Attention):
+    # number of `batch * heads` entries attended at once, `None` for all; kept per layer, processors can be shared
+    attention_slice_size = None
+
+    def set_attention_slice(self, slice_size):
+        # keep the multiview processor, only change how many rows it attends at once
+        if slice_size is not None and slice_size > self.sliceable_head_dim:
+            raise ValueError(f"slice_size {slice_size} has to be smaller or equal to {self.sliceable_head_dim}.")
+        sliceable = (MVAttnProcessor, XFormersMVAttnProcessor, BackendAttnProcessor)
+        if slice_size is not None and not isinstance(self.processor, sliceable):
+            raise ValueError(
+                f"{type(self.processor).__name__} does not support sliced attention, set a multiview processor"
+                f" or an attention backend first."
+            )
+        self.attention_slice_size = slice_size
+
     def set_use_memory_efficient_attention_xformers(
         self, use_memory_efficient_attention_xformers: bool, *args, **kwargs
     ):
@@ -630,6 +655,21 @@ class CustomAttention(Attention):
 
 
 class CustomJointAttention(Attention):
+    # number of `batch * heads` entries attended at once, `None` for all; kept per layer, processors can be shared
+    attention_slice_size = None
+
+    def set_attention_slice(self, slice_size):
+        # keep the multiview processor, only change how many rows it attends at once
+        if slice_size is not None and slice_size > self.sliceable_head_dim:
+            raise ValueError(f"slice_size {slice_size} has to be smaller or equal to {self.sliceable_head_dim}.")
+        sliceable = (JointAttnProcessor, XFormersJointAttnProcessor, BackendAttnProcessor)
+        if slice_size is not None and not isinstance(self.processor, sliceable):
+            raise ValueError(
+                f"{type(self.processor).__name__} does not support sliced attention, set a multiview processor"
+                f" or an attention backend first."
+            )
+        self.attention_slice_size = slice_size
+
     def set_use_memory_efficient_attention_xformers(
         self, use_memory_efficient_attention_xformers: bool, *args, **kwargs
     ):
@@ -642,6 +682,9 @@ class MVAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="eager"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -650,7 +693,9 @@ class MVAttnProcessor:
         attention_mask=None,
         temb=None,
         num_views=1,
-        multiview_attention=True
+        multiview_attention=True,
+        height=None,
+        width=None,
     ):
         residual = hidden_states
 
@@ -666,7 +711,15 @@ class MVAttnProcessor:
         batch_size, sequence_length, _ = (
             hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
         )
-        height = int(math.sqrt(sequence_length)) 
+        if height is None or width is None:
+            # no spatial size given, assume square latents
+            height = int(math.sqrt(sequence_length))
+            width = sequence_length // height
+        if height * width != sequence_length:
+            raise ValueError(
+                f"Row-wise attention got `height` {height} and `width` {width}, which do not match the sequence length"
+                f" {sequence_length}. Make sure to pass the latent size of this level to the attention processor."
+            )
         attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
 
         if attn.group_norm is not None:
@@ -694,8 +747,7 @@ class MVAttnProcessor:
         key = attn.head_to_batch_dim(key).contiguous()
         value = attn.head_to_batch_dim(value).contiguous()
         
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -719,6 +771,9 @@ class XFormersMVAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="xformers"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -729,6 +784,8 @@ class XFormersMVAttnProcessor:
         num_views=1,
         multiview_attention=True,
         mvcd_attention=False,
+        height=None,
+        width=None,
     ):
         residual = hidden_states
 
@@ -744,7 +801,15 @@ class XFormersMVAttnProcessor:
         batch_size, sequence_length, _ = (
             hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
         )
-        height = int(math.sqrt(sequence_length)) 
+        if height is None or width is None:
+            # no spatial size given, assume square latents
+            height = int(math.sqrt(sequence_length))
+            width = sequence_length // height
+        if height * width != sequence_length:
+            raise ValueError(
+                f"Row-wise attention got `height` {height} and `width` {width}, which do not match the sequence length"
+                f" {sequence_length}. Make sure to pass the latent size of this level to the attention processor."
+            )
         attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
         # from yuancheng; here attention_mask is None
         if attention_mask is not None:
@@ -791,7 +856,7 @@ class XFormersMVAttnProcessor:
         key = attn.head_to_batch_dim(key)
         value = attn.head_to_batch_dim(value)
 
-        hidden_states = xformers.ops.memory_efficient_attention(query, key, value, attn_bias=attention_mask)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -816,6 +881,9 @@ class XFormersJointAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="xformers"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -880,7 +948,7 @@ class XFormersJointAttnProcessor:
         key = attn.head_to_batch_dim(key).contiguous()
         value = attn.head_to_batch_dim(value).contiguous()
 
-        hidden_states = xformers.ops.memory_efficient_attention(query, key, value, attn_bias=attention_mask)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -904,6 +972,9 @@ class JointAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="eager"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -958,8 +1029,7 @@ class JointAttnProcessor:
         key = attn.head_to_batch_dim(key).contiguous()
         value = attn.head_to_batch_dim(value).contiguous()
 
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
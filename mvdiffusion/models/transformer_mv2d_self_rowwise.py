@@ -33,6 +33,8 @@ import pdb
 import random
 import math
 
+from .attention_backends import BackendAttnProcessor, dispatch_attention
+
 
 if is_xformers_available():
     import xformers
@@ -311,8 +313,10 @@ class TransformerMV2DModel(ModelMixin, ConfigMixin):
                 hidden_states = hidden_states.permute(0, 2, 3, 1).reshape(batch, height * width, inner_dim)
                 hidden_states = self.proj_in(hidden_states)
         elif self.is_input_vectorized:
+            height, width = self.height, self.width
             hidden_states = self.latent_image_embedding(hidden_states)
         elif self.is_input_patches:
+            height, width = hidden_states.shape[-2] // self.patch_size, hidden_states.shape[-1] // self.patch_size
             hidden_states = self.pos_embed(hidden_states)
 
         # 2. Blocks
@@ -326,6 +330,8 @@ class TransformerMV2DModel(ModelMixin, ConfigMixin):
                 timestep=timestep,
                 cross_attention_kwargs=cross_attention_kwargs,
                 class_labels=class_labels,
+                height=height,
+                width=width,
             )
 
         # 3. Output
@@ -554,7 +560,9 @@ class BasicMVTransformerBlock(nn.Module):
         timestep: Optional[torch.LongTensor] = None,
         cross_attention_kwargs: Dict[str, Any] = None,
         class_labels: Optional[torch.LongTensor] = None,
-        dino_feature: Optional[torch.FloatTensor] = None
+        dino_feature: Optional[torch.FloatTensor] = None,
+        height: Optional[int] = None,
+        width: Optional[int] = None,
     ):
         assert attention_mask is None # not supported yet
         # Notice that normalization is always applied before the real computation in the following blocks.
@@ -597,6 +605,8 @@ class BasicMVTransformerBlock(nn.Module):
                 num_views=self.num_views,
                 multiview_attention=self.multiview_attention,
                 cd_attention_mid=self.cd_attention_mid,
+                height=height,
+                width=width,
                 **cross_attention_kwargs,
                 )
             hidden_states = attn_output + hidden_states 
@@ -646,6 +656,21 @@ class BasicMVTransformerBlock(nn.Module):
     
 
 class CustomAttention(Attention):
+    # number of `batch * heads` entries attended at once, `None` for all; kept per layer, processors can be shared
+    attention_slice_size = None
+
+    def set_attention_slice(self, slice_size):
+        # keep the multiview processor, only change how many rows it attends at once
+        if slice_size is not None and slice_size > self.sliceable_head_dim:
+            raise ValueError(f"slice_size {slice_size} has to be smaller or equal to {self.sliceable_head_dim}.")
+        sliceable = (MVAttnProcessor, XFormersMVAttnProcessor, BackendAttnProcessor)
+        if slice_size is not None and not isinstance(self.processor, sliceable):
+            raise ValueError(
+                f"{type(self.processor).__name__} does not support sliced attention, set a multiview processor"
+                f" or an attention backend first."
+            )
+        self.attention_slice_size = slice_size
+
     def set_use_memory_efficient_attention_xformers(
         self, use_memory_efficient_attention_xformers: bool, *args, **kwargs
     ):
@@ -655,6 +680,21 @@ class CustomAttention(Attention):
 
 
 class CustomJointAttention(Attention):
+    # number of `batch * heads` entries attended at once, `None` for all; kept per layer, processors can be shared
+    attention_slice_size = None
+
+    def set_attention_slice(self, slice_size):
+        # keep the multiview processor, only change how many rows it attends at once
+        if slice_size is not None and slice_size > self.sliceable_head_dim:
+            raise ValueError(f"slice_size {slice_size} has to be smaller or equal to {self.sliceable_head_dim}.")
+        sliceable = (JointAttnProcessor, XFormersJointAttnProcessor, BackendAttnProcessor)
+        if slice_size is not None and not isinstance(self.processor, sliceable):
+            raise ValueError(
+                f"{type(self.processor).__name__} does not support sliced attention, set a multiview processor"
+                f" or an attention backend first."
+            )
+        self.attention_slice_size = slice_size
+
     def set_use_memory_efficient_attention_xformers(
         self, use_memory_efficient_attention_xformers: bool, *args, **kwargs
     ):
@@ -667,6 +707,9 @@ class MVAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="eager"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -675,7 +718,10 @@ class MVAttnProcessor:
         attention_mask=None,
         temb=None,
         num_views=1,
-        cd_attention_mid=False
+        multiview_attention=True,
+        cd_attention_mid=False,
+        height=None,
+        width=None,
     ):
         residual = hidden_states
 
@@ -691,7 +737,15 @@ class MVAttnProcessor:
         batch_size, sequence_length, _ = (
             hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
         )
-        height = int(math.sqrt(sequence_length)) 
+        if height is None or width is None:
+            # no spatial size given, assume square latents
+            height = int(math.sqrt(sequence_length))
+            width = sequence_length // height
+        if height * width != sequence_length:
+            raise ValueError(
+                f"Row-wise attention got `height` {height} and `width` {width}, which do not match the sequence length"
+                f" {sequence_length}. Make sure to pass the latent size of this level to the attention processor."
+            )
         attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
 
         if attn.group_norm is not None:
@@ -731,8 +785,7 @@ class MVAttnProcessor:
         key = attn.head_to_batch_dim(key).contiguous()
         value = attn.head_to_batch_dim(value).contiguous()
         
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -762,6 +815,9 @@ class XFormersMVAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="xformers"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -771,7 +827,9 @@ class XFormersMVAttnProcessor:
         temb=None,
         num_views=1,
         multiview_attention=True,
-        cd_attention_mid=False
+        cd_attention_mid=False,
+        height=None,
+        width=None,
     ):
         # print(num_views)
         residual = hidden_states
@@ -788,7 +846,15 @@ class XFormersMVAttnProcessor:
         batch_size, sequence_length, _ = (
             hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
         )
-        height = int(math.sqrt(sequence_length)) 
+        if height is None or width is None:
+            # no spatial size given, assume square latents
+            height = int(math.sqrt(sequence_length))
+            width = sequence_length // height
+        if height * width != sequence_length:
+            raise ValueError(
+                f"Row-wise attention got `height` {height} and `width` {width}, which do not match the sequence length"
+                f" {sequence_length}. Make sure to pass the latent size of this level to the attention processor."
+            )
         attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
         # from yuancheng; here attention_mask is None
         if attention_mask is not None:
@@ -839,7 +905,7 @@ class XFormersMVAttnProcessor:
         key = attn.head_to_batch_dim(key)
         value = attn.head_to_batch_dim(value)
 
-        hidden_states = xformers.ops.memory_efficient_attention(query, key, value, attn_bias=attention_mask)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -870,6 +936,9 @@ class XFormersJointAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="xformers"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -935,7 +1004,7 @@ class XFormersJointAttnProcessor:
         key = attn.head_to_batch_dim(key).contiguous()
         value = attn.head_to_batch_dim(value).contiguous()
 
-        hidden_states = xformers.ops.memory_efficient_attention(query, key, value, attn_bias=attention_mask)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         # linear proj
@@ -961,6 +1030,9 @@ class JointAttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, backend="eager"):
+        self.backend = backend
+
     def __call__(
         self,
         attn: Attention,
@@ -1016,8 +1088,7 @@ class JointAttnProcessor:
         key = attn.head_to_batch_dim(key).contiguous()
         value = attn.head_to_batch_dim(value).contiguous()
 
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
+        hidden_states = dispatch_attention(self.backend, attn, query, key, value, attention_mask)
         hidden_states = attn.batch_to_head_dim(hidden_states)
 
         
@@ -1026,7 +1097,8 @@ class JointAttnProcessor:
         # dropout
         hidden_states = attn.to_out[1](hidden_states)
 
-        hidden_states = torch.cat([hidden_states[:, 0], hidden_states[:, 1]], dim=0)  # 2bv hw c
+        hidden_states_normal, hidden_states_color = torch.chunk(hidden_states, dim=1, chunks=2)
+        hidden_states = torch.cat([hidden_states_normal, hidden_states_color], dim=0)  # 2bv hw c
         if input_ndim == 4:
             hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
 
@@ -55,11 +55,15 @@ from diffusers.utils import (
     is_torch_version,
     logging,
 )
-from diffusers.utils.import_utils import is_accelerate_available 
+from diffusers.utils.import_utils import is_accelerate_available
 from diffusers.utils.hub_utils import HF_HUB_OFFLINE
 from huggingface_hub.constants import HUGGINGFACE_HUB_CACHE
 DIFFUSERS_CACHE = HUGGINGFACE_HUB_CACHE
 
+if is_accelerate_available():
+    import accelerate
+    from accelerate.utils import set_module_tensor_to_device
+
 from diffusers import __version__
 from .unet_mv2d_blocks import (
     CrossAttnDownBlockMV2D,
@@ -82,6 +86,67 @@ from mvdiffusion.models.unet_mv2d_blocks import (
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+# parameters zero-initialized by the constructors, a no-op on the meta device so they are zeroed on materialization
+_ZERO_INIT_PARAMETERS = (
+    "attn_mv.to_out.0.weight",
+    "attn_joint.to_out.0.weight",
+    "attn_joint_twice.to_out.0.weight",
+    "attn_joint_last.to_out.0.weight",
+    "attn_joint_mid.to_out.0.weight",
+    "addition_conv_out.weight",
+)
+
+
+def load_state_dict_mmap(checkpoint_file: Union[str, os.PathLike], variant: Optional[str] = None):
+    r"""
+    Reads a checkpoint without staging a second copy: safetensors files are read through their memory map and torch
+    pickles are loaded with `mmap=True`, so the tensors can be handed to a meta-device model as they are.
+    """
+    if not str(checkpoint_file).endswith(".safetensors"):
+        try:
+            return torch.load(checkpoint_file, map_location="cpu", mmap=True, weights_only=True)
+        except RuntimeError:
+            # legacy (non-zipfile) checkpoints can't be memory-mapped
+            pass
+    return load_state_dict(checkpoint_file, variant=variant)
+
+
+def _load_state_dict_into_meta_model_2d(model: nn.Module, state_dict: Dict[str, torch.Tensor]) -> List[str]:
+    r"""
+    Loads `state_dict` into a model built on the meta device. Tensors the checkpoint does not provide are allocated
+    on the cpu and initialized like `from_config` would: `reset_parameters` of their module, or zeros for
+    `_ZERO_INIT_PARAMETERS`.
+    """
+    error_msgs = []
+    model_state_dict = model.state_dict()
+    for key, value in state_dict.items():
+        if key not in model_state_dict:
+            continue
+        if value.shape != model_state_dict[key].shape:
+            error_msgs.append(
+                f"size mismatch for {key}: copying a param with shape {value.shape} from checkpoint, the shape in"
+                f" current model is {model_state_dict[key].shape}."
+            )
+            continue
+        set_module_tensor_to_device(model, key, "cpu", value=value)
+
+    for module_name, module in model.named_modules():
+        tensors = list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False))
+        if not any(tensor.is_meta for _, tensor in tensors):
+            continue
+        loaded = {name: tensor for name, tensor in tensors if not tensor.is_meta}
+        module.to_empty(device="cpu", recurse=False)
+        if hasattr(module, "reset_parameters"):
+            module.reset_parameters()
+        with torch.no_grad():
+            for name, tensor in tensors:
+                full_name = f"{module_name}.{name}" if module_name else name
+                if name in loaded:
+                    getattr(module, name).copy_(loaded[name])
+                elif full_name.endswith(_ZERO_INIT_PARAMETERS):
+                    getattr(module, name).zero_()
+    return error_msgs
+
 
 @dataclass
 class UNetMV2DConditionOutput(BaseOutput):
@@ -1384,11 +1449,7 @@ class UNetMV2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixi
         offload_state_dict = kwargs.pop("offload_state_dict", False)
         variant = kwargs.pop("variant", None)
         use_safetensors = kwargs.pop("use_safetensors", None)
-
-        if use_safetensors:
-            raise ValueError(
-                "`use_safetensors`=True but safetensors is not installed. Please install safetensors with `pip install safetensors"
-            )
+        low_cpu_mem_usage = kwargs.pop("low_cpu_mem_usage", is_accelerate_available())
 
         allow_pickle = False
         if use_safetensors is None:
@@ -1401,6 +1462,15 @@ class UNetMV2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixi
                 " `device_map=None`. You can install accelerate with `pip install accelerate`."
             )
 
+        if low_cpu_mem_usage and not is_accelerate_available():
+            low_cpu_mem_usage = False
+            logger.warning(
+                "Cannot initialize model with low cpu memory usage because `accelerate` was not found in the"
+                " environment. Defaulting to `low_cpu_mem_usage=False`. It is strongly recommended to install"
+                " `accelerate` for faster and less memory-intense model loading. You can do so with: \n```\npip"
+                " install accelerate\n```\n."
+            )
+
         # Check if we can handle device_map and dispatching the weights
         if device_map is not None and not is_torch_version(">=", "1.9.0"):
             raise NotImplementedError(
@@ -1512,21 +1582,27 @@ class UNetMV2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixi
                     commit_hash=commit_hash,
                 )
 
-            model = cls.from_config(config, **unused_kwargs)
-            import copy
-            state_dict_pretrain = load_state_dict(model_file, variant=variant)
-            state_dict = copy.deepcopy(state_dict_pretrain)
+            if low_cpu_mem_usage:
+                # skip the random init, the weights are materialized while loading the checkpoint
+                with accelerate.init_empty_weights():
+                    model = cls.from_config(config, **unused_kwargs)
+            else:
+                model = cls.from_config(config, **unused_kwargs)
+            state_dict_pretrain = load_state_dict_mmap(model_file, variant=variant)
+            # shallow copy, the tensors themselves are never modified in place
+            state_dict = dict(state_dict_pretrain)
             
             if init_mvattn_with_selfattn:
+                # copies: the meta-device loader keeps the tensors it is given, shared ones would train as tied weights
                 for key in state_dict_pretrain:
                     if 'attn1' in key:
                         key_mv = key.replace('attn1', 'attn_mv')
-                        state_dict[key_mv] = state_dict_pretrain[key]
+                        state_dict[key_mv] = state_dict_pretrain[key].clone()
                         if 'to_out.0.weight' in key:
-                            nn.init.zeros_(state_dict[key_mv].data)
+                            state_dict[key_mv] = torch.zeros_like(state_dict_pretrain[key])
                     if 'transformer_blocks' in key and 'norm1' in key: # in case that initialize the norm layer in resnet block
                         key_mv = key.replace('norm1', 'norm_mv')
-                        state_dict[key_mv] = state_dict_pretrain[key]
+                        state_dict[key_mv] = state_dict_pretrain[key].clone()
             # del state_dict_pretrain
             
             model._convert_deprecated_attention_blocks(state_dict)
@@ -1539,6 +1615,7 @@ class UNetMV2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixi
                 model_file,
                 pretrained_model_name_or_path,
                 ignore_mismatched_sizes=True,
+                low_cpu_mem_usage=low_cpu_mem_usage,
             )
             if any([key == 'conv_in.weight' for key, _, _ in mismatched_keys]):
                 # initialize from the original SD structure
@@ -1588,6 +1665,7 @@ class UNetMV2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixi
         resolved_archive_file,
         pretrained_model_name_or_path,
         ignore_mismatched_sizes=False,
+        low_cpu_mem_usage=False,
     ):
         # Retrieve missing & unexpected_keys
         model_state_dict = model.state_dict()
@@ -1632,7 +1710,10 @@ class UNetMV2DConditionModel(ModelMixin, ConfigMixin, UNet2DConditionLoadersMixi
                 original_loaded_keys,
                 ignore_mismatched_sizes,
             )
-            error_msgs = _load_state_dict_into_model(model_to_load, state_dict)
+            if low_cpu_mem_usage:
+                error_msgs = _load_state_dict_into_meta_model_2d(model_to_load, state_dict)
+            else:
+                error_msgs = _load_state_dict_into_model(model_to_load, state_dict)
 
         if len(error_msgs) > 0:
             error_msg = "\n\t".join(error_msgs)
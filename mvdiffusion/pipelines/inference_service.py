@@ -0,0 +1,596 @@
+"""
+Headless HTTP inference service around `StableUnCLIPImg2ImgPipeline`.
+
+Requests go into a bounded queue and are served by `max_concurrency` workers sharing the weights of one pipeline.
+A worker groups queued requests with the same guidance scale and number of steps into one pipeline call of up to
+`max_batch_size` images, waiting at most `batch_wait_ms` for the batch to fill. Every request has a timeout and can
+be cancelled while queued or running; a running batch stops at the next denoising step once none of its requests
+is still wanted.
+
+    python -m mvdiffusion.pipelines.inference_service --config configs/test_unclip-512-6view.yaml --port 8000 \
+        --max_batch_size 4 --batch_wait_ms 20
+    # random weights on the cpu, exercises the queueing, batching and endpoints locally
+    python -m mvdiffusion.pipelines.inference_service --tiny --port 8000
+
+    POST   /generate        {"image": <base64 png, rgba with the background removed>, "guidance_scale": 3.0,
+                             "num_inference_steps": 40, "seed": 42, "crop_size": 420, "timeout_s": 300}
+                            -> {"id": ..., "views": [...], "colors": [<base64 png>, ...], "normals": [...]}
+    DELETE /requests/<id>   cancels a queued or running request, the id is also sent as `X-Request-Id`
+    GET    /healthz         200 once the workers are running
+    GET    /metrics         counters and gauges in the Prometheus text format
+"""
+import argparse
+import base64
+import copy
+import io
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
+
+VIEWS = {
+    4: ['front', 'right', 'back', 'left'],
+    6: ['front', 'front_right', 'right', 'back', 'left', 'front_left'],
+    8: ['front', 'front_right', 'right', 'back_right', 'back', 'back_left', 'left', 'front_left'],
+}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+@dataclass
+class GenerationRequest:
+    image: torch.Tensor  # (3, H, W) in [0, 1]
+    guidance_scale: float
+    num_inference_steps: int
+    seed: int
+    deadline: float  # time.monotonic()
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    future: Future = field(default_factory=Future)
+    enqueued: float = field(default_factory=time.monotonic)
+    _cancelled: threading.Event = field(default_factory=threading.Event)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def batch_key(self):
+        # requests agreeing on these can share one pipeline call
+        return (self.guidance_scale, self.num_inference_steps)
+
+    def expired(self) -> bool:
+        return time.monotonic() > self.deadline
+
+    def abandoned(self) -> bool:
+        return self._cancelled.is_set() or self.expired()
+
+    def resolve(self, result=None, exception: Optional[Exception] = None) -> bool:
+        # the worker, the http handler and the queue sweep race to finish a request, the first one wins
+        with self._lock:
+            if self.future.done():
+                return False
+            if exception is not None:
+                self.future.set_exception(exception)
+            else:
+                self.future.set_result(result)
+            return True
+
+    def cancel(self) -> bool:
+        self._cancelled.set()
+        return self.resolve(exception=RequestCancelled(f"request {self.id} was cancelled"))
+
+
+class ServiceMetrics:
+    COUNTERS = (
+        "requests_total", "requests_rejected", "requests_completed", "requests_failed", "requests_cancelled",
+        "requests_timed_out", "batches_total", "batched_requests_total", "batches_interrupted",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {name: 0 for name in self.COUNTERS}
+        self.latency_sum_s = 0.
+        self.queue_wait_sum_s = 0.
+
+    def inc(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, latency_s: float, queue_wait_s: float):
+        with self._lock:
+            self.latency_sum_s += latency_s
+            self.queue_wait_sum_s += queue_wait_s
+
+    def render(self, gauges: Dict[str, float]) -> str:
+        with self._lock:
+            lines = [f"era3d_{name} {value}" for name, value in self.counters.items()]
+            lines.append(f"era3d_request_latency_seconds_sum {self.latency_sum_s:.6f}")
+            lines.append(f"era3d_request_queue_wait_seconds_sum {self.queue_wait_sum_s:.6f}")
+        lines += [f"era3d_{name} {value}" for name, value in gauges.items()]
+        return "\n".join(lines) + "\n"
+
+
+def clone_pipeline(pipeline: StableUnCLIPImg2ImgPipeline) -> StableUnCLIPImg2ImgPipeline:
+    r"""
+    A pipeline sharing the models of `pipeline` but with its own schedulers, which `__call__` mutates.
+    """
+    components = dict(pipeline.components)
+    components["scheduler"] = copy.deepcopy(pipeline.scheduler)
+    components["image_noising_scheduler"] = copy.deepcopy(pipeline.image_noising_scheduler)
+    clone = StableUnCLIPImg2ImgPipeline(**components, num_views=pipeline.num_views)
+    clone.set_progress_bar_config(disable=True)
+    return clone
+
+
+class InferenceService:
+    r"""
+    Queue, micro-batching and workers around one pipeline; `serve` puts the HTTP endpoints in front of it.
+
+    Args:
+        pipeline (`StableUnCLIPImg2ImgPipeline`):
+            The placed pipeline, its models are shared by all workers.
+        prompt_embeddings (`torch.Tensor`):
+            `(2 * Nv, N, C)` fixed prompt embeddings, the normal domain first.
+        max_queue_size (`int`, *optional*, defaults to 32):
+            Requests beyond this many waiting ones are rejected with `QueueFull`.
+        max_concurrency (`int`, *optional*, defaults to 1):
+            The number of batches running at once.
+        max_batch_size (`int`, *optional*, defaults to 4):
+            The most input images in one pipeline call.
+        batch_wait_ms (`float`, *optional*, defaults to 10):
+            How long a worker waits for compatible requests to fill a batch.
+        default_timeout_s (`float`, *optional*, defaults to 300):
+            The timeout of requests that do not set their own, counted from their submission.
+        pipe_kwargs (`dict`, *optional*):
+            Further arguments of every pipeline call, e.g. the `eta` of `pipe_validation_kwargs`.
+    """
+    def __init__(
+        self,
+        pipeline: StableUnCLIPImg2ImgPipeline,
+        prompt_embeddings: torch.Tensor,
+        max_queue_size: int = 32,
+        max_concurrency: int = 1,
+        max_batch_size: int = 4,
+        batch_wait_ms: float = 10.,
+        default_timeout_s: float = 300.,
+        pipe_kwargs: Optional[dict] = None,
+    ):
+        self.pipeline = pipeline
+        self.pipeline.set_progress_bar_config(disable=True)
+        self.prompt_embeddings = prompt_embeddings.to(device=pipeline._execution_device, dtype=pipeline.unet.dtype)
+        self.max_queue_size = max_queue_size
+        self.max_concurrency = max_concurrency
+        self.max_batch_size = max_batch_size
+        self.batch_wait_s = batch_wait_ms / 1000.
+        self.default_timeout_s = default_timeout_s
+        self.pipe_kwargs = {'eta': 1.0, **(pipe_kwargs or {})}
+        self.metrics = ServiceMetrics()
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._requests: Dict[str, GenerationRequest] = {}
+        self._in_flight = 0
+        self._workers: List[threading.Thread] = []
+        self._stopped = False
+
+    @property
+    def image_size(self) -> int:
+        return self.pipeline.unet.config.sample_size * self.pipeline.vae_scale_factor
+
+    @property
+    def num_views(self) -> int:
+        return self.pipeline.num_views
+
+    def is_ready(self) -> bool:
+        return not self._stopped and len(self._workers) > 0 and all(worker.is_alive() for worker in self._workers)
+
+    def start(self):
+        for rank in range(self.max_concurrency):
+            pipeline = self.pipeline if rank == 0 else clone_pipeline(self.pipeline)
+            worker = threading.Thread(target=self._worker, args=(pipeline,), name=f"era3d-worker-{rank}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            queued, self._queue = list(self._queue), deque()
+            self._cond.notify_all()
+        for request in queued:
+            request.cancel()
+        for worker in self._workers:
+            worker.join()
+
+    def submit(
+        self,
+        image: torch.Tensor,
+        guidance_scale: float = 3.0,
+        num_inference_steps: int = 40,
+        seed: int = 42,
+        timeout_s: Optional[float] = None,
+    ) -> GenerationRequest:
+        r"""
+        Queues one preprocessed `(3, H, W)` image; the result, `{'colors', 'normals'}` as `(Nv, H, W, 3)` uint8
+        arrays, arrives on the `future` of the returned request. Raises `QueueFull` when the queue is full.
+        """
+        timeout_s = self.default_timeout_s if timeout_s is None else timeout_s
+        request = GenerationRequest(
+            image=image, guidance_scale=float(guidance_scale), num_inference_steps=int(num_inference_steps),
+            seed=int(seed), deadline=time.monotonic() + timeout_s,
+        )
+        with self._cond:
+            if self._stopped or len(self._queue) >= self.max_queue_size:
+                self.metrics.inc("requests_rejected")
+                raise QueueFull(f"{len(self._queue)} requests are waiting, try again later.")
+            self._queue.append(request)
+            self._requests[request.id] = request
+            self.metrics.inc("requests_total")
+            self._cond.notify_all()
+        return request
+
+    def cancel(self, request_id: str) -> bool:
+        request = self._requests.get(request_id)
+        if request is None or not request.cancel():
+            return False
+        self.metrics.inc("requests_cancelled")
+        return True
+
+    def expire(self, request: GenerationRequest):
+        if request.resolve(exception=RequestTimeout(f"request {request.id} timed out")):
+            self.metrics.inc("requests_timed_out")
+
+    def gauges(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "queue_depth": len(self._queue),
+                "in_flight_requests": self._in_flight,
+                "workers_alive": sum(worker.is_alive() for worker in self._workers),
+            }
+
+    def _sweep(self):
+        # drops cancelled and expired requests from the queue, with `_cond` held
+        if any(request.abandoned() for request in self._queue):
+            for request in self._queue:
+                if request.expired():
+                    self.expire(request)
+                if request.abandoned():
+                    self._requests.pop(request.id, None)
+            self._queue = deque(request for request in self._queue if not request.abandoned())
+
+    def _take_compatible(self, key, max_count: int) -> List[GenerationRequest]:
+        taken, kept = [], deque()
+        for request in self._queue:
+            if len(taken) < max_count and request.batch_key() == key:
+                taken.append(request)
+            else:
+                kept.append(request)
+        self._queue = kept
+        return taken
+
+    def _next_batch(self) -> Optional[List[GenerationRequest]]:
+        with self._cond:
+            while True:
+                self._sweep()
+                if self._stopped:
+                    return None
+                if len(self._queue) > 0:
+                    break
+                # woken up regularly to expire queued requests
+                self._cond.wait(timeout=0.5)
+            first = self._queue.popleft()
+            batch = [first]
+            batch_deadline = time.monotonic() + self.batch_wait_s
+            while True:
+                batch += self._take_compatible(first.batch_key(), self.max_batch_size - len(batch))
+                remaining = batch_deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0 or self._stopped:
+                    break
+                self._cond.wait(timeout=remaining)
+            self._in_flight += len(batch)
+            return batch
+
+    def _worker(self, pipeline: StableUnCLIPImg2ImgPipeline):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            started = time.monotonic()
+            wanted = [request for request in batch if not request.abandoned()]
+            try:
+                if len(wanted) > 0:
+                    self.metrics.inc("batches_total")
+                    self.metrics.inc("batched_requests_total", len(wanted))
+                    results = self.generate(pipeline, wanted)
+                    for request, result in zip(wanted, results):
+                        if request.resolve(result):
+                            self.metrics.inc("requests_completed")
+                            self.metrics.observe(time.monotonic() - request.enqueued, started - request.enqueued)
+            except RequestCancelled:
+                self.metrics.inc("batches_interrupted")
+            except Exception as e:
+                for request in wanted:
+                    if request.resolve(exception=e):
+                        self.metrics.inc("requests_failed")
+            finally:
+                for request in batch:
+                    if request.expired():
+                        self.expire(request)
+                with self._cond:
+                    self._in_flight -= len(batch)
+                    for request in batch:
+                        self._requests.pop(request.id, None)
+
+    @torch.no_grad()
+    def generate(self, pipeline: StableUnCLIPImg2ImgPipeline, batch: List[GenerationRequest]) -> List[dict]:
+        num_views = pipeline.num_views
+        device = pipeline._execution_device
+        bsz = len(batch)
+
+        images = torch.stack([request.image for request in batch]).to(device=device, dtype=pipeline.unet.dtype)
+        # (2B, Nv, 3, H, W) expanded view, normal then color domain, every input image is encoded once
+        imgs_in = torch.cat([images] * 2, dim=0).unsqueeze(1).expand(-1, num_views, -1, -1, -1)
+        normal_embeds, color_embeds = self.prompt_embeddings.chunk(2, dim=0)
+        prompt_embeds = torch.cat([normal_embeds] * bsz + [color_embeds] * bsz, dim=0)
+        # one generator per request, repeated for its views: each generator is drawn from in the same order as in a
+        # batch of one, so a request gets the same noise whatever it was batched with (batched kernels may still
+        # round differently, see tests/test_inference_service.py)
+        generators = [torch.Generator(device=device).manual_seed(request.seed) for request in batch]
+        generator = [generators[i] for i in range(bsz) for _ in range(num_views)] * 2
+
+        def stop_when_abandoned(step, timestep, latents):
+            if all(request.abandoned() for request in batch):
+                raise RequestCancelled("every request of the batch was cancelled or timed out")
+
+        pipe_kwargs = {**self.pipe_kwargs, 'num_inference_steps': batch[0].num_inference_steps}
+        out = pipeline(
+            imgs_in, None, prompt_embeds=prompt_embeds, generator=generator, guidance_scale=batch[0].guidance_scale,
+            output_type='pt', num_images_per_prompt=1, callback=stop_when_abandoned, **pipe_kwargs
+        ).images
+        out = out.mul(255).add_(0.5).clamp_(0, 255).permute(0, 2, 3, 1).to("cpu", torch.uint8).numpy()
+        normals, colors = out[:bsz * num_views], out[bsz * num_views:]
+        return [
+            {
+                'normals': normals[i * num_views:(i + 1) * num_views],
+                'colors': colors[i * num_views:(i + 1) * num_views],
+            }
+            for i in range(bsz)
+        ]
+
+
+def preprocess_image(image: Image.Image, image_size: int, crop_size: Optional[int] = None) -> torch.Tensor:
+    r"""
+    An RGBA image with the background removed -> `(3, H, W)` input on white, like `SingleImageDataset`.
+    """
+    from mvdiffusion.data.single_image_dataset import SingleImageDataset
+
+    if crop_size is None:
+        # the demo crops 512 px inputs to 420 px
+        crop_size = int(image_size * 420 / 512)
+    dataset = SingleImageDataset(
+        root_dir='', num_views=1, img_wh=[image_size, image_size], bg_color='white', crop_size=crop_size,
+        single_image=image.convert('RGBA'), prompt_embeds_path=None,
+    )
+    return dataset[0]['imgs_in']
+
+
+def _encode_png(ndarr: np.ndarray) -> str:
+    buffer = io.BytesIO()
+    Image.fromarray(ndarr).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    # `self.server.service` is the InferenceService
+    def _send_json(self, status: int, body: dict, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/healthz':
+            ready = service.is_ready()
+            self._send_json(200 if ready else 503, {'status': 'ok' if ready else 'unavailable', **service.gauges()})
+        elif self.path == '/metrics':
+            data = service.metrics.render(service.gauges()).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_DELETE(self):
+        if not self.path.startswith('/requests/'):
+            return self._send_json(404, {'error': f'unknown path {self.path}'})
+        request_id = self.path[len('/requests/'):]
+        if self.server.service.cancel(request_id):
+            self._send_json(200, {'id': request_id, 'status': 'cancelled'})
+        else:
+            self._send_json(404, {'error': f'no queued or running request {request_id}'})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self._send_json(404, {'error': f'unknown path {self.path}'})
+        service = self.server.service
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            image = Image.open(io.BytesIO(base64.b64decode(body['image'])))
+            image = preprocess_image(image, service.image_size, body.get('crop_size'))
+        except Exception as e:
+            return self._send_json(400, {'error': f'invalid request: {e}'})
+
+        try:
+            request = service.submit(
+                image, guidance_scale=body.get('guidance_scale', 3.0),
+                num_inference_steps=body.get('num_inference_steps', 40), seed=body.get('seed', 42),
+                timeout_s=body.get('timeout_s'),
+            )
+        except QueueFull as e:
+            return self._send_json(503, {'error': str(e)}, headers={'Retry-After': '1'})
+
+        headers = {'X-Request-Id': request.id}
+        try:
+            result = request.future.result(timeout=max(request.deadline - time.monotonic(), 0))
+        except (FutureTimeoutError, RequestTimeout):
+            service.expire(request)
+            return self._send_json(504, {'id': request.id, 'error': 'timed out'}, headers=headers)
+        except RequestCancelled:
+            return self._send_json(499, {'id': request.id, 'error': 'cancelled'}, headers=headers)
+        except Exception as e:
+            return self._send_json(500, {'id': request.id, 'error': str(e)}, headers=headers)
+        self._send_json(200, {
+            'id': request.id,
+            'views': VIEWS.get(service.num_views, list(range(service.num_views))),
+            'colors': [_encode_png(color) for color in result['colors']],
+            'normals': [_encode_png(normal) for normal in result['normals']],
+        }, headers=headers)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(service: InferenceService, host: str = '0.0.0.0', port: int = 8000):
+    service.start()
+    server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"serving Era3D on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.stop()
+
+
+def build_tiny_pipeline(num_views: int = 6, seed: int = 0, width: int = 32):
+    r"""
+    A randomly initialized pipeline with the Era3D architecture at a toy size (16 px images), for running the service
+    on a cpu. `width` is the channel count of the first UNet block; raise it for a model with more weights, e.g. to
+    measure memory. Returns the pipeline and matching `(2 * Nv, 4, 32)` prompt embeddings.
+    """
+    from diffusers import AutoencoderKL, DDIMScheduler, DDPMScheduler
+    from diffusers.pipelines.stable_diffusion.stable_unclip_image_normalizer import StableUnCLIPImageNormalizer
+    from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModelWithProjection
+
+    from mvdiffusion.models.unet_mv2d_condition import UNetMV2DConditionModel
+
+    torch.manual_seed(seed)
+    embedder_dim = 16
+    image_encoder = CLIPVisionModelWithProjection(CLIPVisionConfig(
+        hidden_size=32, projection_dim=embedder_dim, num_hidden_layers=2, num_attention_heads=4,
+        intermediate_size=37, image_size=32, patch_size=4,
+    ))
+    unet = UNetMV2DConditionModel(
+        sample_size=8, in_channels=8, out_channels=4,
+        down_block_types=("CrossAttnDownBlockMV2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlockMV2D"),
+        block_out_channels=(width, 2 * width), layers_per_block=1, cross_attention_dim=32, attention_head_dim=8,
+        # the noised image embedding is concatenated with its noise level embedding
+        class_embed_type="projection", projection_class_embeddings_input_dim=2 * embedder_dim,
+        num_views=num_views, multiview_attention=True, sparse_mv_attention=True, selfattn_block="self_rowwise",
+        mvcd_attention=True,
+        # like the released model, the elevation and focal length are regressed and embedded
+        regress_elevation=True, regress_focal_length=True, projection_camera_embeddings_input_dim=4,
+        num_regress_blocks=1,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(32, 64), in_channels=3, out_channels=3, latent_channels=4,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+    )
+    pipeline = StableUnCLIPImg2ImgPipeline(
+        feature_extractor=CLIPImageProcessor(crop_size=32, size=32),
+        image_encoder=image_encoder,
+        image_normalizer=StableUnCLIPImageNormalizer(embedding_dim=embedder_dim),
+        image_noising_scheduler=DDPMScheduler(beta_schedule="squaredcos_cap_v2"),
+        tokenizer=None,
+        text_encoder=None,
+        unet=unet,
+        scheduler=DDIMScheduler(
+            beta_schedule="scaled_linear", beta_start=0.00085, beta_end=0.012, prediction_type="v_prediction",
+            set_alpha_to_one=False, steps_offset=1,
+        ),
+        vae=vae,
+        num_views=num_views,
+    )
+    prompt_embeddings = torch.randn(2 * num_views, 4, 32)
+    return pipeline, prompt_embeddings
+
+
+def load_service_pipeline(cfg, device: str):
+    r"""
+    The pipeline and prompt embeddings described by a test config, placed on `device`.
+    """
+    from mvdiffusion.pipelines.pipeline_loading import load_era3d_pipeline
+
+    pipeline, prompt_embeds = load_era3d_pipeline(cfg, device=device)
+    if cfg.attention_backend is not None and cfg.attention_backend != 'autotune':
+        from mvdiffusion.models.attention_backends import set_attention_backend
+
+        set_attention_backend(pipeline.unet, cfg.attention_backend)
+    if cfg.attention_slice_size is not None:
+        pipeline.enable_attention_slicing(cfg.attention_slice_size)
+    return pipeline, torch.cat([prompt_embeds['normal'], prompt_embeds['color']], dim=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default=None)
+    parser.add_argument('--tiny', action='store_true', help='serve a random-weight toy model, e.g. on a cpu')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_queue_size', type=int, default=32)
+    parser.add_argument('--max_concurrency', type=int, default=1)
+    parser.add_argument('--max_batch_size', type=int, default=4)
+    parser.add_argument('--batch_wait_ms', type=float, default=10.)
+    parser.add_argument('--timeout_s', type=float, default=300.)
+    args, extras = parser.parse_known_args()
+
+    if args.tiny:
+        pipeline, prompt_embeddings = build_tiny_pipeline()
+        pipeline.to(args.device)
+        pipe_kwargs = None
+    elif args.config is not None:
+        from omegaconf import OmegaConf
+        from utils.misc import load_config
+        from test_mvdiffusion_unclip import TestConfig
+
+        cfg = OmegaConf.merge(OmegaConf.structured(TestConfig), load_config(args.config, cli_args=extras))
+        pipeline, prompt_embeddings = load_service_pipeline(cfg, args.device)
+        # the steps are chosen per request
+        pipe_kwargs = {k: v for k, v in cfg.pipe_validation_kwargs.items() if k != 'num_inference_steps'}
+    else:
+        parser.error('pass --config or --tiny')
+
+    service = InferenceService(
+        pipeline, prompt_embeddings, max_queue_size=args.max_queue_size, max_concurrency=args.max_concurrency,
+        max_batch_size=args.max_batch_size, batch_wait_ms=args.batch_wait_ms, default_timeout_s=args.timeout_s,
+        pipe_kwargs=pipe_kwargs,
+    )
+    serve(service, host=args.host, port=args.port)
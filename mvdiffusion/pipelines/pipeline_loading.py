@@ -0,0 +1,67 @@
+"""
+Loading the Era3D pipeline described by a test config, for the test script, the inference service, snapshot export
+and the benchmarks:
+
+    pipeline, prompt_embeds = load_era3d_pipeline(cfg)
+    prompt_embeddings = batch_prompt_embeddings(prompt_embeds, batch_size)
+
+The fixed prompt embeddings come with the pipeline: from the snapshot when `cfg.pipeline_snapshot` is set, from
+`cfg.validation_dataset.prompt_embeds_path` otherwise.
+"""
+import os
+from typing import Dict, Optional, Tuple
+
+import torch
+from einops import rearrange
+
+from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
+
+
+def load_prompt_embeds(prompt_embeds_path: str) -> Dict[str, torch.Tensor]:
+    r"""
+    The fixed `(Nv, N, C)` normal and color prompt embeddings saved in `prompt_embeds_path`.
+    """
+    return {
+        'normal': torch.load(f'{prompt_embeds_path}/normal_embeds.pt'),
+        'color': torch.load(f'{prompt_embeds_path}/clr_embeds.pt'),
+    }
+
+
+def load_era3d_pipeline(
+    cfg, device: Optional[str] = 'cuda:0', dtype: torch.dtype = torch.float16, root: str = ''
+) -> Tuple[StableUnCLIPImg2ImgPipeline, Dict[str, torch.Tensor]]:
+    r"""
+    The pipeline described by `cfg` and its fixed prompt embeddings, `{'normal': ..., 'color': ...}`.
+
+    Args:
+        cfg (`TestConfig`):
+            The test config.
+        device (`str`, *optional*, defaults to `'cuda:0'`):
+            Where to place the pipeline. `None`, or no cuda, keeps it on the cpu.
+        dtype (`torch.dtype`, *optional*, defaults to `torch.float16`):
+            The dtype of the pretrained weights. A snapshot keeps the dtype it was exported in.
+        root (`str`, *optional*):
+            The directory a relative `prompt_embeds_path` is resolved against, for callers outside the repository root.
+    """
+    from mvdiffusion.pipelines.pipeline_snapshot import load_pipeline_snapshot
+
+    device = device if torch.cuda.is_available() else None
+    if cfg.get('pipeline_snapshot') is not None:
+        return load_pipeline_snapshot(cfg.pipeline_snapshot, device=device)
+    pipeline = StableUnCLIPImg2ImgPipeline.from_pretrained(
+        cfg.pretrained_model_name_or_path, torch_dtype=dtype, **cfg.pipe_kwargs
+    )
+    pipeline.unet.enable_xformers_memory_efficient_attention()
+    if device is not None:
+        pipeline.to(device)
+    return pipeline, load_prompt_embeds(os.path.join(root, cfg.validation_dataset.prompt_embeds_path))
+
+
+def batch_prompt_embeddings(prompt_embeds: Dict[str, torch.Tensor], batch_size: int) -> torch.Tensor:
+    r"""
+    The `(2 * batch_size * Nv, N, C)` prompt embeddings of a batch: the normal ones of every example, then the color
+    ones, in the order of the doubled `imgs_in`.
+    """
+    normal = prompt_embeds['normal'][None].expand(batch_size, -1, -1, -1)
+    color = prompt_embeds['color'][None].expand(batch_size, -1, -1, -1)
+    return rearrange(torch.cat([normal, color], dim=0), "B Nv N C -> (B Nv) N C")
@@ -192,7 +192,9 @@ class StableUnCLIPImg2ImgPipeline(DiffusionPipeline):
                 weighting. If not provided, negative_prompt_embeds will be generated from `negative_prompt` input
                 argument.
         """
-        prompt_embeds = prompt_embeds.to(dtype=self.text_encoder.dtype, device=device)
+        # pipelines restored from a snapshot run on the fixed prompt embeddings and carry no text encoder
+        dtype = self.text_encoder.dtype if self.text_encoder is not None else self.unet.dtype
+        prompt_embeds = prompt_embeds.to(dtype=dtype, device=device)
 
         if do_classifier_free_guidance:
             # For classifier free guidance, we need to do two forward passes.
@@ -211,13 +213,16 @@ class StableUnCLIPImg2ImgPipeline(DiffusionPipeline):
         num_images_per_prompt,
         do_classifier_free_guidance,
         noise_level: int=0,
-        generator: Optional[torch.Generator] = None
+        generator: Optional[torch.Generator] = None,
+        num_views_per_image: int = 1,
     ):
         dtype = next(self.image_encoder.parameters()).dtype
         # ______________________________clip image embedding______________________________ 
         image = self.feature_extractor(images=image_pil, return_tensors="pt").pixel_values
         image = image.to(device=device, dtype=dtype)
         image_embeds = self.image_encoder(image).image_embeds
+        # every view of an input image shares its embedding, the noise below is still drawn per view
+        image_embeds = image_embeds.repeat_interleave(num_views_per_image, dim=0)
         
         image_embeds = self.noise_image_embeddings(
             image_embeds=image_embeds,
@@ -242,6 +247,7 @@ class StableUnCLIPImg2ImgPipeline(DiffusionPipeline):
         image_pt = torch.stack([TF.to_tensor(img) for img in image_pil], dim=0).to(dtype=self.vae.dtype, device=device)
         image_pt = image_pt * 2.0 - 1.0
         image_latents = self.vae.encode(image_pt).latent_dist.mode() * self.vae.config.scaling_factor
+        image_latents = image_latents.repeat_interleave(num_views_per_image, dim=0)
         # Note: repeat differently from official pipelines     
         image_latents = image_latents.repeat(num_images_per_prompt, 1, 1, 1)
 
@@ -411,7 +417,8 @@ class StableUnCLIPImg2ImgPipeline(DiffusionPipeline):
                 `Image`, or tensor representing an image batch. The image will be encoded to its CLIP embedding which
                 the unet will be conditioned on. Note that the image is _not_ encoded by the vae and then used as the
                 latents in the denoising process such as in the standard stable diffusion text guided image variation
-                process.
+                process. A `(batch, num_views, channels, height, width)` tensor gives the input of each view; when it
+                is an `expand`ed view of one image per batch entry, that image is only encoded once.
             height (`int`, *optional*, defaults to self.unet.config.sample_size * self.vae_scale_factor):
                 The height in pixels of the generated image.
             width (`int`, *optional*, defaults to self.unet.config.sample_size * self.vae_scale_factor):
@@ -493,13 +500,25 @@ class StableUnCLIPImg2ImgPipeline(DiffusionPipeline):
         )
 
         # 2. Define call parameters
+        num_views_per_image = 1
         if isinstance(image, list):
             batch_size = len(image)
         elif isinstance(image, torch.Tensor):
-            batch_size = image.shape[0]
+            if image.ndim == 5:
+                assert image.shape[1] == self.num_views
+                batch_size = image.shape[0] * image.shape[1]
+                if image.stride(1) == 0:
+                    # the views are broadcast from one image each
+                    num_views_per_image = self.num_views
+                    image = image[:, 0]
+                else:
+                    image = image.flatten(0, 1)
+            else:
+                batch_size = image.shape[0]
             assert batch_size >= self.num_views and batch_size % self.num_views == 0
         elif isinstance(image, PIL.Image.Image):
-            image = [image]*self.num_views*2
+            image = [image]*2
+            num_views_per_image = self.num_views
             batch_size = self.num_views*2
 
         if isinstance(prompt, str):
@@ -541,6 +560,7 @@ class StableUnCLIPImg2ImgPipeline(DiffusionPipeline):
             do_classifier_free_guidance=do_classifier_free_guidance,
             noise_level=noise_level,
             generator=generator,
+            num_views_per_image=num_views_per_image,
         )
 
         # 5. Prepare timesteps
@@ -0,0 +1,248 @@
+"""
+Single-file snapshots of a ready-to-run Era3D pipeline.
+
+A snapshot is one safetensors file holding the weights of every model in the target dtype, the fixed prompt
+embeddings, and, in its metadata, the model / scheduler configs and the attention processors and slice sizes chosen for each layer.
+Restoring it is one (memory-mapped) read plus meta-device construction: no hub resolution, no random init, no dtype
+conversion and no processor swaps.
+
+    python -m mvdiffusion.pipelines.pipeline_snapshot export --config configs/test_unclip-512-6view.yaml \
+        --output era3d-512-6view.safetensors
+    python -m mvdiffusion.pipelines.pipeline_snapshot import --snapshot era3d-512-6view.safetensors
+
+The tokenizer and the text encoder are not part of a snapshot: Era3D always runs on the fixed prompt embeddings.
+"""
+import argparse
+import importlib
+import json
+import time
+from typing import Dict, Optional, Tuple
+
+import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModelWithProjection
+
+import diffusers
+from diffusers.models import AutoencoderKL
+from diffusers.pipelines.stable_diffusion.stable_unclip_image_normalizer import StableUnCLIPImageNormalizer
+
+from mvdiffusion.models.unet_mv2d_condition import UNetMV2DConditionModel
+from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
+
+SNAPSHOT_FORMAT = "era3d-pipeline-snapshot"
+SNAPSHOT_VERSION = "1"
+
+# pipeline attribute -> model class, all restored from their config on the meta device
+_SNAPSHOT_MODELS = {
+    "unet": UNetMV2DConditionModel,
+    "vae": AutoencoderKL,
+    "image_encoder": CLIPVisionModelWithProjection,
+    "image_normalizer": StableUnCLIPImageNormalizer,
+}
+_SNAPSHOT_SCHEDULERS = ("scheduler", "image_noising_scheduler")
+
+
+def _model_config(model) -> dict:
+    if isinstance(model, CLIPVisionModelWithProjection):
+        return model.config.to_dict()
+    return dict(model.config)
+
+
+def _processor_spec(processor) -> dict:
+    spec = {"module": type(processor).__module__, "class": type(processor).__qualname__}
+    if hasattr(processor, "backend"):
+        spec["backend"] = processor.backend
+    return spec
+
+
+def _build_processor(spec: dict):
+    processor_cls = getattr(importlib.import_module(spec["module"]), spec["class"])
+    processor = processor_cls()
+    if "backend" in spec:
+        processor.backend = spec["backend"]
+    return processor
+
+
+def pipeline_to_tensors(
+    pipeline: StableUnCLIPImg2ImgPipeline,
+    prompt_embeds: Optional[Dict[str, torch.Tensor]] = None,
+    dtype: torch.dtype = torch.float16,
+) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    r"""
+    Flattens `pipeline` (with its current attention processors) and the fixed `prompt_embeds` into a flat dict of
+    cpu tensors and a dict of string metadata, the two halves of a snapshot.
+
+    Args:
+        pipeline (`StableUnCLIPImg2ImgPipeline`):
+            The pipeline to export, as configured for inference.
+        prompt_embeds (`Dict[str, torch.Tensor]`, *optional*):
+            The fixed prompt embeddings, e.g. `{'normal': ..., 'color': ...}`.
+        dtype (`torch.dtype`, *optional*, defaults to `torch.float16`):
+            The dtype floating point weights are stored in.
+    """
+    tensors = {}
+    configs = {}
+    for name in _SNAPSHOT_MODELS:
+        model = getattr(pipeline, name)
+        configs[name] = _model_config(model)
+        for key, value in model.state_dict().items():
+            value = value.detach()
+            if value.is_floating_point():
+                value = value.to(dtype)
+            tensors[f"{name}.{key}"] = value.contiguous().cpu()
+    for key, value in (prompt_embeds or {}).items():
+        tensors[f"prompt_embeds.{key}"] = value.detach().to(dtype).contiguous().cpu()
+
+    schedulers = {
+        name: {"class": type(getattr(pipeline, name)).__name__, "config": dict(getattr(pipeline, name).config)}
+        for name in _SNAPSHOT_SCHEDULERS
+    }
+    metadata = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "dtype": str(dtype).replace("torch.", ""),
+        "num_views": str(pipeline.num_views),
+        "configs": json.dumps(configs),
+        "schedulers": json.dumps(schedulers),
+        "feature_extractor": json.dumps(pipeline.feature_extractor.to_dict()),
+        "attn_processors": json.dumps(
+            {name: _processor_spec(processor) for name, processor in pipeline.unet.attn_processors.items()}
+        ),
+        # sliced attention is a setting of the attention layers, not of their (possibly shared) processors
+        "attention_slice_sizes": json.dumps({
+            name: module.attention_slice_size for name, module in pipeline.unet.named_modules()
+            if getattr(module, "attention_slice_size", None) is not None
+        }),
+    }
+    return tensors, metadata
+
+
+def pipeline_from_tensors(
+    tensors: Dict[str, torch.Tensor], metadata: Dict[str, str], device: Optional[str] = None
+) -> Tuple[StableUnCLIPImg2ImgPipeline, Dict[str, torch.Tensor]]:
+    r"""
+    Rebuilds a pipeline from the output of `pipeline_to_tensors`. The models are built on the meta device and take
+    `tensors` as their parameters without copying them.
+
+    Returns:
+        `tuple`: the pipeline and the dict of fixed prompt embeddings.
+    """
+    if metadata.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError("The metadata does not describe an Era3D pipeline snapshot.")
+    if metadata["version"] != SNAPSHOT_VERSION:
+        raise ValueError(
+            f"Got snapshot version {metadata['version']}, but version {SNAPSHOT_VERSION} is expected."
+        )
+
+    grouped = {}
+    for key, value in tensors.items():
+        name, key = key.split(".", 1)
+        grouped.setdefault(name, {})[key] = value
+
+    configs = json.loads(metadata["configs"])
+    components = {}
+    for name, model_cls in _SNAPSHOT_MODELS.items():
+        with init_empty_weights():
+            if model_cls is CLIPVisionModelWithProjection:
+                model = model_cls(CLIPVisionConfig.from_dict(configs[name]))
+            else:
+                model = model_cls.from_config(configs[name])
+        # the tensors become the parameters as they are, nothing is copied
+        model.load_state_dict(grouped[name], assign=True)
+        components[name] = model.eval()
+
+    for name, spec in json.loads(metadata["schedulers"]).items():
+        components[name] = getattr(diffusers, spec["class"]).from_config(spec["config"])
+
+    pipeline = StableUnCLIPImg2ImgPipeline(
+        feature_extractor=CLIPImageProcessor.from_dict(json.loads(metadata["feature_extractor"])),
+        tokenizer=None,
+        text_encoder=None,
+        num_views=int(metadata["num_views"]),
+        **components,
+    )
+    processors = {
+        name: _build_processor(spec) for name, spec in json.loads(metadata["attn_processors"]).items()
+    }
+    pipeline.unet.set_attn_processor(processors)
+    modules = dict(pipeline.unet.named_modules())
+    for name, slice_size in json.loads(metadata.get("attention_slice_sizes", "{}")).items():
+        modules[name].set_attention_slice(slice_size)
+    if device is not None:
+        # non-persistent buffers are not part of the snapshot and were created on the cpu
+        pipeline.to(device)
+    return pipeline, grouped.get("prompt_embeds", {})
+
+
+def export_pipeline_snapshot(
+    pipeline: StableUnCLIPImg2ImgPipeline,
+    output_path: str,
+    prompt_embeds: Optional[Dict[str, torch.Tensor]] = None,
+    dtype: torch.dtype = torch.float16,
+):
+    r"""
+    Writes `pipeline` and the fixed `prompt_embeds` into one safetensors file, see `pipeline_to_tensors`.
+    """
+    tensors, metadata = pipeline_to_tensors(pipeline, prompt_embeds=prompt_embeds, dtype=dtype)
+    save_file(tensors, output_path, metadata=metadata)
+
+
+def load_pipeline_snapshot(
+    snapshot_path: str, device: Optional[str] = None
+) -> Tuple[StableUnCLIPImg2ImgPipeline, Dict[str, torch.Tensor]]:
+    r"""
+    Restores a pipeline written by `export_pipeline_snapshot`.
+
+    Args:
+        snapshot_path (`str`):
+            The snapshot file.
+        device (`str`, *optional*):
+            Where to place the weights, e.g. `'cuda:0'`. safetensors reads them straight onto that device.
+
+    Returns:
+        `tuple`: the pipeline and the dict of fixed prompt embeddings.
+    """
+    with safe_open(snapshot_path, framework="pt") as f:
+        metadata = f.metadata()
+    if metadata is None or metadata.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"{snapshot_path} is not an Era3D pipeline snapshot.")
+    tensors = load_file(snapshot_path, device=device or "cpu")
+    return pipeline_from_tensors(tensors, metadata, device=device)
+
+
+def export_from_config(cfg, output_path: str):
+    from mvdiffusion.models.attention_backends import set_attention_backend
+    from mvdiffusion.pipelines.pipeline_loading import load_era3d_pipeline
+
+    pipeline, prompt_embeds = load_era3d_pipeline(cfg)
+    if cfg.attention_backend is not None and cfg.attention_backend != 'autotune':
+        set_attention_backend(pipeline.unet, cfg.attention_backend)
+    export_pipeline_snapshot(pipeline, output_path, prompt_embeds=prompt_embeds, dtype=pipeline.unet.dtype)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='write a snapshot of the pipeline described by a config')
+    export_parser.add_argument('--config', type=str, required=True)
+    export_parser.add_argument('--output', type=str, required=True)
+    import_parser = subparsers.add_parser('import', help='restore a snapshot and report how long it took')
+    import_parser.add_argument('--snapshot', type=str, required=True)
+    import_parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    args, extras = parser.parse_known_args()
+
+    if args.command == 'export':
+        from omegaconf import OmegaConf
+        from utils.misc import load_config
+        from test_mvdiffusion_unclip import TestConfig
+
+        cfg = OmegaConf.merge(OmegaConf.structured(TestConfig), load_config(args.config, cli_args=extras))
+        export_from_config(cfg, args.output)
+        print(f"snapshot written to {args.output}")
+    else:
+        start = time.perf_counter()
+        pipeline, prompt_embeds = load_pipeline_snapshot(args.snapshot, device=args.device)
+        print(f"restored {args.snapshot} on {pipeline.device} in {time.perf_counter() - start:.2f}s,"
+              f" prompt embeddings: {sorted(prompt_embeds.keys())}")
@@ -0,0 +1,173 @@
+"""
+Content-addressed store of generated results, used by the Gradio demo and the batch runner. Their keys are built from
+different parameters, so each only hits its own entries.
+
+An entry is keyed by a hash of the preprocessed input image and every parameter that changes the output (seed,
+guidance scale, steps, crop size, model revision, ...) and holds the result files under stable names, e.g. the
+multiview normals and colors and, once reconstructed, the mesh. Entries are directories below `root`, holding
+numbered versions: every `put` assembles the next version aside and renames it into place, so readers see a complete
+version and concurrent writers merge instead of overwriting each other. Entries are evicted least-recently-used first
+once the store grows beyond `max_size_gb`.
+
+    cache = ResultCache('.cache/results', max_size_gb=20)
+    key = cache.make_key(image, seed=42, guidance_scale=3.0, num_inference_steps=40, crop_size=420, revision=rev)
+    files = cache.get(key)  # {name: path} or None
+    if files is None:
+        ...
+        cache.put(key, {'color_front.png': path, ...})
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+_ENTRY_FILE = "entry.json"
+# writers merging into the same entry at once retry this often before giving up
+_PUT_ATTEMPTS = 16
+
+
+class ResultCache:
+    def __init__(self, root: str, max_size_gb: float = 20.0):
+        self.root = root
+        self.max_size_bytes = int(max_size_gb * 1024 ** 3)
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def make_key(image, **params) -> str:
+        r"""
+        Hash of `image` (a numpy array, a PIL image or bytes) and the json-serializable `params`.
+        """
+        if not isinstance(image, bytes):
+            image = np.ascontiguousarray(np.asarray(image))
+            image = str(image.shape).encode() + str(image.dtype).encode() + image.tobytes()
+        key = hashlib.sha256(image)
+        key.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return key.hexdigest()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    @staticmethod
+    def _versions(entry_dir: str):
+        return sorted(name for name in os.listdir(entry_dir) if name.startswith("v") and name[1:].isdigit())
+
+    def _read_entry(self, key: str) -> Optional[Tuple[str, dict]]:
+        # the latest version of the entry and its description, or None while there is none
+        entry_dir = self._entry_dir(key)
+        try:
+            versions = self._versions(entry_dir)
+            if not versions:
+                return None
+            version_dir = os.path.join(entry_dir, versions[-1])
+            with open(os.path.join(version_dir, _ENTRY_FILE)) as f:
+                return version_dir, json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # evicted or superseded meanwhile
+            return None
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        r"""
+        Returns `{name: path}` of the files of entry `key`, or `None` on a miss, and marks the entry as used.
+        """
+        current = self._read_entry(key)
+        if current is None:
+            return None
+        version_dir, entry = current
+        files = {name: os.path.join(version_dir, name) for name in entry["files"]}
+        if not all(os.path.exists(path) for path in files.values()):
+            return None
+        try:
+            # the modification time of the entry directory orders the entries for eviction
+            os.utime(self._entry_dir(key))
+        except FileNotFoundError:
+            return None
+        return files
+
+    def put(self, key: str, files: Dict[str, str], metadata: Optional[dict] = None) -> Dict[str, str]:
+        r"""
+        Copies `files` (`{name: source path}`) into entry `key`, next to the files the entry already has, and
+        evicts old entries if the store is over quota. Returns `{name: path}` of all files of the entry.
+        """
+        entry_dir = self._entry_dir(key)
+        for _ in range(_PUT_ATTEMPTS):
+            current = self._read_entry(key)
+            version, entry = 0, {"files": [], "metadata": {}}
+            # assembled next to the store and renamed into place, readers never see a half written version
+            tmp_dir = os.path.join(self.root, f".tmp-{key}-{uuid.uuid4().hex}")
+            try:
+                if current is not None:
+                    version_dir, entry = current
+                    version = int(os.path.basename(version_dir)[1:])
+                    shutil.copytree(version_dir, tmp_dir)
+                else:
+                    os.makedirs(tmp_dir)
+            except (FileNotFoundError, shutil.Error):
+                # the version was superseded while being copied
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                continue
+            for name, path in files.items():
+                shutil.copyfile(path, os.path.join(tmp_dir, name))
+            entry["files"] = sorted(set(entry["files"]) | set(files.keys()))
+            entry["metadata"].update(metadata or {})
+            entry["updated"] = time.time()
+            with open(os.path.join(tmp_dir, _ENTRY_FILE), "w") as f:
+                json.dump(entry, f, indent=2)
+
+            # renaming onto an existing version fails, so of two writers starting from the same version one wins
+            # and the other merges its files into the winner's version on the next attempt
+            try:
+                os.makedirs(entry_dir, exist_ok=True)
+                os.rename(tmp_dir, os.path.join(entry_dir, f"v{version + 1:08d}"))
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                continue
+            # the replaced version stays for the readers that just looked it up, the files of the older ones go; their
+            # description stays, so a writer starting from a stale version can never rename into a free number
+            try:
+                for name in self._versions(entry_dir):
+                    if int(name[1:]) < version:
+                        for filename in os.listdir(os.path.join(entry_dir, name)):
+                            if filename != _ENTRY_FILE:
+                                os.remove(os.path.join(entry_dir, name, filename))
+            except FileNotFoundError:
+                # pruned by another writer or evicted meanwhile
+                pass
+            break
+        else:
+            raise RuntimeError(f"Could not store the result entry {key}, it kept changing under {_PUT_ATTEMPTS} attempts.")
+
+        self.evict()
+        return self.get(key) or {}
+
+    def evict(self):
+        r"""
+        Deletes the least recently used entries until the store fits into `max_size_gb`.
+        """
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.root):
+            entry_dir = self._entry_dir(key)
+            if key.startswith(".tmp-") or not os.path.isdir(entry_dir):
+                continue
+            try:
+                mtime = os.path.getmtime(entry_dir)
+                size = sum(
+                    os.path.getsize(os.path.join(dirpath, filename))
+                    for dirpath, _, filenames in os.walk(entry_dir) for filename in filenames
+                )
+            except FileNotFoundError:
+                # evicted or superseded meanwhile
+                continue
+            entries.append((mtime, size, entry_dir))
+            total_size += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,119 @@
+"""
+Sharing one copy of the Era3D weights between several inference processes on a host.
+
+The parent flattens the pipeline into cpu tensors (see `pipeline_snapshot.pipeline_to_tensors`), moves them into
+shared memory once and hands them to the workers. Spawned workers receive the tensors as shared-memory handles,
+forked ones inherit the mapping; either way every worker rebuilds its pipeline on the meta device around the very
+same storages, so an extra worker only costs its runtime and activations. The shared tensors are read-only by
+convention: workers run inference only and must not modify the weights in place.
+
+    state = share_pipeline(pipeline, prompt_embeds)
+    processes = launch_shared_workers(state, worker_fn, num_workers=4)
+    for process in processes:
+        process.join()
+
+with `worker_fn(rank, pipeline, prompt_embeds, *args)` defined at module level, so spawned workers can import it.
+"""
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
+from mvdiffusion.pipelines.pipeline_snapshot import pipeline_from_tensors, pipeline_to_tensors
+
+
+@dataclass
+class SharedPipelineState:
+    tensors: Dict[str, torch.Tensor]
+    metadata: Dict[str, str]
+
+    def attach(self, device: Optional[str] = None) -> Tuple[StableUnCLIPImg2ImgPipeline, Dict[str, torch.Tensor]]:
+        r"""
+        Builds a pipeline around the shared tensors. On the cpu the weights stay shared; with a cuda `device` they
+        are copied to the GPU straight from shared memory, without a private host copy.
+        """
+        pipeline, prompt_embeds = pipeline_from_tensors(self.tensors, self.metadata, device=device)
+        for name in ("unet", "vae", "image_encoder", "image_normalizer"):
+            getattr(pipeline, name).requires_grad_(False)
+        return pipeline, prompt_embeds
+
+
+def share_pipeline(
+    pipeline: StableUnCLIPImg2ImgPipeline,
+    prompt_embeds: Optional[Dict[str, torch.Tensor]] = None,
+    dtype: torch.dtype = torch.float16,
+) -> SharedPipelineState:
+    r"""
+    Moves the weights of `pipeline` (and the fixed `prompt_embeds`) into shared memory. Load `pipeline` on the cpu:
+    tensors that already are cpu tensors of `dtype` are moved in place, so the parent does not keep a second copy.
+    """
+    tensors, metadata = pipeline_to_tensors(pipeline, prompt_embeds=prompt_embeds, dtype=dtype)
+    for tensor in tensors.values():
+        tensor.share_memory_()
+    return SharedPipelineState(tensors, metadata)
+
+
+def _shared_worker_main(rank, state: SharedPipelineState, worker_fn: Callable, device: Optional[str], args):
+    torch.set_grad_enabled(False)
+    pipeline, prompt_embeds = state.attach(device=device)
+    worker_fn(rank, pipeline, prompt_embeds, *args)
+
+
+def launch_shared_workers(
+    state: SharedPipelineState,
+    worker_fn: Callable,
+    num_workers: int,
+    start_method: str = "spawn",
+    devices: Optional[List[str]] = None,
+    args: tuple = (),
+) -> List[mp.Process]:
+    r"""
+    Starts `num_workers` processes running `worker_fn(rank, pipeline, prompt_embeds, *args)` on the shared weights.
+
+    Args:
+        state (`SharedPipelineState`):
+            The output of `share_pipeline`.
+        worker_fn (`Callable`):
+            The worker body, a module-level function.
+        num_workers (`int`):
+            The number of processes to start.
+        start_method (`str`, *optional*, defaults to `"spawn"`):
+            `"spawn"` or `"fork"`; CUDA can only be used in forked workers if the parent never initialized it.
+        devices (`List[str]`, *optional*):
+            The device of each worker, defaults to the GPUs round robin, or the cpu when there are none.
+        args (`tuple`, *optional*):
+            Extra (picklable) arguments for `worker_fn`.
+
+    Returns:
+        `List[torch.multiprocessing.Process]`: the started processes.
+    """
+    if devices is None:
+        num_gpus = torch.cuda.device_count()
+        devices = [f"cuda:{rank % num_gpus}" if num_gpus > 0 else None for rank in range(num_workers)]
+    if len(devices) != num_workers:
+        raise ValueError(f"Got {len(devices)} devices for {num_workers} workers.")
+
+    ctx = mp.get_context(start_method)
+    processes = []
+    for rank in range(num_workers):
+        process = ctx.Process(target=_shared_worker_main, args=(rank, state, worker_fn, devices[rank], args))
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def memory_usage_mb() -> Dict[str, float]:
+    r"""
+    Resident (RSS) and proportional (PSS) set size of this process in MB. PSS splits shared pages between the
+    processes mapping them, so it is the number to look at when the weights are shared. Linux only.
+    """
+    usage = {}
+    with open(f"/proc/{os.getpid()}/smaps_rollup") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            if key in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty"):
+                usage[key.lower()] = int(value.split()[0]) / 1024
+    return usage
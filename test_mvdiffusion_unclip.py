@@ -1,21 +1,16 @@
 import argparse
 import os
-from typing import Dict, Optional,  List
+import shutil
+from typing import Any, Dict, Optional,  List
 from omegaconf import OmegaConf
 from PIL import Image
 from dataclasses import dataclass
 from collections import defaultdict
 import torch
-import torch.nn.functional as F
-import torch.utils.checkpoint
-import torchvision.transforms.functional as TF
-from torchvision.utils import make_grid, save_image
-from accelerate.utils import  set_seed
 from tqdm.auto import tqdm
 from mvdiffusion.data.single_image_dataset import SingleImageDataset
-from einops import rearrange, repeat
-from rembg import remove
-from mvdiffusion.pipelines.pipeline_mvdiffusion_unclip import StableUnCLIPImg2ImgPipeline
+# heavy / optional dependencies (diffusers, accelerate, torchvision, rembg) are imported where they are first used,
+# see benchmarks/importtime.py
 
 weight_dtype = torch.float16
 
@@ -56,6 +51,17 @@ class TestConfig:
     
     regress_elevation: bool
     regress_focal_length: bool
+
+    attention_backend: Optional[str] = None  # eager, sdpa, xformers, blockwise or autotune
+    attention_autotune_cache: Optional[str] = None
+    attention_slice_size: Optional[Any] = None  # 'auto', 'max' or an int, trades speed for peak memory
+    pipeline_snapshot: Optional[str] = None  # written by `python -m mvdiffusion.pipelines.pipeline_snapshot export`
+    num_shared_workers: int = 0  # > 0: load the weights once into shared memory and split the dataset over workers
+    rgba_mask: str = 'rembg'  # rgba save mode: 'rembg' per image, or one mask per view by 'threshold' or 'refined'
+    # content-addressed cache of the saved results, reused across runs of this script with the same settings (the demo
+    # keys its results differently); reseeds the generator per batch
+    result_cache_dir: Optional[str] = None
+    result_cache_size_gb: float = 20.0
     
 
 
@@ -72,7 +78,32 @@ def save_image_numpy(ndarr, fp):
     im = Image.fromarray(ndarr)
     im.save(fp)
 
-def log_validation_joint(dataloader, pipeline, cfg: TestConfig,  save_dir):
+def expand_views(imgs_in, num_views):
+    # (B, 3, H, W) -> (B, Nv, 3, H, W) view of the same storage, the pipeline encodes each image once
+    return imgs_in.unsqueeze(1).expand(-1, num_views, -1, -1, -1)
+
+def scene_output_files(cfg: TestConfig, cur_dir, scene, num_views):
+    # {name in the result cache: path} of the files saved for one scene
+    if cfg.save_mode == 'concat':
+        return {'concat.png': f"{cur_dir}/{scene}.png"}
+    scene_dir = os.path.join(cur_dir, scene)
+    files = {}
+    for j in range(num_views):
+        for filename in (f"normals_{VIEWS[j]}_masked.png", f"color_{VIEWS[j]}_masked.png"):
+            files[filename] = os.path.join(scene_dir, filename)
+    return files
+
+def result_cache_params(cfg: TestConfig, num_views):
+    # everything besides the input image and the guidance scale that changes the saved files
+    return dict(
+        seed=cfg.seed, model=cfg.pretrained_model_name_or_path, revision=cfg.revision,
+        unet=cfg.pretrained_unet_path, pipeline_snapshot=cfg.pipeline_snapshot, num_views=num_views,
+        crop_size=cfg.validation_dataset.get('crop_size'), save_mode=cfg.save_mode, rgba_mask=cfg.rgba_mask,
+        pipe_validation_kwargs=dict(cfg.pipe_validation_kwargs),
+    )
+
+def log_validation_joint(dataloader, pipeline, prompt_embeds, cfg: TestConfig,  save_dir):
+    from mvdiffusion.pipelines.pipeline_loading import batch_prompt_embeddings
 
     pipeline.set_progress_bar_config(disable=True)
 
@@ -80,21 +111,46 @@ def log_validation_joint(dataloader, pipeline, cfg: TestConfig,  save_dir):
         generator = None
     else:
         generator = torch.Generator(device=pipeline.unet.device).manual_seed(cfg.seed)
+    result_cache = None
+    if cfg.result_cache_dir is not None:
+        from mvdiffusion.pipelines.result_cache import ResultCache
+        result_cache = ResultCache(cfg.result_cache_dir, max_size_gb=cfg.result_cache_size_gb)
+        result_params = result_cache_params(cfg, pipeline.num_views)
     
     images_cond, pred_cat = [], defaultdict(list)
     for _, batch in tqdm(enumerate(dataloader)):
-        images_cond.append(batch['imgs_in'][:, 0]) 
-        imgs_in = torch.cat([batch['imgs_in']]*2, dim=0)
-        num_views = imgs_in.shape[1]
-        imgs_in = rearrange(imgs_in, "B Nv C H W -> (B Nv) C H W")# (B*Nv, 3, H, W)
+        images_cond.append(batch['imgs_in']) 
+        num_views = pipeline.num_views
+        scenes = [filename.split('.')[0] for filename in batch['filename']]
+        imgs_in = expand_views(torch.cat([batch['imgs_in']]*2, dim=0), num_views) # (B, Nv, 3, H, W), not copied
 
-        normal_prompt_embeddings, clr_prompt_embeddings = batch['normal_prompt_embeddings'], batch['color_prompt_embeddings'] 
-        prompt_embeddings = torch.cat([normal_prompt_embeddings, clr_prompt_embeddings], dim=0)
-        prompt_embeddings = rearrange(prompt_embeddings, "B Nv N C -> (B Nv) N C")
+        prompt_embeddings = batch_prompt_embeddings(prompt_embeds, len(scenes))
 
         with torch.autocast("cuda"):
             # B*Nv images
             for guidance_scale in cfg.validation_guidance_scales:
+                # cur_dir = os.path.join(save_dir, f"cropsize-{cfg.validation_dataset.crop_size}-cfg{guidance_scale:.1f}-seed{cfg.seed}")
+                cur_dir = save_dir 
+                os.makedirs(cur_dir, exist_ok=True)
+                if result_cache is not None:
+                    # the noise of a scene depends on the size of its batch and its position in it
+                    keys = [
+                        result_cache.make_key(
+                            batch['imgs_in'][i].numpy(), guidance_scale=guidance_scale, batch_size=len(scenes),
+                            batch_position=i, **result_params,
+                        )
+                        for i in range(len(scenes))
+                    ]
+                    cached = [result_cache.get(key) for key in keys]
+                    if all(files is not None for files in cached):
+                        for scene, files in zip(scenes, cached):
+                            for name, path in scene_output_files(cfg, cur_dir, scene, num_views).items():
+                                os.makedirs(os.path.dirname(path), exist_ok=True)
+                                shutil.copyfile(files[name], path)
+                        continue
+                    if generator is not None:
+                        # the outputs of a batch must not depend on the batches generated before it
+                        generator.manual_seed(cfg.seed)
                 unet_out = pipeline(
                     imgs_in, None, prompt_embeds=prompt_embeddings,
                     generator=generator, guidance_scale=guidance_scale, output_type='pt', num_images_per_prompt=1, 
@@ -108,9 +164,6 @@ def log_validation_joint(dataloader, pipeline, cfg: TestConfig,  save_dir):
                 images_pred = out[bsz:] 
                 # print(normals_pred.shape, images_pred.shape)
                 pred_cat[f"cfg{guidance_scale:.1f}"].append(torch.cat([normals_pred, images_pred], dim=-1)) # b, 3, h, w
-                # cur_dir = os.path.join(save_dir, f"cropsize-{cfg.validation_dataset.crop_size}-cfg{guidance_scale:.1f}-seed{cfg.seed}")
-                cur_dir = save_dir 
-                os.makedirs(cur_dir, exist_ok=True)
                 if cfg.save_mode == 'concat': ## save concatenated color and normal---------------------
                     for i in range(bsz//num_views):
                         scene =  batch['filename'][i].split('.')[0]
@@ -128,6 +181,7 @@ def log_validation_joint(dataloader, pipeline, cfg: TestConfig,  save_dir):
 
                         out_filename = f"{cur_dir}/{scene}.png"
                         vis_ = torch.stack(vis_, dim=0)
+                        from torchvision.utils import make_grid
                         vis_ = make_grid(vis_, nrow=len(vis_), padding=0, value_range=(0, 1))
                         save_image(vis_, out_filename)
                 elif cfg.save_mode == 'rgb':
@@ -152,7 +206,12 @@ def log_validation_joint(dataloader, pipeline, cfg: TestConfig,  save_dir):
                             save_image(normal, os.path.join(scene_dir, normal_filename))
                             save_image(color, os.path.join(scene_dir, rgb_filename))
                 elif cfg.save_mode == 'rgba':
+                    from mvdiffusion.data.background_removal import remove_background_batch
+                    from mvdiffusion.data.view_masks import derive_view_masks
 
+                    if cfg.rgba_mask != 'rembg':
+                        # one mask per view, used as the alpha of its normal and its color
+                        masks = derive_view_masks(normals_pred, images_pred, refine=cfg.rgba_mask == 'refined')
                     for i in range(bsz//num_views):
                         scene =  batch['filename'][i].split('.')[0]
                         scene_dir = os.path.join(cur_dir, scene)
@@ -160,6 +219,17 @@ def log_validation_joint(dataloader, pipeline, cfg: TestConfig,  save_dir):
 
                         img_in_ = images_cond[-1][i].to(out.device)
                         vis_ = [img_in_]
+                        if cfg.rgba_mask == 'rembg':
+                            # the normals and colors of all views of a scene are segmented in one call
+                            rm_views = remove_background_batch(
+                                [convert_to_numpy(normals_pred[i*num_views + j]) for j in range(num_views)] +
+                                [convert_to_numpy(images_pred[i*num_views + j]) for j in range(num_views)]
+                            )
+                        else:
+                            rm_views = [
+                                convert_to_numpy(torch.cat([preds[i*num_views + j], masks[i*num_views + j]], dim=0))
+                                for preds in (normals_pred, images_pred) for j in range(num_views)
+                            ]
                         for j in range(num_views):
                             view = VIEWS[j]
                             idx = i*num_views + j
@@ -168,43 +238,103 @@ def log_validation_joint(dataloader, pipeline, cfg: TestConfig,  save_dir):
                             vis_.append(color)
                             vis_.append(normal)
                             
-                            normal = convert_to_numpy(normal)
-                            color = convert_to_numpy(color)
-                            rm_normal = remove(normal)
-                            rm_color = remove(color)
+                            rm_normal = rm_views[j]
+                            rm_color = rm_views[num_views + j]
                             normal_filename = f"normals_{view}_masked.png"
                             rgb_filename = f"color_{view}_masked.png"
                             save_image_numpy(rm_normal, os.path.join(scene_dir, normal_filename))
                             save_image_numpy(rm_color, os.path.join(scene_dir, rgb_filename))
+                if result_cache is not None:
+                    for scene, key in zip(scenes, keys):
+                        result_cache.put(key, scene_output_files(cfg, cur_dir, scene, num_views))
     torch.cuda.empty_cache()    
 
-def load_era3d_pipeline(cfg):
-    pipeline = StableUnCLIPImg2ImgPipeline.from_pretrained(cfg.pretrained_model_name_or_path, torch_dtype=weight_dtype)
-    pipeline.unet.enable_xformers_memory_efficient_attention()
-    if torch.cuda.is_available():
-        pipeline.to('cuda:0')
-    return pipeline
+def autotune_pipeline_attention(pipeline, prompt_embeds, batch, cfg: TestConfig):
+    from mvdiffusion.models.attention_backends import autotune_attention_backends
+    from mvdiffusion.pipelines.pipeline_loading import batch_prompt_embeddings
+
+    # one denoising step on a real batch traces the attention shapes of every UNet level
+    imgs_in = expand_views(torch.cat([batch['imgs_in']]*2, dim=0), pipeline.num_views)
+    prompt_embeddings = batch_prompt_embeddings(prompt_embeds, len(batch['imgs_in']))
+
+    def forward_fn():
+        with torch.autocast("cuda"):
+            pipeline(
+                imgs_in, None, prompt_embeds=prompt_embeddings, guidance_scale=cfg.validation_guidance_scales[0],
+                output_type='latent', num_images_per_prompt=1, num_inference_steps=1
+            )
+
+    pipeline.set_progress_bar_config(disable=True)
+    return autotune_attention_backends(pipeline.unet, forward_fn, cache_path=cfg.attention_autotune_cache)
+
+def setup_attention(pipeline, prompt_embeds, validation_dataloader, cfg: TestConfig):
+    from mvdiffusion.models.attention_backends import set_attention_backend
+
+    if cfg.attention_backend == 'autotune':
+        autotune_pipeline_attention(pipeline, prompt_embeds, next(iter(validation_dataloader)), cfg)
+    elif cfg.attention_backend is not None:
+        set_attention_backend(pipeline.unet, cfg.attention_backend)
+    if cfg.attention_slice_size is not None:
+        pipeline.enable_attention_slicing(cfg.attention_slice_size)
+
+def build_validation_dataset(cfg: TestConfig):
+    # the prompt embeddings come with the pipeline, the dataset only loads the images
+    return SingleImageDataset(**{**cfg.validation_dataset, 'prompt_embeds_path': None})
+
+def shared_validation_worker(rank, pipeline, prompt_embeds, cfg: TestConfig, views, num_workers):
+    # spawned workers re-import this file without running `__main__`
+    from accelerate.utils import set_seed
+
+    global VIEWS
+    VIEWS = views
+    if cfg.seed is not None:
+        set_seed(cfg.seed)
+    validation_dataset = build_validation_dataset(cfg)
+    validation_dataset = torch.utils.data.Subset(validation_dataset, range(rank, len(validation_dataset), num_workers))
+    validation_dataloader = torch.utils.data.DataLoader(
+        validation_dataset, batch_size=cfg.validation_batch_size, shuffle=False, num_workers=cfg.dataloader_num_workers
+    )
+    setup_attention(pipeline, prompt_embeds, validation_dataloader, cfg)
+    log_validation_joint(validation_dataloader, pipeline, prompt_embeds, cfg, cfg.save_dir)
+
+def main_shared(cfg: TestConfig):
+    from mvdiffusion.pipelines.pipeline_loading import load_era3d_pipeline
+    from mvdiffusion.pipelines.shared_pipeline import launch_shared_workers, share_pipeline
+
+    # the parent keeps the weights on the cpu, in shared memory; each worker copies them to its own GPU
+    pipeline, prompt_embeds = load_era3d_pipeline(cfg, device=None, dtype=weight_dtype)
+    state = share_pipeline(pipeline, prompt_embeds, dtype=weight_dtype)
+    del pipeline
+    os.makedirs(cfg.save_dir, exist_ok=True)
+    processes = launch_shared_workers(
+        state, shared_validation_worker, cfg.num_shared_workers, args=(cfg, VIEWS, cfg.num_shared_workers)
+    )
+    for process in processes:
+        process.join()
 
 def main(
     cfg: TestConfig
 ):
+    from accelerate.utils import set_seed
+    from mvdiffusion.pipelines.pipeline_loading import load_era3d_pipeline
+
+    if cfg.num_shared_workers > 0:
+        return main_shared(cfg)
     if cfg.seed is not None:
         set_seed(cfg.seed)
-    pipeline = load_era3d_pipeline(cfg)
-    if torch.cuda.is_available():
-        pipeline.to('cuda:0')
+    pipeline, prompt_embeds = load_era3d_pipeline(cfg, dtype=weight_dtype)
 
     # Get the  dataset
-    validation_dataset = SingleImageDataset(
-        **cfg.validation_dataset
-    )
+    validation_dataset = build_validation_dataset(cfg)
     # DataLoaders creation:
     validation_dataloader = torch.utils.data.DataLoader(
         validation_dataset, batch_size=cfg.validation_batch_size, shuffle=False, num_workers=cfg.dataloader_num_workers
     )
     os.makedirs(cfg.save_dir, exist_ok=True)
 
-    log_validation_joint(validation_dataloader, pipeline, cfg, cfg.save_dir)
+    setup_attention(pipeline, prompt_embeds, validation_dataloader, cfg)
+
+    log_validation_joint(validation_dataloader, pipeline, prompt_embeds, cfg, cfg.save_dir)
    
     
     
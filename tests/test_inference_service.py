@@ -0,0 +1,228 @@
+"""
+Queueing, cancellation, timeouts and micro-batching of the inference service, on the random-weight toy pipeline on
+the cpu:
+
+    python -m pytest tests/test_inference_service.py
+"""
+import base64
+import io
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+from PIL import Image
+
+from mvdiffusion.pipelines.inference_service import (
+    InferenceRequestHandler,
+    InferenceService,
+    RequestCancelled,
+    RequestTimeout,
+    build_tiny_pipeline,
+)
+
+
+@pytest.fixture(scope="module")
+def tiny_pipeline():
+    return build_tiny_pipeline()
+
+
+def make_service(tiny_pipeline, **kwargs):
+    pipeline, prompt_embeddings = tiny_pipeline
+    return InferenceService(pipeline, prompt_embeddings, **kwargs)
+
+
+def random_images(count, size=16, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.rand(3, size, size, generator=generator) for _ in range(count)]
+
+
+def wait_for(condition, timeout_s=60.):
+    deadline = time.monotonic() + timeout_s
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def http_server():
+    # the endpoints around a service whose workers the test starts, or not
+    servers = []
+
+    def start(service):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), InferenceRequestHandler)
+        server.daemon_threads = True
+        server.service = service
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def http(method, url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status, dict(response.headers), json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), json.loads(e.read())
+
+
+def png_body(**kwargs):
+    image = Image.new("RGBA", (32, 32), (0, 0, 0, 0))
+    image.paste((200, 80, 40, 255), (8, 8, 24, 24))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return {"image": base64.b64encode(buffer.getvalue()).decode(), **kwargs}
+
+
+def test_full_queue_answers_503(tiny_pipeline, http_server):
+    # no workers: the one queued request stays queued
+    service = make_service(tiny_pipeline, max_queue_size=1)
+    queued = service.submit(random_images(1)[0], num_inference_steps=1)
+    url = http_server(service)
+
+    status, headers, body = http("POST", f"{url}/generate", png_body(num_inference_steps=1))
+    assert status == 503
+    assert headers["Retry-After"] == "1"
+    assert service.metrics.counters["requests_rejected"] == 1
+    assert not queued.future.done()
+
+
+def test_cancel_queued_request(tiny_pipeline, http_server):
+    service = make_service(tiny_pipeline)
+    request = service.submit(random_images(1)[0], num_inference_steps=1)
+    url = http_server(service)
+
+    status, _, body = http("DELETE", f"{url}/requests/{request.id}")
+    assert status == 200 and body["status"] == "cancelled"
+    with pytest.raises(RequestCancelled):
+        request.future.result(timeout=1)
+    assert service.metrics.counters["requests_cancelled"] == 1
+
+    service.start()
+    try:
+        # the worker drops it from the queue instead of running it
+        wait_for(lambda: service.gauges()["queue_depth"] == 0)
+        assert service.metrics.counters["batches_total"] == 0
+        status, _, _ = http("DELETE", f"{url}/requests/{request.id}")
+        assert status == 404
+    finally:
+        service.stop()
+
+
+def test_cancel_running_request_stops_its_batch(tiny_pipeline):
+    service = make_service(tiny_pipeline)
+    service.start()
+    try:
+        request = service.submit(random_images(1)[0], num_inference_steps=500)
+        wait_for(lambda: service.gauges()["in_flight_requests"] == 1)
+        assert service.cancel(request.id)
+        with pytest.raises(RequestCancelled):
+            request.future.result(timeout=1)
+        wait_for(lambda: service.metrics.counters["batches_interrupted"] == 1)
+        assert service.gauges()["in_flight_requests"] == 0
+        assert service.metrics.counters["requests_completed"] == 0
+    finally:
+        service.stop()
+
+
+def test_timeout_while_queued(tiny_pipeline, http_server):
+    # no workers: the request can only time out
+    service = make_service(tiny_pipeline)
+    url = http_server(service)
+
+    status, headers, body = http("POST", f"{url}/generate", png_body(num_inference_steps=1, timeout_s=0.2))
+    assert status == 504
+    assert body["id"] == headers["X-Request-Id"]
+    assert service.metrics.counters["requests_timed_out"] == 1
+
+
+def test_timeout_while_running(tiny_pipeline):
+    service = make_service(tiny_pipeline)
+    service.start()
+    try:
+        request = service.submit(random_images(1)[0], num_inference_steps=500, timeout_s=0.5)
+        with pytest.raises(RequestTimeout):
+            request.future.result(timeout=60)
+        wait_for(lambda: service.metrics.counters["batches_interrupted"] == 1)
+        assert service.metrics.counters["requests_timed_out"] == 1
+    finally:
+        service.stop()
+
+
+def test_generate_endpoint(tiny_pipeline, http_server):
+    service = make_service(tiny_pipeline)
+    service.start()
+    try:
+        url = http_server(service)
+        status, _, body = http("GET", f"{url}/healthz")
+        assert status == 200 and body["status"] == "ok"
+
+        status, headers, body = http("POST", f"{url}/generate", png_body(num_inference_steps=2, seed=3))
+        assert status == 200
+        assert body["id"] == headers["X-Request-Id"]
+        assert len(body["colors"]) == len(body["normals"]) == len(body["views"]) == service.num_views
+        color = np.asarray(Image.open(io.BytesIO(base64.b64decode(body["colors"][0]))))
+        assert color.shape == (service.image_size, service.image_size, 3)
+
+        with urllib.request.urlopen(f"{url}/metrics", timeout=10) as response:
+            metrics = response.read().decode()
+        assert "era3d_requests_completed 1" in metrics
+    finally:
+        service.stop()
+
+
+def test_compatible_requests_share_a_batch(tiny_pipeline):
+    service = make_service(tiny_pipeline, max_batch_size=4)
+    images = random_images(4)
+    # queued before the worker starts: the three compatible ones form one batch, the other guidance scale another
+    requests = [service.submit(image, num_inference_steps=2, seed=10 + i) for i, image in enumerate(images[:3])]
+    other = service.submit(images[3], guidance_scale=2.0, num_inference_steps=2, seed=13)
+    service.start()
+    try:
+        for request in requests + [other]:
+            request.future.result(timeout=60)
+        assert service.metrics.counters["batches_total"] == 2
+        assert service.metrics.counters["batched_requests_total"] == 4
+    finally:
+        service.stop()
+
+
+def test_output_does_not_depend_on_the_batch(tiny_pipeline):
+    service = make_service(tiny_pipeline, max_batch_size=4)
+    images = random_images(3)
+    batched = [service.submit(image, num_inference_steps=3, seed=10 + i) for i, image in enumerate(images)]
+    service.start()
+    try:
+        batched = [request.future.result(timeout=60) for request in batched]
+        assert service.metrics.counters["batches_total"] == 1
+        alone = [
+            service.submit(image, num_inference_steps=3, seed=10 + i).future.result(timeout=60)
+            for i, image in enumerate(images)
+        ]
+        reseeded = service.submit(images[0], num_inference_steps=3, seed=99).future.result(timeout=60)
+        assert service.metrics.counters["batches_total"] == 5
+    finally:
+        service.stop()
+
+    for batched_result, alone_result in zip(batched, alone):
+        for domain in ("colors", "normals"):
+            # the same noise; batched kernels may round differently, by at most one level of the uint8 output
+            difference = np.abs(batched_result[domain].astype(int) - alone_result[domain].astype(int))
+            assert difference.max() <= 1
+    # another seed draws other noise
+    assert np.abs(reseeded["colors"].astype(int) - alone[0]["colors"].astype(int)).max() > 1
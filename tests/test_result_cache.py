@@ -0,0 +1,55 @@
+"""
+Concurrent writers and readers of one result cache entry:
+
+    python -m pytest tests/test_result_cache.py
+"""
+import threading
+
+from mvdiffusion.pipelines.result_cache import ResultCache
+
+
+def test_concurrent_puts_merge(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    key = cache.make_key(b"image", seed=42)
+    sources = []
+    for i in range(8):
+        source = tmp_path / f"view_{i}.png"
+        source.write_bytes(bytes([i]) * 64)
+        sources.append(source)
+
+    stop = threading.Event()
+    read_errors = []
+
+    def read():
+        while not stop.is_set():
+            try:
+                files = cache.get(key)
+                if files is not None:
+                    for path in files.values():
+                        with open(path, "rb"):
+                            pass
+            except FileNotFoundError:
+                # a version replaced after the lookup may go away, a lookup itself must not raise
+                pass
+            except Exception as e:
+                read_errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    writers = [
+        threading.Thread(target=cache.put, args=(key, {source.name: str(source)}, {source.name: i}))
+        for i, source in enumerate(sources)
+    ]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    assert read_errors == []
+    files = cache.get(key)
+    assert sorted(files) == sorted(source.name for source in sources)
+    for source in sources:
+        with open(files[source.name], "rb") as f:
+            assert f.read() == source.read_bytes()
@@ -0,0 +1,50 @@
+"""
+Initializing the multiview UNet from a 2D checkpoint, on a toy-size Stable Diffusion UNet:
+
+    python -m pytest tests/test_unet_from_pretrained_2d.py
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+from diffusers import UNet2DConditionModel
+
+from mvdiffusion.models.unet_mv2d_condition import UNetMV2DConditionModel
+
+
+@pytest.fixture(scope="module")
+def checkpoint_2d(tmp_path_factory):
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        sample_size=8, in_channels=4, out_channels=4, block_out_channels=(16, 16, 16, 16), layers_per_block=1,
+        norm_num_groups=8, cross_attention_dim=16, attention_head_dim=8,
+    )
+    path = tmp_path_factory.mktemp("unet_2d")
+    unet.save_pretrained(path)
+    return path, unet.state_dict()
+
+
+@pytest.mark.parametrize("low_cpu_mem_usage", [False, True])
+def test_mv_attention_is_a_copy_of_self_attention(checkpoint_2d, low_cpu_mem_usage):
+    path, state_dict_2d = checkpoint_2d
+    unet = UNetMV2DConditionModel.from_pretrained_2d(
+        path, camera_embedding_type="e_de_da_sincos", num_views=6, sample_size=8, selfattn_block="self_rowwise",
+        init_mvattn_with_selfattn=True, low_cpu_mem_usage=low_cpu_mem_usage,
+    )
+    params = dict(unet.named_parameters())
+    pairs = [
+        (name, name.replace("attn_mv", "attn1").replace("norm_mv", "norm1"))
+        for name in params if ".attn_mv." in name or ".norm_mv." in name
+    ]
+    assert len(pairs) > 0
+    for name_mv, name_self in pairs:
+        assert params[name_mv].data_ptr() != params[name_self].data_ptr(), name_mv
+        if name_mv.endswith("attn_mv.to_out.0.weight"):
+            assert torch.count_nonzero(params[name_mv]) == 0
+        else:
+            torch.testing.assert_close(params[name_mv], state_dict_2d[name_self], msg=name_mv)
+
+    # the multiview layers train on their own
+    with torch.no_grad():
+        params[pairs[0][0]].add_(1.)
+    torch.testing.assert_close(params[pairs[0][1]], state_dict_2d[pairs[0][1]])